@@ -6,22 +6,222 @@ Has a /submit endpoint to test form POST.
 
 From QEMU user-mode networking, the host is accessible at 10.0.2.2.
 So in TrustOS: browse http://10.0.2.2:8080/
+
+Usage:
+    python test_browser_server.py [--port 8080] [--dir DIR]
+                                  [--shape [PATTERN:]KEY=V,...] [--shape-file FILE]
+                                  [--seed N]
+
+    --port N    Port to listen on (default 8080)
+    --dir DIR   Directory to serve (default: test_server/ next to this script)
+    --shape RULE
+                Slow down responses whose URL path matches PATTERN (glob,
+                default *), repeatable; first matching rule wins. Keys:
+                  rate=KB/s      bandwidth cap per connection
+                  latency=MS     delay before the response starts
+                  jitter=MS      extra random delay, 0..MS
+                  chunk=BYTES    send the response in pieces of this size
+                  reset=P        probability of resetting the connection
+                                 part-way through the response
+                e.g. --shape "/images/*:rate=16,chunk=536,reset=0.1"
+    --shape-file FILE
+                JSON list of rules, each {"path": PATTERN, KEY: V, ...},
+                checked after the --shape rules
+    --seed N    Seed for jitter and resets (default 0); the same seed and
+                request order replay the same faults
+
+Shaping counters per rule: http://10.0.2.2:8080/__shape
 """
 
+import fnmatch
 import http.server
+import json
 import os
+import random
+import socket
+import struct
 import sys
+import threading
+import time
 from urllib.parse import parse_qs
 
 PORT = 8080
 DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_server")
 
+# ─── Link Shaping ────────────────────────────────────────────────────────────
+# At localhost speed the kernel browser never sees a slow or broken link, so
+# its TCP stack (1 s RTO, 3 retries) goes unexercised. A matching rule paces
+# the response on its connection, splits it into small send() calls with
+# Nagle off (one segment each), and can abort it with an RST at a random
+# offset. Random choices come from a generator seeded with --seed, the path
+# and how often that path has been requested, so a run replays the same
+# faults whatever the thread interleaving.
+
+SHAPE_KEYS = {"rate": float, "latency": float, "jitter": float, "chunk": int, "reset": float}
+
+class ShapeRule:
+    def __init__(self, pattern, **options):
+        unknown = set(options) - set(SHAPE_KEYS)
+        if unknown:
+            raise ValueError(f"unknown shape key(s): {', '.join(sorted(unknown))}")
+        self.pattern = pattern
+        self.options = {k: SHAPE_KEYS[k](v) for k, v in options.items()}
+        self.rate = self.options.get("rate", 0) * 1024
+        self.latency = self.options.get("latency", 0) / 1000
+        self.jitter = self.options.get("jitter", 0) / 1000
+        self.chunk = self.options.get("chunk", 0)
+        self.reset = self.options.get("reset", 0)
+        self.requests = 0
+        self.resets = 0
+        self.bytes = 0
+
+    @classmethod
+    def parse(cls, spec):
+        """ "[PATTERN:]key=v,key=v" -> ShapeRule."""
+        pattern, _, opts = spec.rpartition(":")
+        options = dict(item.split("=", 1) for item in opts.split(",") if item)
+        return cls(pattern or "*", **options)
+
+    def describe(self):
+        return f"{self.pattern}: " + ", ".join(f"{k}={v:g}" for k, v in self.options.items())
+
+class LinkShaper:
+    """Ordered shaping rules and their counters."""
+
+    def __init__(self, seed=0):
+        self.rules = []
+        self.seed = seed
+        self.seen = {}
+        self.lock = threading.Lock()
+
+    def load(self, path):
+        with open(path) as f:
+            for item in json.load(f):
+                item = dict(item)
+                self.rules.append(ShapeRule(item.pop("path", "*"), **item))
+
+    def match(self, path):
+        """(rule, random generator) for a request path, or (None, None)."""
+        path = path.split("?", 1)[0]
+        for rule in self.rules:
+            if fnmatch.fnmatchcase(path, rule.pattern):
+                with self.lock:
+                    n = self.seen.get(path, 0)
+                    self.seen[path] = n + 1
+                    rule.requests += 1
+                return rule, random.Random(f"{self.seed}:{path}:{n}")
+        return None, None
+
+    def count(self, rule, sent, reset):
+        with self.lock:
+            rule.bytes += sent
+            rule.resets += reset
+
+    def stats(self):
+        with self.lock:
+            return {"seed": self.seed,
+                    "rules": [dict(path=r.pattern, **r.options, requests=r.requests,
+                                   resets=r.resets, bytes=r.bytes) for r in self.rules]}
+
+shaper = LinkShaper()
+
+class ShapedWriter:
+    """Stands in for a handler's wfile: paces, fragments and maybe cuts
+    the response."""
+
+    def __init__(self, handler, rule, cut):
+        self.handler = handler
+        self.raw = handler.wfile
+        self.rule = rule
+        self.cut = cut          # byte offset to reset the connection at, or None
+        self.sent = 0
+        self.aborted = False    # set once the connection was actually reset
+        self.start = None
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        if self.start is None:
+            self.start = time.monotonic()
+        step = self.rule.chunk or len(data) or 1
+        for i in range(0, len(data), step):
+            piece = data[i:i + step]
+            if self.cut is not None and self.sent + len(piece) > self.cut:
+                self.raw.write(piece[:self.cut - self.sent])
+                self.sent = self.cut
+                self.abort()
+            self.raw.write(piece)
+            self.sent += len(piece)
+            if self.rule.rate:
+                ahead = self.sent / self.rule.rate - (time.monotonic() - self.start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def abort(self):
+        sock = self.handler.connection
+        # Zero linger turns close() into an RST instead of a FIN
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        sock.close()
+        self.aborted = True
+        raise ConnectionAbortedError(f"reset after {self.sent} bytes")
+
 
 class TrustOSTestHandler(http.server.SimpleHTTPRequestHandler):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=DIRECTORY, **kwargs)
 
+    def wants_shape_stats(self):
+        """/__shape, with or without a query string: the counters, unshaped."""
+        return self.path.split("?", 1)[0] == "/__shape"
+
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        if self.wants_shape_stats():
+            return True
+        rule, rng = shaper.match(self.path)
+        if rule is None:
+            return True
+        cut = None
+        if rule.reset and rng.random() < rule.reset:
+            # Anywhere in the response: headers, or a file body of known size
+            path = self.translate_path(self.path)
+            size = os.path.getsize(path) if self.command != "POST" and os.path.isfile(path) else 1024
+            cut = int(rng.random() * (size + 256))
+        if rule.chunk:
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        time.sleep(rule.latency + rng.random() * rule.jitter)
+        self.shape_rule = rule
+        self.wfile = ShapedWriter(self, rule, cut)
+        return True
+
+    def handle(self):
+        self.shape_rule = None
+        try:
+            super().handle()
+        except ConnectionAbortedError as e:
+            print(f"\033[35m[RESET] {self.path} {e}\033[0m")
+        except ConnectionError:
+            pass
+        finally:
+            if self.shape_rule is not None:
+                shaper.count(self.shape_rule, self.wfile.sent, self.wfile.aborted)
+
     def do_GET(self):
+        if self.wants_shape_stats():
+            body = json.dumps(shaper.stats(), indent=1).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
         # Serve files with Set-Cookie header to test cookie handling
         super().do_GET()
 
@@ -86,6 +286,21 @@ class TrustOSTestHandler(http.server.SimpleHTTPRequestHandler):
 
 
 if __name__ == "__main__":
+    shape_file = None
+    for i, arg in enumerate(sys.argv[1:], 1):
+        if arg == "--port" and i < len(sys.argv) - 1:
+            PORT = int(sys.argv[i + 1])
+        elif arg == "--dir" and i < len(sys.argv) - 1:
+            DIRECTORY = os.path.abspath(sys.argv[i + 1])
+        elif arg == "--shape" and i < len(sys.argv) - 1:
+            shaper.rules.append(ShapeRule.parse(sys.argv[i + 1]))
+        elif arg == "--shape-file" and i < len(sys.argv) - 1:
+            shape_file = sys.argv[i + 1]
+        elif arg == "--seed" and i < len(sys.argv) - 1:
+            shaper.seed = int(sys.argv[i + 1])
+    if shape_file:
+        shaper.load(shape_file)
+
     os.chdir(DIRECTORY)
     print(f"=" * 60)
     print(f"TrustOS Browser Test Server")
@@ -101,9 +316,17 @@ if __name__ == "__main__":
     print(f"")
     print(f"Or in desktop browser, navigate to:")
     print(f"  http://10.0.2.2:{PORT}/")
+    if shaper.rules:
+        print(f"")
+        print(f"Link shaping (seed {shaper.seed}, first match wins):")
+        for rule in shaper.rules:
+            print(f"  {rule.describe()}")
     print(f"=" * 60)
 
-    with http.server.HTTPServer(("0.0.0.0", PORT), TrustOSTestHandler) as httpd:
+    # Shaped responses take seconds; serve them side by side so a capped
+    # connection does not hold up every other one
+    server_class = http.server.ThreadingHTTPServer if shaper.rules else http.server.HTTPServer
+    with server_class(("0.0.0.0", PORT), TrustOSTestHandler) as httpd:
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
@@ -0,0 +1,927 @@
+#!/usr/bin/env python3
+"""
+TrustOS Web Proxy Benchmarks
+============================
+Checks and benchmarks for server/web_proxy.py against local stand-in sites:
+HTTPS servers on 127.0.0.1 with a throwaway self-signed certificate (made
+with the openssl CLI), so nothing leaves the machine.
+
+Usage:
+    python proxy-bench.py pool [--images 24] [--browser-conns 6] [--rounds 5]
+    python proxy-bench.py stream [--chunks 10] [--interval-ms 200]
+    python proxy-bench.py cache [--assets 20] [--latency-ms 80]
+    python proxy-bench.py transform [--interval-ms 100]
+    python proxy-bench.py prefetch [--assets 24] [--latency-ms 80]
+
+Each run spawns web_proxy.py on a free port (with a throwaway --cache-dir)
+and stops it afterwards.
+"""
+
+import argparse
+import email.utils
+import html.parser
+import http.client
+import http.server
+import json
+import os
+import shlex
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None   # JPEG checks of `transform` are skipped
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+WEB_PROXY = os.path.join(SCRIPT_DIR, "web_proxy.py")
+
+# Spawning, ports and checks are shared with the benchmarks in tools/
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "..", "tools"))
+from benchutil import Checks, Spawned, free_port
+
+# ─── Stand-in Sites ──────────────────────────────────────────────────────────
+
+def make_cert(directory):
+    """Self-signed certificate for 127.0.0.1; returns (certfile, keyfile)."""
+    openssl = shutil.which("openssl")
+    if not openssl:
+        sys.exit("openssl not found on PATH (needed for the HTTPS stand-in)")
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run([openssl, "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=127.0.0.1", "-keyout", key, "-out", cert],
+                   check=True, capture_output=True)
+    return cert, key
+
+class StandIn:
+    """A local site. Routes:
+        /page?n=N       HTML page referencing N images
+        /img/<i>        a small PNG-sized body
+        /slow/<ms>      answers after <ms> milliseconds
+        /redirect       302 to /page?n=1
+        /moved          302 to /docs/page, a cacheable page whose image
+                        link is relative (img.png)
+        /drip?chunks=N&ms=M&size=S&length=0|1
+                        N chunks of S bytes, M ms apart; chunked unless length=1
+        /article?ms=M   a heavy page (inline scripts, styles, web fonts,
+                        comments) sent chunked in parts M ms apart
+        /latin1         an ISO-8859-1 page
+        /site?n=N&size=S&ms=M
+                        a page with N images (relative, root-relative and
+                        absolute links), a stylesheet, an icon, a script, a
+                        no-store image, a data: URI and a duplicate, all
+                        served from /res with M ms latency
+        /photo.png?w=W&h=H, /photo.jpg?w=W&h=H
+                        a W x H photo-like image (JPEG needs Pillow)
+        /res/<name>?cc=..&etag=..&lm=1&expires=S&size=N&ms=M&type=T
+                        a cacheable resource: Cache-Control cc, ETag etag, a
+                        Last-Modified an hour ago, Expires S seconds from now
+                        (may be negative); answers conditional requests with
+                        304 (carrying only Date and ETag with bare304=1);
+                        Content-Type T (default octet-stream).
+                        bump(name) changes its ETag and body.
+    Counts TLS connections, requests, 304s sent, and the most requests
+    handled at once."""
+
+    def __init__(self, cert=None, key=None):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.active = 0
+        self.peak = 0
+        self.not_modified = 0
+        self.versions = {}              # /res name -> times bumped
+        self.modified = email.utils.formatdate(time.time() - 3600, usegmt=True)
+        site = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                if isinstance(self.request, ssl.SSLSocket):
+                    self.request.do_handshake()
+                with site.lock:
+                    site.connections += 1
+                super().setup()
+
+            def log_message(self, *args):
+                pass
+
+            def handle(self):
+                try:
+                    super().handle()
+                except ConnectionError:
+                    pass   # the proxy dropped a connection it did not read to the end
+
+            def send(self, status, body, content_type="text/html", headers=()):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", len(body))
+                for k, v in headers:
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def drip(self, chunks, size, delay, length):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                if length:
+                    self.send_header("Content-Length", chunks * size)
+                else:
+                    self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    for i in range(chunks):
+                        if i:
+                            time.sleep(delay)
+                        data = bytes([65 + i % 26]) * size
+                        self.wfile.write(data if length else b"%x\r\n%s\r\n" % (size, data))
+                        self.wfile.flush()
+                    if not length:
+                        self.wfile.write(b"0\r\n\r\n")
+                except ConnectionError:
+                    # The proxy hung up (e.g. past its --max-body)
+                    self.close_connection = True
+
+            def resource(self, name, q):
+                time.sleep(int(q.get("ms", 0)) / 1000.0)
+                version = site.versions.get(name, 0)
+                headers = [("Date", email.utils.formatdate(usegmt=True))]
+                if "cc" in q:
+                    headers.append(("Cache-Control", q["cc"]))
+                if "expires" in q:
+                    expires = time.time() + int(q["expires"])
+                    headers.append(("Expires", email.utils.formatdate(expires, usegmt=True)))
+                etag = f'"{q["etag"]}-{version}"' if "etag" in q else None
+                if etag:
+                    headers.append(("ETag", etag))
+                if "lm" in q:
+                    headers.append(("Last-Modified", site.modified))
+                inm, ims = self.headers.get("If-None-Match"), self.headers.get("If-Modified-Since")
+                if (etag and inm == etag) or (not inm and "lm" in q and ims == site.modified):
+                    with site.lock:
+                        site.not_modified += 1
+                    self.send_response(304)
+                    if q.get("bare304") == "1":
+                        headers = [(k, v) for k, v in headers if k in ("Date", "ETag")]
+                    for k, v in headers:
+                        self.send_header(k, v)
+                    self.end_headers()
+                    return
+                body = f"{name} v{version} ".encode().ljust(int(q.get("size", 1000)), b".")
+                self.send(200, body, q.get("type", "application/octet-stream"), headers)
+
+            def do_GET(self):
+                with site.lock:
+                    site.requests += 1
+                    site.active += 1
+                    site.peak = max(site.peak, site.active)
+                try:
+                    site.route(self)
+                finally:
+                    with site.lock:
+                        site.active -= 1
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.scheme = "http"
+        if cert:
+            ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ctx.load_cert_chain(cert, key)
+            # Handshake in the handler thread, not in the accept loop
+            self.httpd.socket = ctx.wrap_socket(self.httpd.socket, server_side=True,
+                                                do_handshake_on_connect=False)
+            self.scheme = "https"
+        self.url = f"{self.scheme}://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def route(self, h):
+        path, _, query = h.path.partition("?")
+        if path == "/page":
+            n = int(query.partition("=")[2] or 0)
+            imgs = "".join(f'<img src="/img/{i}">' for i in range(n))
+            h.send(200, f"<html><body><h1>Stand-in</h1>{imgs}</body></html>".encode())
+        elif path.startswith("/img/"):
+            h.send(200, b"\x89PNG" + bytes(2048), "image/png")
+        elif path.startswith("/slow/"):
+            time.sleep(int(path[6:]) / 1000.0)
+            h.send(200, b"slow done", "text/plain")
+        elif path == "/redirect":
+            h.send(302, b"", headers=[("Location", "/page?n=1")])
+        elif path == "/moved":
+            h.send(302, b"", headers=[("Location", "/docs/page")])
+        elif path == "/docs/page":
+            h.send(200, b'<html><body><img src="img.png"></body></html>',
+                   headers=[("Cache-Control", "max-age=300")])
+        elif path == "/drip":
+            q = dict(kv.partition("=")[::2] for kv in query.split("&") if kv)
+            h.drip(int(q.get("chunks", 10)), int(q.get("size", 1024)),
+                   int(q.get("ms", 100)) / 1000.0, q.get("length") == "1")
+        elif path == "/article":
+            q = dict(kv.partition("=")[::2] for kv in query.split("&") if kv)
+            parts = article_parts()
+            h.send_response(200)
+            h.send_header("Content-Type", "text/html; charset=utf-8")
+            h.send_header("Transfer-Encoding", "chunked")
+            h.end_headers()
+            for i, part in enumerate(parts):
+                if i:
+                    time.sleep(int(q.get("ms", 0)) / 1000.0)
+                h.wfile.write(b"%x\r\n%s\r\n" % (len(part), part))
+                h.wfile.flush()
+            h.wfile.write(b"0\r\n\r\n")
+        elif path == "/site":
+            q = dict(kv.partition("=")[::2] for kv in query.split("&") if kv)
+            n, size, ms = int(q.get("n", 24)), int(q.get("size", 20000)), int(q.get("ms", 0))
+            time.sleep(ms / 1000.0)
+            h.send(200, site_page(self.url, n, size, ms).encode())
+        elif path == "/latin1":
+            h.send(200, LATIN1_PAGE, "text/html; charset=iso-8859-1")
+        elif path in ("/photo.png", "/photo.jpg"):
+            q = dict(kv.partition("=")[::2] for kv in query.split("&") if kv)
+            w, hgt = int(q.get("w", 1600)), int(q.get("h", 1000))
+            if path.endswith(".png"):
+                h.send(200, photo_png(w, hgt), "image/png")
+            else:
+                h.send(200, photo_jpeg(w, hgt), "image/jpeg")
+        elif path.startswith("/res/"):
+            q = {k: urllib.parse.unquote(v) for k, _, v in
+                 (kv.partition("=") for kv in query.split("&") if kv)}
+            h.resource(path[5:], q)
+        else:
+            h.send(404, b"not here", "text/plain")
+
+    def reset(self):
+        with self.lock:
+            self.connections = self.requests = self.peak = self.not_modified = 0
+
+    def bump(self, name):
+        with self.lock:
+            self.versions[name] = self.versions.get(name, 0) + 1
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+ARTICLE_TEXT = ("<p>TrustOS is a hobby operating system with its own TCP stack, HTML "
+                "renderer and package manager &mdash; &amp; this paragraph is what a "
+                "reader came for. &#169; 2026</p>\n")
+LATIN1_PAGE = "<html><body><p>Caf\xe9 cr\xe8me</p><script>x()</script></body></html>".encode("latin-1")
+
+def article_parts():
+    """A news-site-like page in parts: head with fonts, styles and
+    scripts, then article text interleaved with more scripts."""
+    script = "<script>" + "window.track && track({event: 'view', id: 1234567});" * 400 + "</script>\n"
+    head = ("<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>Article</title>\n"
+            '<link rel="preconnect" href="https://fonts.gstatic.com">\n'
+            '<link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;700" rel="stylesheet">\n'
+            '<link rel="preload" href="/fonts/inter.woff2" as="font" type="font/woff2" crossorigin>\n'
+            '<link rel="stylesheet" href="/main.css">\n'
+            "<style>" + ".card{margin:0 auto;padding:4px 8px;border:1px solid #ddd}" * 300 + "</style>\n"
+            + script * 3 + "<!-- build 2026-10-18 " + "x" * 2000 + " -->\n</head><body>\n")
+    body = [f"<h2>Section {i}</h2>\n" + ARTICLE_TEXT * 8 + script for i in range(8)]
+    return [head.encode()] + [b.encode() for b in body] + [b'<img src="/photo.png"></body></html>\n']
+
+def site_page(base, n, size, ms):
+    res = f"size={size}&ms={ms}"
+    imgs = []
+    for i in range(n):
+        asset = f"res/img{i}?{res}&cc=max-age=3600"
+        if i % 4 == 2:
+            imgs.append(f'<img src="/{asset}">')                 # root-relative
+        elif i % 4 == 3:
+            imgs.append(f'<img src="{base}/{asset}" alt="a">')   # absolute
+        else:
+            imgs.append(f'<img src="{asset}">')
+    return ("<!DOCTYPE html><html><head><title>Site</title>\n"
+            f'<link rel="stylesheet" href="res/main.css?size=3000&ms={ms}&type=text/css">\n'
+            f'<link rel="icon" href="res/favicon?size=600&ms={ms}&type=image/png">\n'
+            f'<script src="res/app.js?size=5000&ms={ms}&type=text/javascript"></script>\n'
+            "</head><body><h1>Multi-asset site</h1>\n" + "\n".join(imgs) + "\n"
+            f'<img src="res/private?{res}&cc=no-store">\n'
+            '<img src="data:image/png;base64,iVBORw0KGgo=">\n'
+            f'<img src="res/img0?{res}&cc=max-age=3600">\n'
+            "</body></html>\n")
+
+_photos = {}
+
+def photo_png(w, h):
+    """Gradient plus texture, stored as an RGB PNG (stdlib only)."""
+    if ("png", w, h) not in _photos:
+        rows = []
+        for y in range(h):
+            g = y * 255 // max(h - 1, 1)
+            rows.append(b"\x00" + bytes(v for x in range(w)
+                                       for v in (x * 255 // w, g, (x * 7 + y * 13 + (x * y) % 97) & 255)))
+        raw = b"".join(rows)
+
+        def chunk(kind, data):
+            return (len(data).to_bytes(4, "big") + kind + data
+                    + zlib.crc32(kind + data).to_bytes(4, "big"))
+        ihdr = w.to_bytes(4, "big") + h.to_bytes(4, "big") + bytes([8, 2, 0, 0, 0])
+        _photos[("png", w, h)] = (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr)
+                                  + chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b""))
+    return _photos[("png", w, h)]
+
+def photo_jpeg(w, h):
+    if ("jpg", w, h) not in _photos:
+        import io
+        out = io.BytesIO()
+        Image.open(io.BytesIO(photo_png(w, h))).save(out, "JPEG", quality=85)
+        _photos[("jpg", w, h)] = out.getvalue()
+    return _photos[("jpg", w, h)]
+
+def png_header(data):
+    """(width, height, bit depth, colour type) of a PNG, or None."""
+    if data[:8] != b"\x89PNG\r\n\x1a\n":
+        return None
+    return (int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big"), data[24], data[25])
+
+class SpawnedProxy(Spawned):
+    """Run web_proxy.py as a subprocess on a free localhost port, with a
+    throwaway --cache-dir unless `args` names one."""
+
+    def __init__(self, args=""):
+        port = free_port()
+        super().__init__([WEB_PROXY, "--host", "127.0.0.1", "--port", str(port)] + shlex.split(args),
+                         port, path=None, timeout=10.0, cache_dir=True)
+
+def proxy_get(proxy, url, conn=None, headers=None, response=False):
+    """GET `url` through the proxy; returns (status, body, seconds), or
+    (response, body, seconds) with response=True."""
+    own = conn is None
+    conn = conn or http.client.HTTPConnection(proxy.host, proxy.port, timeout=30)
+    t0 = time.perf_counter()
+    try:
+        conn.request("GET", "/" + url, headers=headers or {})
+        resp = conn.getresponse()
+        body = resp.read()
+        return resp if response else resp.status, body, time.perf_counter() - t0
+    finally:
+        if own:
+            conn.close()
+
+def fetch_all(proxy, urls, browser_conns):
+    """GET every URL over `browser_conns` parallel keep-alive connections."""
+    queue = list(urls)
+    lock = threading.Lock()
+
+    def worker():
+        conn = http.client.HTTPConnection(proxy.host, proxy.port, timeout=30)
+        while True:
+            with lock:
+                if not queue:
+                    break
+                url = queue.pop()
+            status, _, _ = proxy_get(proxy, url, conn)
+            if status != 200:
+                raise RuntimeError(f"{url}: {status}")
+        conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(browser_conns)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def load_page(proxy, site, images, browser_conns):
+    """Fetch a page, then its images over `browser_conns` parallel
+    keep-alive connections, like the browser does. Returns seconds."""
+    t0 = time.perf_counter()
+    status, _, _ = proxy_get(proxy, f"{site.url}/page?n={images}")
+    if status != 200:
+        raise RuntimeError(f"page: {status}")
+    fetch_all(proxy, [f"{site.url}/img/{i}" for i in range(images)], browser_conns)
+    return time.perf_counter() - t0
+
+# ─── Connection Pool ─────────────────────────────────────────────────────────
+# Page loads through the proxy with upstream keep-alive pooling versus a new
+# TLS connection per request (--idle-timeout 0 disables reuse), then checks
+# of the per-site cap, slow-site isolation, redirects and upstream errors.
+
+def cmd_pool(args):
+    check = Checks()
+    with tempfile.TemporaryDirectory() as tmp:
+        cert, key = make_cert(tmp)
+        with StandIn(cert, key) as site, StandIn(cert, key) as other:
+            print(f"Page + {args.images} images over {args.browser_conns} browser connections, "
+                  f"HTTPS stand-in, {args.rounds} loads")
+            print(f"  {'upstream':<24} {'ms/page':>8} {'TLS handshakes':>15} {'requests':>9}")
+            for label, flags in (("new connection each", "--idle-timeout 0"), ("keep-alive pool", "")):
+                with SpawnedProxy(flags) as proxy:
+                    site.reset()
+                    times = [load_page(proxy, site, args.images, args.browser_conns)
+                             for _ in range(args.rounds)]
+                    print(f"  {label:<24} {sum(times) / len(times) * 1000:>8.1f}"
+                          f" {site.connections:>15} {site.requests:>9}")
+
+            print("Checks")
+            with SpawnedProxy("--per-host 4") as proxy:
+                site.reset()
+                results = []
+                threads = [threading.Thread(target=lambda: results.append(
+                    proxy_get(proxy, f"{site.url}/slow/300"))) for _ in range(12)]
+                for t in threads:
+                    t.start()
+                time.sleep(0.05)
+                status, _, secs = proxy_get(proxy, f"{other.url}/page?n=0")
+                for t in threads:
+                    t.join()
+                check(f"--per-host 4: 12 concurrent slow requests, at most {site.peak} at once upstream",
+                      site.peak == 4 and all(r[0] == 200 for r in results))
+                check(f"another site is not held up by the slow one ({secs * 1000:.0f} ms)",
+                      status == 200 and secs < 0.2)
+
+                status, body, _ = proxy_get(proxy, f"{site.url}/redirect")
+                check("redirects are followed", status == 200 and b"Stand-in" in body)
+                status, body, _ = proxy_get(proxy, f"{site.url}/missing")
+                check(f"upstream errors pass through ({status})", status == 404 and body == b"not here")
+                status, _, _ = proxy_get(proxy, f"https://127.0.0.1:{free_port()}/")
+                check(f"unreachable site -> {status}", status == 502)
+            with SpawnedProxy("--max-upstream 2") as proxy:
+                t0 = time.perf_counter()
+                threads = [threading.Thread(target=proxy_get, args=(proxy, f"{s.url}/slow/300"))
+                           for s in (site, other) for _ in range(3)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                secs = time.perf_counter() - t0
+                check(f"--max-upstream 2: 6 slow requests on two sites queue for slots ({secs:.2f}s)",
+                      0.9 <= secs < 1.5)
+    check.exit()
+
+# ─── Streaming ───────────────────────────────────────────────────────────────
+# A slow upstream that sends its body in chunks some time apart. A proxy that
+# buffers the whole body cannot send the first byte before the last one has
+# arrived, so its time-to-first-byte equals the total time; streaming gets
+# the first chunk to the browser as soon as the upstream sends it.
+
+def timed_get(proxy, url):
+    """GET through the proxy; returns (response, body, ttfb, total seconds)."""
+    conn = http.client.HTTPConnection(proxy.host, proxy.port, timeout=30)
+    t0 = time.perf_counter()
+    try:
+        conn.request("GET", "/" + url)
+        resp = conn.getresponse()
+        first = resp.read1(65536) if resp.status == 200 else b""
+        ttfb = time.perf_counter() - t0
+        body = first + resp.read()
+        return resp, body, ttfb, time.perf_counter() - t0
+    finally:
+        conn.close()
+
+def raw_http10(proxy, url):
+    """HTTP/1.0 GET through the proxy; returns the raw response bytes."""
+    with socket.create_connection((proxy.host, proxy.port), timeout=30) as s:
+        s.sendall(f"GET /{url} HTTP/1.0\r\n\r\n".encode())
+        chunks = []
+        while True:
+            data = s.recv(65536)
+            if not data:
+                return b"".join(chunks)
+            chunks.append(data)
+
+def cmd_stream(args):
+    check = Checks()
+    with StandIn() as site, SpawnedProxy("--max-body 1") as proxy:
+        drip = f"{site.url}/drip?chunks={args.chunks}&ms={args.interval_ms}&size=4096"
+        upstream_secs = (args.chunks - 1) * args.interval_ms / 1000.0
+        print(f"Slow upstream: {args.chunks} x 4 KB chunks, {args.interval_ms} ms apart "
+              f"(~{upstream_secs * 1000:.0f} ms to send)")
+        print(f"  {'upstream framing':<20} {'TTFB ms':>8} {'total ms':>9} {'framing to browser':>20}")
+        results = {}
+        for label, length in (("Content-Length", 1), ("chunked", 0)):
+            resp, body, ttfb, total = timed_get(proxy, f"{drip}&length={length}")
+            framing = ("chunked" if resp.getheader("Transfer-Encoding") == "chunked"
+                       else f"Content-Length {resp.getheader('Content-Length')}")
+            results[label] = (resp, body, ttfb, total)
+            print(f"  {label:<20} {ttfb * 1000:>8.1f} {total * 1000:>9.1f} {framing:>20}")
+
+        print("Checks")
+        expected = b"".join(bytes([65 + i % 26]) * 4096 for i in range(args.chunks))
+        for label, (resp, body, ttfb, total) in results.items():
+            check(f"{label}: body intact ({len(body)} bytes)", resp.status == 200 and body == expected)
+            check(f"{label}: first byte after {ttfb * 1000:.0f} ms, before the upstream finished "
+                  f"({total * 1000:.0f} ms; buffering would make them equal)",
+                  ttfb < total / 3)
+        check("upstream Content-Length is forwarded",
+              results["Content-Length"][0].getheader("Content-Length") == str(len(expected)))
+        check("no upstream length -> Transfer-Encoding: chunked",
+              results["chunked"][0].getheader("Transfer-Encoding") == "chunked")
+        raw = raw_http10(proxy, f"{drip}&length=0&ms=10")
+        head, _, body = raw.partition(b"\r\n\r\n")
+        check("HTTP/1.0 client gets a close-delimited body",
+              b"chunked" not in head.lower() and body == expected)
+
+        big = f"{site.url}/drip?chunks=40&ms=0&size=65536"
+        resp, body, _, _ = timed_get(proxy, f"{big}&length=1")
+        check(f"--max-body 1: 2.5 MB declared by Content-Length -> {resp.status}", resp.status == 502)
+        try:
+            resp, body, _, _ = timed_get(proxy, f"{big}&length=0")
+            cut = False
+        except http.client.IncompleteRead as e:
+            body, cut = e.partial, True
+        check(f"--max-body 1: undeclared 2.5 MB stream is cut off ({len(body)} bytes delivered)",
+              cut and len(body) <= 1 << 20)
+        status, body, _ = proxy_get(proxy, f"{site.url}/page?n=0")
+        check("proxy still serves after an aborted stream", status == 200 and b"Stand-in" in body)
+    check.exit()
+
+# ─── Response Cache ──────────────────────────────────────────────────────────
+# Repeat visits to a page of cacheable assets on a stand-in site with added
+# latency (standing in for the internet), with the cache off, cold, warm,
+# after a proxy restart (disk tier) and with every asset needing
+# revalidation; then checks of the freshness rules, LRU bounds and /__cache.
+
+def cache_status(proxy, url, headers=None):
+    resp, body, _ = proxy_get(proxy, url, headers=headers, response=True)
+    return resp.getheader("X-Cache"), body
+
+def cache_stats(proxy):
+    status, body, _ = proxy_get(proxy, "__cache.json")
+    return json.loads(body) if status == 200 else {}
+
+def cmd_cache(args):
+    check = Checks()
+    tmp = tempfile.mkdtemp(prefix="proxy-cache-")
+    try:
+        with StandIn() as site:
+            def visit(proxy, cc):
+                urls = [f"{site.url}/res/asset{i}?cc={cc}&etag=a&size=20000&ms={args.latency_ms}"
+                        for i in range(args.assets)]
+                t0 = time.perf_counter()
+                proxy_get(proxy, f"{site.url}/res/page?cc={cc}&etag=p&size=8000&ms={args.latency_ms}")
+                fetch_all(proxy, urls, args.browser_conns)
+                return time.perf_counter() - t0
+
+            print(f"Page + {args.assets} x 20 KB assets, {args.latency_ms} ms upstream latency, "
+                  f"{args.browser_conns} browser connections")
+            print(f"  {'visit':<34} {'ms/page':>8} {'upstream reqs':>14} {'304s':>5}")
+            runs = [("--no-cache", "max-age=300", ["no cache: visit 1", "no cache: visit 2"]),
+                    (f"--cache-dir {tmp}", "max-age=300", ["cache: cold", "cache: repeat visit"]),
+                    (f"--cache-dir {tmp} --cache-mb 0.001", "max-age=300",
+                     ["cache: after restart (from disk)", "cache: repeat visit"]),
+                    ("", "no-cache", ["no-cache assets: cold", "no-cache assets: revalidated"])]
+            timings = {}
+            for flags, cc, labels in runs:
+                with SpawnedProxy(flags) as proxy:
+                    for label in labels:
+                        site.reset()
+                        secs = visit(proxy, cc)
+                        timings[label] = secs
+                        print(f"  {label:<34} {secs * 1000:>8.1f} {site.requests:>14} {site.not_modified:>5}")
+
+            print("Checks")
+            check(f"repeat visit served locally ({timings['cache: repeat visit'] * 1000:.0f} ms vs "
+                  f"{timings['no cache: visit 2'] * 1000:.0f} ms uncached)",
+                  timings["cache: repeat visit"] < timings["no cache: visit 2"] / 5)
+            with SpawnedProxy(f"--cache-dir {tmp}") as proxy:
+                site.reset()
+                outcome, _ = cache_status(proxy, f"{site.url}/res/page?cc=max-age=300&etag=p&size=8000&ms={args.latency_ms}")
+                check(f"restarted proxy answers from the disk tier ({outcome}, {site.requests} upstream)",
+                      outcome == "HIT" and site.requests == 0)
+
+            with SpawnedProxy() as proxy:
+                def twice(query, name, pause=0.0, headers=None):
+                    site.reset()
+                    url = f"{site.url}/res/{name}?{query}"
+                    first, _ = cache_status(proxy, url)
+                    time.sleep(pause)
+                    second, body = cache_status(proxy, url, headers)
+                    return first, second, site.requests, site.not_modified, body
+
+                r = twice("cc=max-age=60", "fresh")
+                check(f"max-age=60: {r[0]} then {r[1]}, {r[2]} upstream request", r[:3] == ("MISS", "HIT", 1))
+                r = twice("cc=no-store&etag=x", "nostore")
+                check(f"no-store: {r[0]} then {r[1]}, {r[2]} upstream requests", r[:3] == ("MISS", "MISS", 2))
+                r = twice("cc=private,max-age=60", "private")
+                check(f"private: {r[0]} then {r[1]}", r[:2] == ("MISS", "MISS"))
+                r = twice("cc=no-cache&etag=x", "nocache")
+                check(f"no-cache + ETag: {r[0]} then {r[1]} ({r[3]} upstream 304)",
+                      r[:2] == ("MISS", "REVALIDATED") and r[3] == 1)
+                r = twice("cc=max-age=1&etag=x", "short", pause=1.2)
+                check(f"max-age=1, 1.2 s later: {r[1]}", r[1] == "REVALIDATED")
+                r = twice("cc=max-age=2&etag=x&bare304=1", "bare", pause=2.2)
+                third, _ = cache_status(proxy, f"{site.url}/res/bare?cc=max-age=2&etag=x&bare304=1")
+                check(f"304 without Cache-Control keeps the stored max-age: {r[1]} then {third}",
+                      r[1] == "REVALIDATED" and third == "HIT")
+                r = twice("expires=60", "expires")
+                check(f"Expires in a minute: {r[0]} then {r[1]}", r[:2] == ("MISS", "HIT"))
+                r = twice("expires=-60&lm=1", "expired")
+                check(f"Expires in the past + Last-Modified: {r[1]} via If-Modified-Since ({r[3]} 304)",
+                      r[1] == "REVALIDATED" and r[3] == 1)
+                r = twice("lm=1", "heuristic")
+                check(f"Last-Modified an hour ago only (heuristic freshness): {r[1]}", r[1] == "HIT")
+                r = twice("cc=max-age=60&etag=x", "forced", headers={"Cache-Control": "no-cache"})
+                check(f"browser Cache-Control: no-cache forces revalidation: {r[1]}", r[1] == "REVALIDATED")
+                r = twice("etag=x", "noinfo")
+                check(f"no freshness info, ETag only: {r[1]} (stored, revalidated each use)",
+                      r[1] == "REVALIDATED")
+                r = twice("", "uncacheable")
+                check(f"no freshness info, no validators: {r[1]} (not stored)", r[1] == "MISS")
+
+                url = f"{site.url}/res/changing?cc=no-cache&etag=x"
+                cache_status(proxy, url)
+                site.bump("changing")
+                outcome, body = cache_status(proxy, url)
+                again, _ = cache_status(proxy, url)
+                check(f"changed upstream ETag: {outcome} with the new body, then {again}",
+                      outcome == "MISS" and body.startswith(b"changing v1") and again == "REVALIDATED")
+
+                status, page, _ = proxy_get(proxy, "__cache")
+                check("/__cache lists entries with per-entry hits",
+                      status == 200 and b"/res/fresh?" in page and b"<th>hits</th>" in page)
+                stats = cache_stats(proxy)
+                fresh = [e for e in stats.get("entries_detail", []) if "/res/fresh?" in e["url"]]
+                check(f"/__cache.json: {stats.get('hits')} hits, {stats.get('revalidated')} revalidated, "
+                      f"{stats.get('misses')} misses; fresh entry hit {fresh[0]['hits'] if fresh else '?'} time(s)",
+                      fresh and fresh[0]["hits"] == 1 and stats["hits"] >= 3)
+
+            with SpawnedProxy("--cache-mb 1 --disk-cache-mb 2") as proxy:
+                urls = [f"{site.url}/res/big{i}?cc=max-age=300&size=200000" for i in range(15)]
+                for url in urls:
+                    cache_status(proxy, url)
+                stats = cache_stats(proxy)
+                check(f"--cache-mb 1: {stats['memory_bytes'] >> 10} KB of bodies in memory",
+                      0 < stats["memory_bytes"] <= 1 << 20)
+                check(f"--disk-cache-mb 2: {stats['disk_bytes'] >> 10} KB on disk, "
+                      f"{stats['evictions']} evicted", 0 < stats["disk_bytes"] <= 2 << 20 and stats["evictions"] > 0)
+                newest, _ = cache_status(proxy, urls[-1])
+                on_disk, _ = cache_status(proxy, urls[-8])
+                oldest, _ = cache_status(proxy, urls[0])
+                check(f"LRU: newest {newest}, older (disk only) {on_disk}, oldest evicted {oldest}",
+                      (newest, on_disk, oldest) == ("HIT", "HIT", "MISS"))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    check.exit()
+
+# ─── Transforms ──────────────────────────────────────────────────────────────
+# Bytes sent to the browser for a script-heavy article, a large PNG and a
+# JPEG with and without --transform, the article's time to first byte when
+# it trickles in from the upstream (the rewriter streams, so TTFB should not
+# move), and checks that the rewrite keeps everything it should.
+
+def cmd_transform(args):
+    check = Checks()
+    photo_png(1600, 1000)   # generate it before anything is timed
+    with StandIn() as site:
+        article = f"{site.url}/article?ms={args.interval_ms}"
+        items = [("article (HTML)", article), ("photo.png 1600x1000", f"{site.url}/photo.png")]
+        if Image is not None:
+            items.append(("photo.jpg 1600x1000", f"{site.url}/photo.jpg"))
+        results = {}
+        for label, flags in (("as is", "--no-cache"), ("--transform", "--no-cache --transform")):
+            with SpawnedProxy(flags) as proxy:
+                for name, url in items:
+                    resp, body, ttfb, total = timed_get(proxy, url)
+                    results[(label, name)] = (resp, body, ttfb, total)
+                stats = cache_stats(proxy)   # --no-cache: only to see it is off
+        print(f"  {'response':<22} {'bytes as is':>12} {'transformed':>12} {'saved':>7} "
+              f"{'TTFB ms':>14} {'total ms':>14}")
+        for name, _ in items:
+            _, raw, ttfb0, total0 = results[("as is", name)]
+            _, slim, ttfb1, total1 = results[("--transform", name)]
+            saved = (len(raw) - len(slim)) * 100 / len(raw)
+            print(f"  {name:<22} {len(raw):>12} {len(slim):>12} {saved:>6.0f}% "
+                  f"{ttfb0 * 1000:>6.0f} -> {ttfb1 * 1000:<5.0f} {total0 * 1000:>6.0f} -> {total1 * 1000:<5.0f}")
+
+        print("Checks")
+        check("/__cache is off with --no-cache", stats == {})
+        raw = results[("as is", "article (HTML)")][1]
+        resp, slim, ttfb, total = results[("--transform", "article (HTML)")]
+        check(f"article: {len(raw)} -> {len(slim)} bytes", len(slim) < len(raw) / 5)
+        check("article: scripts, styles, font links and comments removed",
+              not any(t in slim for t in (b"<script", b"<style", b"woff2", b"fonts.googleapis", b"<!--")))
+        check("article: text, entities, stylesheet link and images kept",
+              slim.count(ARTICLE_TEXT.encode()) == 64 and b'<link rel="stylesheet" href="/main.css">' in slim
+              and b'<img src="/photo.png">' in slim and slim.startswith(b"<!DOCTYPE html>"))
+        check(f"article: streamed, first byte after {ttfb * 1000:.0f} ms of {total * 1000:.0f} ms",
+              resp.getheader("Transfer-Encoding") == "chunked" and ttfb < total / 3)
+
+        resp, png, _, _ = results[("--transform", "photo.png 1600x1000")]
+        header = png_header(png)
+        if header is None:
+            print("  SKIP  image checks: the proxy has no Pillow (pip install Pillow)")
+        else:
+            raw = results[("as is", "photo.png 1600x1000")][1]
+            check(f"photo.png: {header[0]}x{header[1]}, 8-bit, colour type {header[3]}; "
+                  f"X-Original-Length {resp.getheader('X-Original-Length')}",
+                  header == (640, 400, 8, 2) and resp.getheader("X-Original-Length") == str(len(raw))
+                  and len(png) < len(raw))
+            if Image is not None:
+                resp, out, _, _ = results[("--transform", "photo.jpg 1600x1000")]
+                check(f"photo.jpg -> {resp.getheader('Content-Type')} {png_header(out)}",
+                      resp.getheader("Content-Type") == "image/png" and png_header(out) == (640, 400, 8, 2))
+
+        with SpawnedProxy("--transform scripts") as proxy:
+            status, body, _ = proxy_get(proxy, f"{site.url}/latin1")
+            check("ISO-8859-1 page keeps its bytes", body == b"<html><body><p>Caf\xe9 cr\xe8me</p></body></html>")
+            _, body, _ = proxy_get(proxy, article)
+            check("--transform scripts leaves <style> and fonts alone",
+                  b"<script" not in body and b"<style>" in body and b"woff2" in body)
+            _, body, _ = proxy_get(proxy, f"{site.url}/res/plain?size=100")
+            check("non-HTML passes untouched", body.startswith(b"plain v0 ") and len(body) == 100)
+            _, png, _ = proxy_get(proxy, f"{site.url}/photo.png")
+            check("images are left alone unless the images stage is on", png == photo_png(1600, 1000))
+
+        with SpawnedProxy("--transform all") as proxy:
+            url = f"{site.url}/res/cached-page?cc=max-age=60&size=300&type=text/html"
+            proxy_get(proxy, url)
+            resp, body, _ = proxy_get(proxy, url, response=True)
+            stats = cache_stats(proxy)
+            check(f"cache hits are transformed too ({resp.getheader('X-Cache')}); "
+                  f"/__cache.json reports {stats['transform'].get('html', {}).get('responses')} HTML transforms",
+                  resp.getheader("X-Cache") == "HIT" and stats["transform"]["html"]["responses"] == 2)
+    check.exit()
+
+# ─── Prefetch ────────────────────────────────────────────────────────────────
+# Cold loads of a multi-asset page by a simulated kernel browser: it fetches
+# the page, collects <img>, stylesheet/icon <link> and <script> URLs like
+# collect_resources() in kernel/src/browser/mod.rs, resolves them like
+# normalize_url(), and fetches them one after another, each on a new
+# connection (Connection: close). Root-relative links that resolve to the
+# proxy without a target URL cannot be loaded; absolute ones bypass the
+# proxy. Compared without --prefetch and with it, then budget checks.
+
+class KernelLinks(html.parser.HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.urls = []
+
+    def handle_starttag(self, tag, attrs):
+        a = {k: v or "" for k, v in attrs}
+        if tag == "img" and a.get("src") and not a["src"].startswith("data:"):
+            self.urls.append(a["src"])
+        elif tag == "link" and a.get("href") and (a.get("rel") == "stylesheet" or "icon" in a.get("rel", "")):
+            self.urls.append(a["href"])
+        elif tag == "script" and a.get("src"):
+            self.urls.append(a["src"])
+
+def kernel_resolve(url, base):
+    """normalize_url() from kernel/src/browser/mod.rs."""
+    url = url.strip()
+    if url.startswith(("http://", "https://")):
+        return url
+    if url.startswith("//"):
+        return "http:" + url
+    dot, slash = url.find("."), url.find("/")
+    if dot >= 0 and (slash < 0 or dot < slash):
+        return "http://" + url
+    rest = base[len("http://"):] if base.startswith("http://") else base
+    host, _, path = rest.partition("/")
+    if url.startswith("/"):
+        return f"http://{host}{url}"
+    base_dir = "/" + path[:path.rfind("/") + 1] if "/" in path else "/"
+    return f"http://{host}{base_dir}{url}"
+
+def kernel_load(proxy, page_url):
+    """Returns (seconds, follow-ups answered from the proxy cache,
+    follow-ups, unloadable links)."""
+    t0 = time.perf_counter()
+    status, body, _ = proxy_get(proxy, page_url, headers={"Connection": "close"})
+    if status != 200:
+        raise RuntimeError(f"page: {status}")
+    links = KernelLinks()
+    links.feed(body.decode())
+    base = f"http://{proxy.host}:{proxy.port}/{page_url}"
+    prefix = f"http://{proxy.host}:{proxy.port}/"
+    cached = fetched = broken = 0
+    for url in dict.fromkeys(kernel_resolve(u, base) for u in links.urls):
+        if url.startswith(prefix):
+            target = url[len(prefix):]
+            if not target.startswith(("http://", "https://")):
+                broken += 1   # the proxy would look for a host named after the path
+                continue
+            resp, _, _ = proxy_get(proxy, target, headers={"Connection": "close"}, response=True)
+            cached += resp.getheader("X-Cache") in ("HIT", "REVALIDATED")
+        else:
+            parts = urllib.parse.urlsplit(url)
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+            conn.request("GET", url[url.index("/", len("http://")):], headers={"Connection": "close"})
+            conn.getresponse().read()
+            conn.close()
+        fetched += 1
+    return time.perf_counter() - t0, cached, fetched, broken
+
+def cmd_prefetch(args):
+    check = Checks()
+    with StandIn() as site:
+        page = f"{site.url}/site?n={args.assets}&size=20000&ms={args.latency_ms}"
+        print(f"Cold load: page + {args.assets} x 20 KB images, stylesheet, icon, script, "
+              f"{args.latency_ms} ms upstream latency, serial kernel-style follow-ups")
+        print(f"  {'proxy':<26} {'ms/page':>8} {'from cache':>11} {'unloadable':>11} "
+              f"{'upstream':>9} {'peak':>5} {'hit rate':>9}")
+        results = {}
+        for label, flags in (("cache, no prefetch", ""),
+                             ("--prefetch-workers 2", "--prefetch --prefetch-workers 2"),
+                             ("--prefetch (4 workers)", "--prefetch"),
+                             ("--prefetch-workers 8", "--prefetch --prefetch-workers 8")):
+            with SpawnedProxy(flags) as proxy:
+                site.reset()
+                secs, cached, fetched, broken = kernel_load(proxy, page)
+                stats = cache_stats(proxy).get("prefetch") or {}
+                rate = f"{stats['hit_rate'] * 100:.0f}%" if stats.get("hit_rate") is not None else "-"
+                results[label] = (secs, cached, fetched, broken, site.requests, site.peak, stats)
+                print(f"  {label:<26} {secs * 1000:>8.0f} {f'{cached}/{fetched}':>11} {broken:>11} "
+                      f"{site.requests:>9} {site.peak:>5} {rate:>9}")
+
+        print("Checks")
+        base = results["cache, no prefetch"]
+        secs, cached, fetched, broken, requests, peak, stats = results["--prefetch (4 workers)"]
+        check(f"--prefetch: page load {secs * 1000:.0f} ms vs {base[0] * 1000:.0f} ms without",
+              secs < base[0] / 2)
+        check(f"--prefetch: rewritten links all load ({broken} unloadable, {base[3]} without prefetch)",
+              broken == 0 and base[3] > 0)
+        check(f"--prefetch: {cached}/{fetched} follow-ups from cache (all but the no-store image)",
+              cached == fetched - 1)
+        check(f"--prefetch: {stats['fetched']} prefetched, {stats['used']} used, "
+              f"{stats['uncacheable']} uncacheable (no-store), data: URI and duplicate skipped",
+              stats["fetched"] == args.assets + 3 and stats["used"] == stats["fetched"]
+              and stats["uncacheable"] == 1)
+        for workers in (2, 4, 8):
+            label = f"--prefetch-workers {workers}" if workers != 4 else "--prefetch (4 workers)"
+            peak = results[label][5]
+            check(f"--prefetch-workers {workers}: at most {peak} upstream requests at once",
+                  peak <= workers + 1)
+
+        with SpawnedProxy("--prefetch --prefetch-budget 5") as proxy:
+            kernel_load(proxy, page)
+            stats = cache_stats(proxy)["prefetch"]
+            check(f"--prefetch-budget 5: {stats['fetched']} prefetched, {stats['over_budget']} over budget",
+                  stats["fetched"] == 5 and stats["over_budget"] == args.assets + 4 - 5)
+        with SpawnedProxy("--prefetch --prefetch-budget-mb 0.05") as proxy:
+            kernel_load(proxy, page)
+            stats = cache_stats(proxy)["prefetch"]
+            check(f"--prefetch-budget-mb 0.05: {stats['fetched_bytes']} bytes prefetched",
+                  0 < stats["fetched_bytes"] <= 0.05 * (1 << 20) and stats["over_budget"] > 0)
+        with SpawnedProxy("--prefetch") as proxy:
+            _, body, _ = proxy_get(proxy, page)
+            check("links point back at the proxy, with raw & for the kernel's parser",
+                  f'src="/{site.url}/res/img2?size=20000&ms={args.latency_ms}&cc=max-age=3600"'.encode() in body
+                  and b'src="data:image/png;base64,iVBORw0KGgo="' in body)
+            while cache_stats(proxy)["prefetch"]["in_flight"]:
+                time.sleep(0.05)
+            site.reset()
+            secs, cached, fetched, _ = kernel_load(proxy, page)
+            stats = cache_stats(proxy)["prefetch"]
+            check(f"repeat visit: {cached}/{fetched} from cache, {site.requests} upstream requests "
+                  f"(page, no-store image twice), {stats['already_cached']} links already cached",
+                  cached == fetched - 1 and site.requests == 3)
+            want = f'src="/{site.url}/docs/img.png"'.encode()
+            miss = proxy_get(proxy, f"{site.url}/moved", response=True)
+            hit = proxy_get(proxy, f"{site.url}/moved", response=True)
+            check(f"a redirected page's relative links resolve against where it ended up, "
+                  f"{miss[0].getheader('X-Cache')} and {hit[0].getheader('X-Cache')}",
+                  want in miss[1] and want in hit[1] and hit[0].getheader("X-Cache") == "HIT")
+    check.exit()
+
+# ─── CLI ─────────────────────────────────────────────────────────────────────
+
+def main():
+    parser = argparse.ArgumentParser(description="TrustOS web proxy benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("pool", help="upstream keep-alive pooling and concurrency limits")
+    p.add_argument("--images", type=int, default=24)
+    p.add_argument("--browser-conns", type=int, default=6)
+    p.add_argument("--rounds", type=int, default=5)
+    p.set_defaults(func=cmd_pool)
+
+    p = sub.add_parser("stream", help="chunked pass-through from a slow upstream, --max-body")
+    p.add_argument("--chunks", type=int, default=10)
+    p.add_argument("--interval-ms", type=int, default=200)
+    p.set_defaults(func=cmd_stream)
+
+    p = sub.add_parser("cache", help="response cache: repeat visits, freshness rules, LRU bounds")
+    p.add_argument("--assets", type=int, default=20)
+    p.add_argument("--latency-ms", type=int, default=80)
+    p.add_argument("--browser-conns", type=int, default=6)
+    p.set_defaults(func=cmd_cache)
+
+    p = sub.add_parser("transform", help="--transform: bytes saved, streaming TTFB, rewrite checks")
+    p.add_argument("--interval-ms", type=int, default=100)
+    p.set_defaults(func=cmd_transform)
+
+    p = sub.add_parser("prefetch", help="--prefetch: kernel-style page loads, hit rate, budgets")
+    p.add_argument("--assets", type=int, default=24)
+    p.add_argument("--latency-ms", type=int, default=80)
+    p.set_defaults(func=cmd_prefetch)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
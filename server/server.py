@@ -1,31 +1,298 @@
 #!/usr/bin/env python3
-"""Simple HTTP server for TrustOS package distribution."""
+"""Simple HTTP server for TrustOS package distribution.
 
+Usage:
+    python server.py [--port 8080] [--dir DIR] [--production]
+                     [--rescan S] [--no-gzip]
+
+    --production    Threaded keep-alive server: file bodies go out with
+                    sendfile(), Range / If-Range / conditional requests are
+                    answered from a cached directory scan, and precompressed
+                    .gz siblings are served to clients that accept gzip
+                    (default: SimpleHTTPRequestHandler, one client at a time)
+    --rescan S      Seconds between mtime polls of the served tree (default 2)
+    --no-gzip       Never serve .gz siblings in place of the file
+"""
+
+import email.utils
+import html
 import http.server
+import importlib.util
+import mimetypes
 import socketserver
 import os
+import sys
+import threading
+import time
+import urllib.parse
+
+def load_httputil():
+    """Import tools/httputil.py (Range / Accept-Encoding parsing shared with
+    tools/pkg-server.py) from its path, leaving sys.path alone."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools", "httputil.py")
+    spec = importlib.util.spec_from_file_location("httputil", path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+httputil = load_httputil()
+negotiate_encoding, parse_range = httputil.negotiate_encoding, httputil.parse_range
 
 PORT = 8080
 DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "packages")
+RESCAN_INTERVAL = 2.0
 
 class Handler(http.server.SimpleHTTPRequestHandler):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=DIRECTORY, **kwargs)
-    
+
+    def log_message(self, format, *args):
+        print(f"[{self.address_string()}] {format % args}")
+
+# ─── Production Mode ─────────────────────────────────────────────────────────
+# Every file under DIRECTORY is stat()ed once into a FileIndex; requests look
+# the path up there (no per-request path resolution or directory stat) and
+# then open the file, whose fstat() is what the headers are built from. A
+# background thread re-walks the tree every --rescan seconds and swaps in a
+# new table when a size or mtime changed, so new and deleted files show up
+# without a restart. Only files in the table are ever opened, which also
+# rules out path traversal.
+
+class FileEntry:
+    __slots__ = ("path", "size", "mtime", "etag", "last_modified", "content_type", "gz")
+
+    def __init__(self, path, st, content_type, gz=None, tag=""):
+        self.path = path
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        # Like nginx: size and mtime, so no file has to be read to tag it
+        self.etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}{tag}"'
+        self.last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        self.content_type = content_type
+        self.gz = gz   # FileEntry of a fresh <path>.gz sibling, or None
+
+class FileIndex:
+    """URL path -> FileEntry for every file in a directory tree."""
+
+    def __init__(self, root, gzip_siblings=True):
+        self.root = root
+        self.gzip_siblings = gzip_siblings
+        # (files, dirs), swapped in one assignment so a request that reads it
+        # once sees a single scan: files maps URL path -> FileEntry, dirs
+        # maps URL dir path ("/" or "/a/b/") -> sorted child names
+        self.table = ({}, {})
+        self.signature = None
+        self.scans = 0
+
+    def _walk(self):
+        stats = {}
+        stack = [""]
+        while stack:
+            rel = stack.pop()
+            try:
+                with os.scandir(os.path.join(self.root, rel)) as it:
+                    for e in it:
+                        sub = f"{rel}/{e.name}" if rel else e.name
+                        if e.is_dir(follow_symlinks=False):
+                            stack.append(sub)
+                        elif e.is_file():
+                            stats[sub] = e.stat()
+            except OSError:
+                continue
+        return stats
+
+    def rescan(self):
+        """Re-stat the tree; rebuild the table if anything changed."""
+        stats = self._walk()
+        signature = {p: (st.st_size, st.st_mtime_ns) for p, st in stats.items()}
+        if signature == self.signature:
+            return False
+        files, dirs = {}, {"/": set()}
+        for rel, st in stats.items():
+            path = os.path.join(self.root, rel)
+            content_type = mimetypes.guess_type(rel)[0] or "application/octet-stream"
+            gz = None
+            sibling = stats.get(rel + ".gz")
+            if self.gzip_siblings and sibling and sibling.st_mtime >= st.st_mtime:
+                # Served under this file's name and type, with its own ETag
+                gz = FileEntry(path + ".gz", sibling, content_type, tag="-gz")
+            files["/" + rel] = FileEntry(path, st, content_type, gz)
+            parts = rel.split("/")
+            for i in range(len(parts)):
+                parent = "/" + "".join(p + "/" for p in parts[:i])
+                child = parts[i] + ("/" if i < len(parts) - 1 else "")
+                dirs.setdefault(parent, set()).add(child)
+        self.table = (files, {d: sorted(names) for d, names in dirs.items()})
+        self.signature = signature
+        self.scans += 1
+        return True
+
+    def watch(self, interval):
+        def poll():
+            while True:
+                time.sleep(interval)
+                if self.rescan():
+                    print(f"[Index] {len(self.table[0])} files (tree changed)")
+        threading.Thread(target=poll, daemon=True).start()
+
+file_index = None   # FileIndex when started with --production
+
+class FastHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = 30
+    disable_nagle_algorithm = True
+
     def log_message(self, format, *args):
         print(f"[{self.address_string()}] {format % args}")
 
+    def not_modified(self, entry):
+        inm = self.headers.get("If-None-Match")
+        if inm is not None:
+            return entry.etag in inm or inm.strip() == "*"
+        ims = self.headers.get("If-Modified-Since")
+        if ims:
+            try:
+                return int(entry.mtime) <= email.utils.parsedate_to_datetime(ims).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def send_small(self, status, body, content_type="text/plain; charset=utf-8", headers=()):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", len(body))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def send_listing(self, path, names):
+        items = "".join(f'<li><a href="{urllib.parse.quote(path + n)}">{html.escape(n)}</a></li>\n'
+                        for n in names)
+        body = f"<html><body><h1>Index of {html.escape(path)}</h1>\n<ul>\n{items}</ul></body></html>\n"
+        self.send_small(200, body.encode("utf-8"), "text/html; charset=utf-8")
+
+    def do_GET(self):
+        path = urllib.parse.unquote(self.path.split("?", 1)[0])
+        files, dirs = file_index.table
+        entry = files.get(path)
+        if entry is None:
+            if path.endswith("/") and path in dirs:
+                index = files.get(path + "index.html")
+                if index is None:
+                    self.send_listing(path, dirs[path])
+                    return
+                entry = index
+            elif path + "/" in dirs:
+                self.send_small(301, b"", headers=[("Location", path + "/")])
+                return
+            else:
+                self.send_small(404, b"404 Not Found\n")
+                return
+
+        gz = False
+        if entry.gz:
+            gz = negotiate_encoding(self.headers.get("Accept-Encoding", ""), ("gzip",)) == "gzip"
+        try:
+            f = open(entry.gz.path if gz else entry.path, "rb")
+        except OSError:
+            self.send_small(404, b"404 Not Found\n")
+            return
+        with f:
+            # The index may be up to --rescan seconds old: take size, ETag
+            # and Last-Modified from the file actually opened, so a rewrite
+            # since the last scan can't produce a short or overlong body.
+            st = os.fstat(f.fileno())
+            sent = entry.gz if gz else entry
+            if st.st_size != sent.size or st.st_mtime != sent.mtime:
+                sent = FileEntry(sent.path, st, entry.content_type, tag="-gz" if gz else "")
+            self.send_file(f, sent, gz, vary=entry.gz is not None)
+
+    def send_file(self, f, entry, gz, vary):
+        headers = [("Accept-Ranges", "bytes"), ("Last-Modified", entry.last_modified)]
+        if vary:
+            headers.append(("Vary", "Accept-Encoding"))
+        if gz:
+            headers.append(("Content-Encoding", "gzip"))
+        headers.append(("ETag", entry.etag))
+        if self.not_modified(entry):
+            self.send_response(304)
+            for key, value in headers:
+                self.send_header(key, value)
+            self.end_headers()
+            return
+
+        start, end, status = 0, entry.size, 200
+        range_header = self.headers.get("Range")
+        if range_header:
+            if_range = self.headers.get("If-Range", "").strip()
+            if not if_range or if_range in (entry.etag, entry.last_modified):
+                span = parse_range(range_header, entry.size)
+                if span == "unsatisfiable":
+                    self.send_small(416, b"", headers=headers + [("Content-Range", f"bytes */{entry.size}")])
+                    return
+                if span:
+                    start, end = span
+                    status = 206
+                    headers.append(("Content-Range", f"bytes {start}-{end - 1}/{entry.size}"))
+        self.send_response(status)
+        self.send_header("Content-Type", entry.content_type)
+        self.send_header("Content-Length", end - start)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD" and end > start:
+            # Kernel-side copy from the page cache to the socket; falls
+            # back to read()/send() where sendfile() is unavailable.
+            self.connection.sendfile(f, start, end - start)
+
+    do_HEAD = do_GET
+
+class ThreadedServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+def serve_production(port, rescan, gzip_siblings):
+    global file_index
+    file_index = FileIndex(DIRECTORY, gzip_siblings)
+    t0 = time.time()
+    file_index.rescan()
+    file_index.watch(rescan)
+    print(f"Indexed: {len(file_index.table[0])} files in {(time.time() - t0) * 1000:.0f} ms "
+          f"(rescanning every {rescan:g}s)")
+    with ThreadedServer(("", port), FastHandler) as httpd:
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            print("\nServer stopped.")
+
 if __name__ == "__main__":
+    port = PORT
+    rescan = RESCAN_INTERVAL
+    for i, arg in enumerate(sys.argv[1:], 1):
+        if arg == "--port" and i < len(sys.argv) - 1:
+            port = int(sys.argv[i + 1])
+        elif arg == "--dir" and i < len(sys.argv) - 1:
+            DIRECTORY = os.path.abspath(sys.argv[i + 1])
+        elif arg == "--rescan" and i < len(sys.argv) - 1:
+            rescan = float(sys.argv[i + 1])
+    production = "--production" in sys.argv
+
     os.chdir(DIRECTORY)
     print(f"TrustOS Package Server")
     print(f"======================")
     print(f"Serving: {DIRECTORY}")
-    print(f"URL: http://0.0.0.0:{PORT}")
-    print(f"VM access: http://10.0.2.2:{PORT}")
+    print(f"Mode: {'production (threaded, sendfile)' if production else 'simple'}")
+    print(f"URL: http://0.0.0.0:{port}")
+    print(f"VM access: http://10.0.2.2:{port}")
     print(f"Press Ctrl+C to stop\n")
-    
-    with socketserver.TCPServer(("", PORT), Handler) as httpd:
-        try:
-            httpd.serve_forever()
-        except KeyboardInterrupt:
-            print("\nServer stopped.")
+
+    if production:
+        serve_production(port, rescan, "--no-gzip" not in sys.argv)
+    else:
+        with socketserver.TCPServer(("", port), Handler) as httpd:
+            try:
+                httpd.serve_forever()
+            except KeyboardInterrupt:
+                print("\nServer stopped.")
@@ -4,28 +4,1027 @@ Simple HTTP Proxy for TrustOS Browser
 Receives HTTP requests from TrustOS and forwards them as HTTPS to real servers.
 TrustOS connects to 10.0.2.2:8080 (QEMU host) and this proxy fetches the page.
 
-Usage: python web_proxy.py
+Usage: python web_proxy.py [--port 8080] [--host 0.0.0.0]
+                           [--per-host N] [--max-upstream N] [--idle-timeout S]
+                           [--max-body MB] [--cache-dir DIR] [--cache-mb N]
+                           [--disk-cache-mb N] [--no-cache]
+                           [--transform STAGES] [--max-image-width N] [--image-bits N]
+                           [--prefetch] [--prefetch-workers N] [--prefetch-budget N]
+                           [--prefetch-budget-mb N]
 Then in TrustOS browser: http://10.0.2.2:8080/https://google.com
+
+    --per-host N      Connections open to one site at a time (default 6, like
+                      a desktop browser); further requests wait for one
+    --max-upstream N  Upstream requests in flight across all sites (default 32)
+    --idle-timeout S  Drop pooled upstream connections idle for S seconds
+                      (default 30)
+    --max-body MB     Refuse (or cut off) upstream bodies larger than this
+                      (default 64)
+    --cache-dir DIR   Where cached responses are kept (default server/.proxy-cache)
+    --cache-mb N      Memory for cached response bodies (default 64)
+    --disk-cache-mb N Disk for cached responses (default 512; 0 = memory only)
+    --no-cache        Fetch everything from upstream every time
+    --transform STAGES
+                      Slim pages down for the TrustOS browser; comma-separated
+                      stages from scripts, styles, fonts, comments, images,
+                      or all (the default when no list is given). The images
+                      stage needs Pillow.
+    --max-image-width N
+                      Scale wider images down to N pixels (default 640)
+    --image-bits N    Bits per colour channel kept in re-encoded images
+                      (default 5)
+    --prefetch        Fetch the images, stylesheets and scripts of each page
+                      into the cache while the page is being sent, and point
+                      the page's links to them at the proxy
+    --prefetch-workers N
+                      Prefetches running at once (default 4)
+    --prefetch-budget N
+                      Subresources prefetched per page at most (default 32)
+    --prefetch-budget-mb N
+                      Bytes prefetched per page at most (default 8)
+
+Cache statistics: http://10.0.2.2:8080/__cache (or /__cache.json)
 """
 
+import codecs
+import email.utils
+import hashlib
+import html
+import html.parser
+import http.client
 import http.server
-import urllib.request
-import urllib.error
+import io
+import json
+import os
+import queue
 import ssl
 import sys
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None   # --transform images needs Pillow (pip install Pillow)
+from urllib.parse import urljoin, urlsplit
 
 PORT = 8080
+HOST = '0.0.0.0'
+PER_HOST = 6
+MAX_UPSTREAM = 32
+IDLE_TIMEOUT = 30
+UPSTREAM_TIMEOUT = 10
+MAX_REDIRECTS = 5
+CHUNK_SIZE = 64 * 1024
+MAX_BODY = 64 << 20
 
-class ProxyHandler(http.server.BaseHTTPRequestHandler):
-    def do_GET(self):
-        # Path format: /https://google.com or /http://example.com
-        path = self.path[1:]  # Remove leading /
-        
-        if not path:
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/html')
-            self.end_headers()
-            self.wfile.write(b'''<!DOCTYPE html>
+REQUEST_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (TrustOS; rv:1.0) Gecko/20100101',
+    'Accept': 'text/html,application/xhtml+xml,*/*',
+    'Accept-Language': 'en-US,en;q=0.5',
+}
+
+# One TLS context for every upstream connection: creating one loads the CA
+# store, which used to happen on every request. Certificates are still not
+# verified (for simplicity).
+SSL_CONTEXT = ssl.create_default_context()
+SSL_CONTEXT.check_hostname = False
+SSL_CONTEXT.verify_mode = ssl.CERT_NONE
+
+# ─── Upstream Connection Pool ─────────────────────────────────────────────────
+# Connections to each scheme://host:port are kept open after a response has
+# been read in full and reused by the next request for that site, so a page
+# and its images/CSS share a handful of TCP + TLS handshakes. A semaphore per
+# site caps the connections open to it, another caps upstream requests in
+# flight overall; a request waits up to UPSTREAM_TIMEOUT for a slot.
+
+class PoolTimeout(Exception):
+    """No upstream connection slot became free in time."""
+
+class HostPool:
+    """Idle keep-alive connections to one site, and its concurrency cap."""
+
+    def __init__(self, scheme, host, port, limit):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.slots = threading.BoundedSemaphore(limit)
+        self.lock = threading.Lock()
+        self.idle = []       # (connection, time it was returned), most recent last
+        self.opened = 0
+        self.reused = 0
+
+    def connect(self):
+        if self.scheme == 'https':
+            conn = http.client.HTTPSConnection(self.host, self.port, timeout=UPSTREAM_TIMEOUT,
+                                               context=SSL_CONTEXT)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=UPSTREAM_TIMEOUT)
+        with self.lock:
+            self.opened += 1
+        return conn
+
+    def take(self, idle_timeout):
+        """Most recently used idle connection, or None."""
+        now = time.monotonic()
+        with self.lock:
+            while self.idle:
+                conn, since = self.idle.pop()
+                if now - since < idle_timeout:
+                    self.reused += 1
+                    return conn
+                conn.close()
+        return None
+
+    def give(self, conn):
+        with self.lock:
+            self.idle.append((conn, time.monotonic()))
+
+class Upstream:
+    """An upstream response. Read the body, then close() to hand the
+    connection back to the pool (or drop it if it cannot be reused)."""
+
+    def __init__(self, pool, host_pool, conn, resp, url):
+        self.pool = pool
+        self.host_pool = host_pool
+        self.conn = conn
+        self.resp = resp
+        self.url = url
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = resp.headers
+
+    def read(self, amt=None):
+        return self.resp.read(amt)
+
+    def read1(self, amt):
+        """Up to `amt` bytes of whatever has arrived; b"" at the end."""
+        data = self.resp.read1(amt)
+        if not data and amt:
+            if self.resp.length:
+                # Upstream hung up short of its Content-Length
+                self.resp.will_close = True
+                raise http.client.IncompleteRead(b"", self.resp.length)
+            # Unlike read(), read1() leaves a drained Content-Length body
+            # open; close it so the connection counts as reusable
+            self.resp.close()
+        return data
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.resp.isclosed() and not self.resp.will_close:
+            self.host_pool.give(self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+        self.pool.release(self.host_pool)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ConnectionPool:
+    """Keep-alive connection pools for every upstream site."""
+
+    def __init__(self, per_host=PER_HOST, max_upstream=MAX_UPSTREAM, idle_timeout=IDLE_TIMEOUT):
+        self.per_host = per_host
+        self.idle_timeout = idle_timeout
+        self.total = threading.BoundedSemaphore(max_upstream)
+        self.max_upstream = max_upstream
+        self.lock = threading.Lock()
+        self.hosts = {}      # (scheme, host, port) -> HostPool
+
+    def host_pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        with self.lock:
+            hp = self.hosts.get(key)
+            if hp is None:
+                hp = self.hosts[key] = HostPool(scheme, host, port, self.per_host)
+            return hp
+
+    def acquire(self, hp):
+        if not hp.slots.acquire(timeout=UPSTREAM_TIMEOUT):
+            raise PoolTimeout(f"{hp.host}: all {self.per_host} connections busy")
+        if not self.total.acquire(timeout=UPSTREAM_TIMEOUT):
+            hp.slots.release()
+            raise PoolTimeout(f"all {self.max_upstream} upstream slots busy")
+
+    def release(self, hp):
+        self.total.release()
+        hp.slots.release()
+
+    def _send(self, hp, target, headers):
+        """GET `target` on a pooled connection, retrying once on a fresh one
+        if a reused connection turns out to have been closed by the server."""
+        conn = hp.take(self.idle_timeout)
+        if conn is not None:
+            try:
+                conn.request('GET', target, headers=headers)
+                return conn, conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+        conn = hp.connect()
+        try:
+            conn.request('GET', target, headers=headers)
+            return conn, conn.getresponse()
+        except BaseException:
+            conn.close()
+            raise
+
+    def get(self, url, headers=None):
+        """GET `url`, following redirects; returns an Upstream. `headers`
+        (e.g. If-None-Match) are sent on top of REQUEST_HEADERS."""
+        headers = {**REQUEST_HEADERS, **headers} if headers else REQUEST_HEADERS
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in ('http', 'https') or not parts.hostname:
+                raise ValueError(f"unsupported URL: {url}")
+            port = parts.port or (443 if parts.scheme == 'https' else 80)
+            hp = self.host_pool(parts.scheme, parts.hostname, port)
+            target = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+            self.acquire(hp)
+            try:
+                conn, resp = self._send(hp, target, headers)
+            except BaseException:
+                self.release(hp)
+                raise
+            up = Upstream(self, hp, conn, resp, url)
+            location = resp.headers.get('Location')
+            if resp.status not in (301, 302, 303, 307, 308) or not location:
+                return up
+            up.read()
+            up.close()
+            url = urljoin(url, location)
+        raise ValueError(f"too many redirects: {url}")
+
+    def stats(self):
+        with self.lock:
+            hosts = list(self.hosts.values())
+        return {
+            "hosts": len(hosts),
+            "opened": sum(h.opened for h in hosts),
+            "reused": sum(h.reused for h in hosts),
+            "idle": sum(len(h.idle) for h in hosts),
+        }
+
+upstream_pool = ConnectionPool()
+
+# ─── Response Cache ───────────────────────────────────────────────────────────
+# 200 responses are kept for repeat visits, following the upstream's caching
+# headers: Cache-Control max-age / s-maxage (no-store and private are never
+# stored, no-cache always revalidates), else Expires, else 10% of the time
+# since Last-Modified (at most a day). A stale entry with an ETag or
+# Last-Modified is revalidated with If-None-Match / If-Modified-Since, and a
+# 304 refreshes it without the body crossing the internet again.
+#
+# Every entry lives on disk in --cache-dir (<key>.json metadata + <key>.body)
+# in an LRU capped at --disk-cache-mb, so the cache survives restarts; the
+# bodies of recently used entries are also held in memory, in a second LRU
+# capped at --cache-mb. Bodies over MAX_ENTRY are streamed but not kept.
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".proxy-cache")
+CACHE_MB = 64
+DISK_CACHE_MB = 512
+MAX_ENTRY = 8 << 20
+HEURISTIC_MAX = 24 * 3600
+# Response headers kept with an entry so a 304 can be merged onto them.
+# Date and Age describe a single message, so they come from the 304 alone.
+STORED_HEADERS = ('Cache-Control', 'Expires', 'Last-Modified', 'ETag', 'Vary')
+
+def parse_cache_control(value):
+    """'max-age=60, no-cache' -> {'max-age': '60', 'no-cache': ''}"""
+    directives = {}
+    for part in value.split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"')
+    return directives
+
+def http_date(value):
+    """HTTP date header -> seconds since the epoch, or None."""
+    if not value:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def expiry(headers, now):
+    """When a response stops being fresh (seconds since the epoch; <= now
+    means revalidate before every use), or None if it must not be stored."""
+    cc = parse_cache_control(headers.get('Cache-Control', ''))
+    if 'no-store' in cc or 'private' in cc or headers.get('Vary', '').strip() == '*':
+        return None
+    date = http_date(headers.get('Date')) or now
+    age = max(now - date, 0)
+    if (headers.get('Age') or '').isdigit():
+        age = max(age, int(headers['Age']))
+
+    lifetime = 0
+    max_age = cc.get('s-maxage', cc.get('max-age'))
+    if 'no-cache' in cc:
+        pass
+    elif max_age is not None:
+        lifetime = int(max_age) if max_age.isdigit() else 0
+    elif 'Expires' in headers:
+        expires = http_date(headers['Expires'])   # invalid means already expired
+        lifetime = expires - date if expires else 0
+    elif 'Last-Modified' in headers:
+        modified = http_date(headers['Last-Modified'])
+        if modified:
+            lifetime = min((date - modified) / 10, HEURISTIC_MAX)
+
+    if lifetime <= age and not (headers.get('ETag') or headers.get('Last-Modified')):
+        return None   # stale on arrival and nothing to revalidate with
+    return now + lifetime - age
+
+def stored_headers(headers):
+    """The STORED_HEADERS present in `headers`, as a plain dict."""
+    return {name: headers[name] for name in STORED_HEADERS if headers.get(name) is not None}
+
+class CacheEntry:
+    __slots__ = ("key", "url", "base", "content_type", "headers", "expires", "stored",
+                 "size", "body", "hits", "revalidations", "last_used", "prefetched")
+
+    def __init__(self, key, url, base, content_type, headers, expires, stored, size):
+        self.key = key
+        self.url = url
+        self.base = base              # final URL after redirects; links resolve against it
+        self.content_type = content_type
+        self.headers = headers        # stored_headers() of the response
+        self.expires = expires
+        self.stored = stored          # when the body was fetched or last revalidated
+        self.size = size
+        self.body = None              # bytes while in the memory tier
+        self.hits = 0
+        self.revalidations = 0
+        self.last_used = stored
+        self.prefetched = False       # stored by the Prefetcher, not yet asked for
+
+    @property
+    def etag(self):
+        return self.headers.get('ETag')
+
+    @property
+    def last_modified(self):
+        return self.headers.get('Last-Modified')
+
+    def fresh(self, now):
+        return now < self.expires
+
+    def validators(self):
+        """Conditional request headers, or None if there are none."""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers or None
+
+    def meta(self):
+        return {"url": self.url, "base": self.base, "content_type": self.content_type,
+                "headers": self.headers,
+                "expires": self.expires, "stored": self.stored, "size": self.size}
+
+class ResponseCache:
+    """Memory + disk LRU of upstream responses, keyed by URL."""
+
+    def __init__(self, directory=CACHE_DIR, memory_bytes=CACHE_MB << 20,
+                 disk_bytes=DISK_CACHE_MB << 20, max_entry=MAX_ENTRY):
+        self.lock = threading.Lock()
+        self.directory = directory    # None: memory only
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.max_entry = min(max_entry, memory_bytes)
+        self.entries = OrderedDict()  # key -> CacheEntry, least recent first
+        self.hot = OrderedDict()      # key -> CacheEntry with .body, least recent first
+        self.memory_total = 0
+        self.disk_total = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.stores = 0
+        self.evictions = 0
+        self.prefetch_used = 0        # prefetched entries the browser then asked for
+        self._scan()
+
+    def _path(self, key, ext):
+        return os.path.join(self.directory, key + ext)
+
+    def _scan(self):
+        """Load the cache directory's <key>.json files into self.entries,
+        ordered by the mtime of each <key>.body (when it was last served);
+        a .json whose body is missing or unreadable is skipped."""
+        if not self.directory:
+            return
+        try:
+            names = [n for n in os.listdir(self.directory) if n.endswith(".json")]
+        except FileNotFoundError:
+            return
+        found = []
+        for n in names:
+            key = n[:-5]
+            try:
+                with open(self._path(key, ".json")) as f:
+                    meta = json.load(f)
+                used = os.stat(self._path(key, ".body")).st_mtime
+            except (OSError, ValueError):
+                continue
+            if "headers" not in meta:   # written before headers were kept
+                meta["headers"] = stored_headers({'ETag': meta.get("etag"),
+                                                  'Last-Modified': meta.get("last_modified")})
+            entry = CacheEntry(key, meta["url"], meta.get("base", meta["url"]), meta["content_type"],
+                               meta["headers"], meta["expires"], meta["stored"], meta["size"])
+            entry.last_used = used
+            found.append((used, key, entry))
+        for _, key, entry in sorted(found):
+            self.entries[key] = entry
+            self.disk_total += entry.size
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha256(url.encode()).hexdigest()[:32]
+
+    def lookup(self, url):
+        with self.lock:
+            entry = self.entries.get(self.key(url))
+            if entry is not None:
+                self.entries.move_to_end(entry.key)
+            return entry
+
+    def body(self, entry):
+        """The entry's body from memory or disk, or None if it has gone."""
+        with self.lock:
+            if entry.body is not None:
+                self.hot.move_to_end(entry.key)
+                return entry.body
+        if not self.directory:
+            return None
+        path = self._path(entry.key, ".body")
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)   # the mtime is this entry's last use for _scan()
+        except OSError:
+            self._drop(entry)
+            return None
+        with self.lock:
+            if entry.key in self.entries and entry.body is None:
+                self._make_hot(entry, data)
+        return data
+
+    def _make_hot(self, entry, data):
+        # Caller holds self.lock
+        entry.body = data
+        self.hot[entry.key] = entry
+        self.memory_total += len(data)
+        while self.memory_total > self.memory_bytes and len(self.hot) > 1:
+            _, cold = self.hot.popitem(last=False)
+            self.memory_total -= len(cold.body)
+            cold.body = None
+            if not self.directory:
+                del self.entries[cold.key]
+                self.evictions += 1
+
+    def _drop(self, entry):
+        with self.lock:
+            if self.entries.get(entry.key) is not entry:
+                return
+            del self.entries[entry.key]
+            self.disk_total -= entry.size if self.directory else 0
+            if self.hot.pop(entry.key, None) is not None:
+                self.memory_total -= len(entry.body)
+                entry.body = None
+
+    def _write(self, entry, data=None):
+        """Persist an entry's metadata (and body, if given)."""
+        if not self.directory:
+            return True
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = f".{threading.get_ident()}.tmp"
+            if data is not None:
+                with open(self._path(entry.key, ".body" + tmp), "wb") as f:
+                    f.write(data)
+                os.replace(self._path(entry.key, ".body" + tmp), self._path(entry.key, ".body"))
+            with open(self._path(entry.key, ".json" + tmp), "w") as f:
+                json.dump(entry.meta(), f)
+            os.replace(self._path(entry.key, ".json" + tmp), self._path(entry.key, ".json"))
+            return True
+        except OSError as e:
+            print(f"[CACHE] Warning: could not store {entry.url}: {e}")
+            return False
+
+    def store(self, url, headers, body, expires, prefetched=False, base=None):
+        """Keep `body` under the requested `url`; `base` is the URL it was
+        finally fetched from, if a redirect was followed."""
+        now = time.time()
+        entry = CacheEntry(self.key(url), url, base or url, headers.get('Content-Type', 'text/html'),
+                           stored_headers(headers), expires, now, len(body))
+        entry.prefetched = prefetched
+        old = self.lookup(url)
+        if old is not None:
+            self._drop(old)
+        if not self._write(entry, body):
+            return
+        evict = []
+        with self.lock:
+            self.entries[entry.key] = entry
+            self.stores += 1
+            self._make_hot(entry, body)
+            if self.directory:
+                self.disk_total += entry.size
+                while self.disk_total > self.disk_bytes and len(self.entries) > 1:
+                    _, old = self.entries.popitem(last=False)
+                    self.disk_total -= old.size
+                    if self.hot.pop(old.key, None) is not None:
+                        self.memory_total -= len(old.body)
+                        old.body = None
+                    self.evictions += 1
+                    evict.append(old.key)
+        for key in evict:
+            for ext in (".json", ".body"):
+                try:
+                    os.remove(self._path(key, ext))
+                except OSError:
+                    pass
+
+    def refresh(self, entry, headers):
+        """Apply a 304: its header fields replace the stored ones (RFC 9111
+        4.3.4), and freshness is computed from the result, so a 304 that
+        repeats only the ETag keeps the stored max-age or Expires."""
+        now = time.time()
+        merged = dict(entry.headers)
+        merged.update(stored_headers(headers))
+        for name in ('Date', 'Age'):
+            if headers.get(name) is not None:
+                merged[name] = headers[name]
+        expires = expiry(merged, now)
+        entry.expires = now if expires is None else expires
+        entry.headers = stored_headers(merged)
+        entry.stored = now
+        self._write(entry)
+
+    def record(self, entry, outcome):
+        """Count a request answered by `entry` ("hit" or "revalidated")."""
+        with self.lock:
+            entry.last_used = time.time()
+            if entry.prefetched:
+                entry.prefetched = False
+                self.prefetch_used += 1
+            if outcome == "hit":
+                entry.hits += 1
+                self.hits += 1
+            else:
+                entry.revalidations += 1
+                self.revalidated += 1
+
+    def miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "in_memory": len(self.hot),
+                "memory_bytes": self.memory_total,
+                "memory_limit": self.memory_bytes,
+                "disk_bytes": self.disk_total if self.directory else 0,
+                "disk_limit": self.disk_bytes if self.directory else 0,
+                "hits": self.hits,
+                "revalidated": self.revalidated,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "prefetch_used": self.prefetch_used,
+            }
+
+    def entry_stats(self, limit=500):
+        """Per-entry stats, most recently used first."""
+        now = time.time()
+        with self.lock:
+            recent = list(self.entries.values())[::-1][:limit]
+            return [{
+                "url": e.url,
+                "size": e.size,
+                "tier": "memory" if e.body is not None else "disk",
+                "hits": e.hits,
+                "revalidations": e.revalidations,
+                "age": round(now - e.stored),
+                "fresh_for": max(round(e.expires - now), 0),
+                "validators": " ".join(v for v, on in (("ETag", e.etag), ("Last-Modified", e.last_modified)) if on),
+            } for e in recent]
+
+    def render(self, prefetch=None):
+        """The /__cache introspection page (with Prefetcher stats, if given)."""
+        s = self.stats()
+        served = s["hits"] + s["revalidated"] + s["misses"]
+        ratio = f"{(s['hits'] + s['revalidated']) * 100 / served:.1f}%" if served else "-"
+        rows = "".join(
+            f"<tr><td>{html.escape(e['url'])}</td><td>{e['size']}</td><td>{e['tier']}</td>"
+            f"<td>{e['hits']}</td><td>{e['revalidations']}</td><td>{e['age']}s</td>"
+            f"<td>{str(e['fresh_for']) + 's' if e['fresh_for'] else 'stale'}</td>"
+            f"<td>{e['validators']}</td></tr>\n"
+            for e in self.entry_stats())
+        return (
+            "<html><head><title>Proxy cache</title></head><body>\n"
+            "<h1>Proxy cache</h1>\n"
+            f"<p>{s['entries']} entries, {s['in_memory']} in memory "
+            f"({s['memory_bytes'] >> 10} / {s['memory_limit'] >> 10} KB), "
+            f"{s['disk_bytes'] >> 10} / {s['disk_limit'] >> 10} KB on disk</p>\n"
+            f"<p>hits {s['hits']}, revalidated {s['revalidated']}, misses {s['misses']} "
+            f"(served from cache: {ratio}); stored {s['stores']}, evicted {s['evictions']}</p>\n"
+            + ("" if prefetch is None else
+               f"<p>prefetch: {prefetch['fetched']} fetched for {prefetch['pages']} pages, "
+               f"{prefetch['used']} used; {prefetch['already_cached']} already cached, "
+               f"{prefetch['over_budget']} over budget, {prefetch['errors']} failed</p>\n") +
+            "<table border=1>\n<tr><th>URL</th><th>bytes</th><th>tier</th><th>hits</th>"
+            "<th>revalidated</th><th>age</th><th>fresh for</th><th>validators</th></tr>\n"
+            f"{rows}</table></body></html>\n").encode()
+
+response_cache = None   # ResponseCache unless started with --no-cache
+
+# ─── Transforms ───────────────────────────────────────────────────────────────
+# With --transform, responses are slimmed down for the TrustOS browser on
+# the way out; the cache keeps what the upstream sent. Stages:
+#   scripts   <script> elements
+#   styles    <style> blocks
+#   fonts     <link>s to web fonts (font files, preload as=font, font CDNs)
+#   comments  <!-- ... -->
+#   images    images wider than --max-image-width are scaled down, and all are
+#             re-encoded as 8-bit RGB(A) PNG (the kernel decodes no JPEG, GIF,
+#             WebP or palette PNG) with --image-bits bits per channel
+# HTML is rewritten as it streams through (html.parser tokenizes each chunk
+# as it arrives; there is no DOM), so the first bytes still leave at once.
+# Images are transformed whole. The image stage needs Pillow.
+
+HTML_STAGES = {'scripts', 'styles', 'fonts', 'comments'}
+TRANSFORM_STAGES = HTML_STAGES | {'images'}
+MAX_IMAGE_WIDTH = 640
+IMAGE_BITS = 5
+FONT_EXTENSIONS = ('.woff', '.woff2', '.ttf', '.otf', '.eot')
+FONT_HOSTS = ('fonts.googleapis.com', 'fonts.gstatic.com', 'use.typekit.net', 'fonts.bunny.net')
+
+def is_font_link(attrs):
+    attrs = {k: (v or '') for k, v in attrs}
+    href = attrs.get('href', '').lower()
+    if attrs.get('as', '').lower() == 'font':
+        return True
+    if urlsplit(href).hostname in FONT_HOSTS:
+        return True
+    return href.split('?')[0].endswith(FONT_EXTENSIONS)
+
+# Attribute holding the URL the kernel browser fetches for a tag (see
+# collect_resources() in kernel/src/browser/mod.rs)
+SUBRESOURCE_ATTRS = {'img': 'src', 'script': 'src', 'link': 'href'}
+
+class HtmlSlimmer(html.parser.HTMLParser):
+    """Streaming HTML rewriter: everything but the stripped elements is
+    passed through as written. With `links`, each subresource URL is
+    reported to it (resolved against `base`) and rewritten to go through
+    the proxy."""
+
+    def __init__(self, stages, base=None, links=None):
+        super().__init__(convert_charrefs=False)
+        self.stages = stages
+        self.base = base
+        self.links = links
+        self.out = []
+        self.skipping = None   # 'script' or 'style' while inside one
+
+    def dropped(self, tag, attrs):
+        return ((tag == 'script' and 'scripts' in self.stages)
+                or (tag == 'style' and 'styles' in self.stages)
+                or (tag == 'link' and 'fonts' in self.stages and is_font_link(attrs)))
+
+    def subresource(self, tag, attrs):
+        """The start tag as written, or with its subresource URL reported
+        and pointed back at the proxy."""
+        text = self.get_starttag_text()
+        name = SUBRESOURCE_ATTRS.get(tag)
+        if self.links is None or name is None:
+            return text
+        values = dict(attrs)
+        rel = (values.get('rel') or '').lower()
+        ref = (values.get(name) or '').strip()
+        if (tag == 'link' and rel != 'stylesheet' and 'icon' not in rel) or not ref or ref.startswith('data:'):
+            return text
+        url = urljoin(self.base, ref)
+        if urlsplit(url).scheme not in ('http', 'https'):
+            return text
+        self.links(url)
+        attrs = [(k, '/' + url if k == name else v) for k, v in attrs]
+        # The kernel's parser does not decode entities in attribute values,
+        # so only quotes are escaped
+        return (f"<{tag}" + "".join(f" {k}" if v is None else f' {k}="{v.replace(chr(34), "&quot;")}"'
+                                    for k, v in attrs)
+                + ("/>" if text.endswith("/>") else ">"))
+
+    def handle_starttag(self, tag, attrs):
+        if self.skipping:
+            return
+        if not self.dropped(tag, attrs):
+            self.out.append(self.subresource(tag, attrs))
+        elif tag in ('script', 'style'):
+            self.skipping = tag
+
+    def handle_startendtag(self, tag, attrs):
+        if not self.skipping and not self.dropped(tag, attrs):
+            self.out.append(self.subresource(tag, attrs))
+
+    def handle_endtag(self, tag):
+        if self.skipping:
+            if tag == self.skipping:
+                self.skipping = None
+        else:
+            self.out.append(f"</{tag}>")
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.out.append(data)
+
+    def handle_entityref(self, name):
+        if not self.skipping:
+            self.out.append(f"&{name};")
+
+    def handle_charref(self, name):
+        if not self.skipping:
+            self.out.append(f"&#{name};")
+
+    def handle_comment(self, data):
+        if not self.skipping and 'comments' not in self.stages:
+            self.out.append(f"<!--{data}-->")
+
+    def handle_decl(self, decl):
+        self.out.append(f"<!{decl}>")
+
+    def unknown_decl(self, data):
+        self.out.append(f"<![{data}]>")
+
+    def handle_pi(self, data):
+        self.out.append(f"<?{data}>")
+
+    def rewrite(self, text, final=False):
+        self.feed(text)
+        if final:
+            self.close()
+        out = ''.join(self.out)
+        self.out.clear()
+        return out
+
+class HtmlTransform:
+    """Bytes in, bytes out, in the page's own charset; undecodable bytes
+    survive the round trip unchanged."""
+    buffered = False
+
+    def __init__(self, charset, stages, base=None, links=None):
+        try:
+            decoder = codecs.getincrementaldecoder(charset)
+        except LookupError:
+            charset, decoder = 'latin-1', codecs.getincrementaldecoder('latin-1')
+        self.charset = charset
+        self.decoder = decoder(errors='surrogateescape')
+        self.slimmer = HtmlSlimmer(stages, base, links)
+
+    def feed(self, data, final=False):
+        text = self.slimmer.rewrite(self.decoder.decode(data, final), final)
+        return text.encode(self.charset, errors='surrogateescape')
+
+    def finish(self):
+        return self.feed(b"", final=True)
+
+    def apply(self, body, content_type):
+        return self.feed(body, final=True), content_type
+
+class ImageTransform:
+    """Downscale and re-encode a whole image as a PNG the kernel can decode."""
+    buffered = True
+
+    def __init__(self, max_width, bits):
+        self.max_width = max_width
+        self.mask = (0xFF << (8 - bits)) & 0xFF
+
+    def apply(self, body, content_type):
+        try:
+            img = Image.open(io.BytesIO(body))
+            decodable = (img.format == 'PNG' and img.mode in ('L', 'LA', 'RGB', 'RGBA')) or \
+                        (img.format == 'BMP' and img.mode in ('RGB', 'RGBA'))
+            if decodable and img.width <= self.max_width:
+                return body, content_type   # the kernel can show it as is
+            alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+            img = img.convert('RGBA' if alpha else 'RGB')
+            if img.width > self.max_width:
+                height = max(round(img.height * self.max_width / img.width), 1)
+                img = img.resize((self.max_width, height), Image.BILINEAR, reducing_gap=2.0)
+            img = img.point([v & self.mask for v in range(256)] * len(img.getbands()))
+            out = io.BytesIO()
+            img.save(out, 'PNG', compress_level=6)
+        except Exception as e:   # Pillow raises all sorts on bad input
+            print(f"[PROXY] Image left as is: {e}")
+            return body, content_type
+        return out.getvalue(), 'image/png'
+
+class TransformStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}        # 'html' / 'image' -> [responses, bytes in, bytes out]
+
+    def record(self, kind, before, after):
+        with self.lock:
+            totals = self.kinds.setdefault(kind, [0, 0, 0])
+            totals[0] += 1
+            totals[1] += before
+            totals[2] += after
+        saved = before - after
+        print(f"[PROXY] Transform {kind}: {before} -> {after} bytes "
+              f"(saved {saved}, {saved * 100 / before if before else 0:.0f}%)")
+
+    def stats(self):
+        with self.lock:
+            return {kind: {"responses": n, "bytes_in": b_in, "bytes_out": b_out, "saved": b_in - b_out}
+                    for kind, (n, b_in, b_out) in self.kinds.items()}
+
+transform_stats = TransformStats()
+
+# ─── Prefetch ─────────────────────────────────────────────────────────────────
+# With --prefetch, the images, stylesheets, icons and scripts an HTML page
+# references are fetched into the cache while the page itself is still
+# streaming to the browser, so its follow-up requests (which the kernel
+# browser makes one after another) are answered locally. Their URLs in the
+# page are rewritten to /<absolute URL> so those requests do come back to
+# the proxy. --prefetch-workers fetches run at once across all pages; each
+# page may prefetch at most --prefetch-budget resources and
+# --prefetch-budget-mb bytes. A browser request for a URL that is still
+# being prefetched waits for it instead of fetching it a second time.
+# Responses without any freshness information are kept for PREFETCH_GRACE
+# seconds, long enough for the page load they were fetched for.
+
+PREFETCH_WORKERS = 4
+PREFETCH_BUDGET = 32
+PREFETCH_BUDGET_MB = 8
+PREFETCH_GRACE = 60
+
+class PrefetchPage:
+    """One page's prefetch budget; `add` is the HtmlSlimmer links callback."""
+
+    def __init__(self, prefetcher, url, budget, budget_bytes):
+        self.prefetcher = prefetcher
+        self.url = url
+        self.remaining = budget
+        self.bytes_left = budget_bytes
+        self.seen = set()
+
+    def add(self, url):
+        self.prefetcher.submit(self, url)
+
+class Prefetcher:
+    """Worker threads fetching subresources into the ResponseCache."""
+
+    def __init__(self, cache, workers=PREFETCH_WORKERS, budget=PREFETCH_BUDGET,
+                 budget_bytes=PREFETCH_BUDGET_MB << 20):
+        self.cache = cache
+        self.workers = workers
+        self.budget = budget
+        self.budget_bytes = budget_bytes
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.inflight = {}     # url -> Event set when its prefetch is done
+        self.pages = 0
+        self.queued = 0
+        self.fetched = 0
+        self.fetched_bytes = 0
+        self.already_cached = 0
+        self.over_budget = 0
+        self.uncacheable = 0
+        self.errors = 0
+        self.waits = 0
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def page(self, url):
+        with self.lock:
+            self.pages += 1
+        return PrefetchPage(self, url, self.budget, self.budget_bytes)
+
+    def submit(self, page, url):
+        if url in page.seen:
+            return
+        page.seen.add(url)
+        entry = self.cache.lookup(url)
+        with self.lock:
+            if entry is not None and entry.fresh(time.time()):
+                self.already_cached += 1
+                return
+            if url in self.inflight:
+                return
+            if page.remaining <= 0:
+                self.over_budget += 1
+                return
+            page.remaining -= 1
+            self.inflight[url] = threading.Event()
+            self.queued += 1
+        self.queue.put((page, url))
+
+    def wait(self, url):
+        """Block while `url` is being prefetched; True if it was."""
+        with self.lock:
+            done = self.inflight.get(url)
+            if done is None:
+                return False
+            self.waits += 1
+        done.wait(UPSTREAM_TIMEOUT)
+        return True
+
+    def _work(self):
+        while True:
+            page, url = self.queue.get()
+            try:
+                self._fetch(page, url)
+            except (PoolTimeout, OSError, http.client.HTTPException, ValueError) as e:
+                print(f"[PREFETCH] Failed: {url}: {e}")
+                with self.lock:
+                    self.errors += 1
+            finally:
+                with self.lock:
+                    self.inflight.pop(url).set()
+
+    def _fetch(self, page, url):
+        with upstream_pool.get(url) as response:
+            if response.status != 200:
+                with self.lock:
+                    self.uncacheable += 1
+                return
+            # A declared length is taken from the page's budget up front, so
+            # concurrent prefetches cannot overrun it together
+            length = response.headers.get('Content-Length')
+            length = int(length) if length and length.isdigit() else None
+            with self.lock:
+                limit = min(self.cache.max_entry, page.bytes_left)
+                fits = limit > 0 and (length is None or length <= limit)
+                if fits and length is not None:
+                    page.bytes_left -= length
+                else:
+                    self.over_budget += not fits
+            if not fits:
+                return
+            parts, size = [], 0
+            while size <= limit:
+                data = response.read1(CHUNK_SIZE)
+                if not data:
+                    break
+                parts.append(data)
+                size += len(data)
+            with self.lock:
+                if length is None:
+                    page.bytes_left -= size
+                if size > limit:
+                    self.over_budget += 1
+                    return
+        now = time.time()
+        expires = expiry(response.headers, now)
+        cc = parse_cache_control(response.headers.get('Cache-Control', ''))
+        if expires is None and not ('no-store' in cc or 'private' in cc
+                                    or response.headers.get('Vary', '').strip() == '*'):
+            expires = now + PREFETCH_GRACE
+        if expires is None:
+            with self.lock:
+                self.uncacheable += 1
+            return
+        self.cache.store(url, response.headers, b"".join(parts), expires, prefetched=True,
+                         base=response.url)
+        with self.lock:
+            self.fetched += 1
+            self.fetched_bytes += size
+
+    def stats(self):
+        used = self.cache.stats()["prefetch_used"]
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "pages": self.pages,
+                "queued": self.queued,
+                "in_flight": len(self.inflight),
+                "fetched": self.fetched,
+                "fetched_bytes": self.fetched_bytes,
+                "used": used,
+                "hit_rate": round(used / self.fetched, 3) if self.fetched else None,
+                "already_cached": self.already_cached,
+                "over_budget": self.over_budget,
+                "uncacheable": self.uncacheable,
+                "errors": self.errors,
+                "browser_waits": self.waits,
+            }
+
+prefetcher = None   # Prefetcher when started with --prefetch
+
+# ─── Proxy Handler ────────────────────────────────────────────────────────────
+
+HOME_PAGE = b'''<!DOCTYPE html>
 <html>
 <head><title>TrustOS Web Proxy</title></head>
 <body style="background:#1a1a2e;color:#0f0;font-family:monospace;padding:20px;">
@@ -33,78 +1032,340 @@ class ProxyHandler(http.server.BaseHTTPRequestHandler):
 <p>Usage: http://10.0.2.2:8080/https://google.com</p>
 <p>Or: http://10.0.2.2:8080/https://example.com</p>
 </body>
-</html>''')
+</html>'''
+
+class ProxyHandler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive towards the browser too; every response is delimited by a
+    # Content-Length or chunked encoding
+    protocol_version = "HTTP/1.1"
+    timeout = 60
+    disable_nagle_algorithm = True
+    max_body = MAX_BODY
+    transforms = frozenset()      # --transform stages
+    image_width = MAX_IMAGE_WIDTH
+    image_bits = IMAGE_BITS
+
+    def send_text(self, status, body, content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        # Path format: /https://google.com or /http://example.com
+        path = self.path[1:]  # Remove leading /
+
+        if not path:
+            self.send_text(200, HOME_PAGE, 'text/html')
             return
-        
+        if path in ('__cache', '__cache.json'):
+            self.send_cache_page(path.endswith('.json'))
+            return
+
         # Ensure URL has scheme
         if not path.startswith('http://') and not path.startswith('https://'):
             path = 'https://' + path
-        
+
         print(f"[PROXY] Fetching: {path}")
-        
+
+        cached = None
+        if prefetcher is not None and prefetcher.wait(path):
+            print(f"[PROXY] Waited for prefetch: {path}")
+        if response_cache is not None:
+            entry = response_cache.lookup(path)
+            if entry is not None and (entry.fresh(time.time()) or entry.validators()):
+                body = response_cache.body(entry)
+                if body is not None and entry.fresh(time.time()) and not self.wants_revalidation():
+                    response_cache.record(entry, "hit")
+                    self.send_cached(entry, body, "HIT")
+                    return
+                if body is not None and entry.validators():
+                    cached = (entry, body)
+
+        self.relaying = False
         try:
-            # Create SSL context that doesn't verify (for simplicity)
-            ctx = ssl.create_default_context()
-            ctx.check_hostname = False
-            ctx.verify_mode = ssl.CERT_NONE
-            
-            req = urllib.request.Request(
-                path,
-                headers={
-                    'User-Agent': 'Mozilla/5.0 (TrustOS; rv:1.0) Gecko/20100101',
-                    'Accept': 'text/html,application/xhtml+xml,*/*',
-                    'Accept-Language': 'en-US,en;q=0.5',
-                }
-            )
-            
-            with urllib.request.urlopen(req, timeout=10, context=ctx) as response:
-                content = response.read()
-                content_type = response.headers.get('Content-Type', 'text/html')
-                
-                self.send_response(200)
-                self.send_header('Content-Type', content_type)
-                self.send_header('Content-Length', len(content))
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(content)
-                
-                print(f"[PROXY] OK: {len(content)} bytes")
-                
-        except urllib.error.HTTPError as e:
-            print(f"[PROXY] HTTP Error: {e.code}")
-            self.send_response(e.code)
-            self.end_headers()
-            self.wfile.write(f"HTTP Error: {e.code}".encode())
-            
-        except urllib.error.URLError as e:
-            print(f"[PROXY] URL Error: {e.reason}")
-            self.send_response(502)
-            self.end_headers()
-            self.wfile.write(f"URL Error: {e.reason}".encode())
-            
-        except Exception as e:
-            print(f"[PROXY] Error: {e}")
-            self.send_response(500)
-            self.end_headers()
-            self.wfile.write(f"Error: {e}".encode())
-    
+            validators = cached[0].validators() if cached else None
+            with upstream_pool.get(path, validators) as response:
+                if response.status == 304 and cached:
+                    response.read()
+                    entry, body = cached
+                    response_cache.refresh(entry, response.headers)
+                    response_cache.record(entry, "revalidated")
+                    self.send_cached(entry, body, "REVALIDATED")
+                    return
+                if response_cache is not None:
+                    response_cache.miss()
+                self.relay(response, path)
+
+        except PoolTimeout as e:
+            print(f"[PROXY] Busy: {e}")
+            self.send_text(503, f"Proxy busy: {e}".encode())
+
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            if self.relaying:
+                # Headers are out; all we can do is cut the response short
+                print(f"[PROXY] Aborted mid-body: {e}")
+                self.close_connection = True
+                return
+            print(f"[PROXY] URL Error: {e}")
+            self.send_text(502, f"URL Error: {e}".encode())
+
+    def wants_revalidation(self):
+        cc = parse_cache_control(self.headers.get('Cache-Control', ''))
+        return ('no-cache' in cc or cc.get('max-age') == '0'
+                or 'no-cache' in self.headers.get('Pragma', ''))
+
+    def transform_for(self, content_type, url=None):
+        """The --transform stage for a response of this type, or None. HTML
+        from `url` also goes through the rewriter with --prefetch."""
+        prefetch = prefetcher is not None and url is not None
+        if not self.transforms and not prefetch:
+            return None
+        mime, _, params = content_type.partition(';')
+        mime = mime.strip().lower()
+        if mime in ('text/html', 'application/xhtml+xml') and (self.transforms & HTML_STAGES or prefetch):
+            charset = 'utf-8'
+            for param in params.split(';'):
+                name, _, value = param.partition('=')
+                if name.strip().lower() == 'charset' and value.strip():
+                    charset = value.strip().strip('"')
+            links = prefetcher.page(url).add if prefetch else None
+            return HtmlTransform(charset, self.transforms, url, links)
+        if mime.startswith('image/') and 'images' in self.transforms and Image is not None:
+            return ImageTransform(self.image_width, self.image_bits)
+        return None
+
+    def send_whole(self, status, content_type, body, headers=(), url=None):
+        """Send a complete body, through the --transform stage if one applies."""
+        stage = self.transform_for(content_type, url)
+        if stage is not None:
+            before = len(body)
+            body, content_type = stage.apply(body, content_type)
+            if self.transforms:
+                transform_stats.record('image' if stage.buffered else 'html', before, len(body))
+                headers = [*headers, ('X-Original-Length', before)]
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', len(body))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_cached(self, entry, body, outcome):
+        self.send_whole(200, entry.content_type, body,
+                        [('Age', max(int(time.time() - entry.stored), 0)), ('X-Cache', outcome)],
+                        entry.base)
+        print(f"[PROXY] {outcome}: {len(body)} bytes from cache")
+
+    def send_cache_page(self, as_json):
+        if response_cache is None:
+            self.send_text(404, b"Cache disabled (--no-cache)")
+        elif as_json:
+            body = {**response_cache.stats(), "pool": upstream_pool.stats(),
+                    "transform": transform_stats.stats(),
+                    "prefetch": prefetcher.stats() if prefetcher else None,
+                    "entries_detail": response_cache.entry_stats()}
+            self.send_text(200, json.dumps(body, indent=1).encode(), 'application/json')
+        else:
+            self.send_text(200, response_cache.render(prefetcher.stats() if prefetcher else None),
+                           'text/html')
+
+    def relay(self, response, url=None):
+        """Stream an upstream response to the browser CHUNK_SIZE bytes at a
+        time as they arrive. Without an upstream Content-Length (or when
+        the HTML is being rewritten) the body is sent chunked, or to an
+        HTTP/1.0 client delimited by closing. Images being transformed are
+        read whole first. A cacheable response for `url` is kept, as the
+        upstream sent it, in response_cache."""
+        length = response.headers.get('Content-Length')
+        length = int(length) if length and length.isdigit() else None
+        if length is not None and length > self.max_body:
+            print(f"[PROXY] Refused: {length} bytes > --max-body")
+            self.send_text(502, f"Response too large ({length} bytes)".encode())
+            return
+
+        keep, expires = None, None
+        if (url and response_cache is not None and response.status == 200
+                and (length is None or length <= response_cache.max_entry)):
+            expires = expiry(response.headers, time.time())
+            if expires is not None:
+                keep = []
+        headers = [('X-Cache', 'MISS')] if response_cache is not None else []
+        content_type = response.headers.get('Content-Type', 'text/html')
+        stage = self.transform_for(content_type, response.url if response.status == 200 else None)
+
+        if stage is not None and stage.buffered:
+            parts, size = [], 0
+            while size <= self.max_body:
+                data = response.read1(CHUNK_SIZE)
+                if not data:
+                    break
+                parts.append(data)
+                size += len(data)
+            if size > self.max_body:
+                print("[PROXY] Refused: body passed --max-body")
+                self.send_text(502, b"Response too large")
+                return
+            body = b"".join(parts)
+            if keep is not None and size <= response_cache.max_entry:
+                response_cache.store(url, response.headers, body, expires, base=response.url)
+            self.send_whole(response.status, content_type, body, headers, response.url)
+            return
+
+        out_length = length if stage is None else None
+        chunked = out_length is None and self.request_version >= "HTTP/1.1"
+        self.send_response(response.status)
+        self.send_header('Content-Type', content_type)
+        if out_length is not None:
+            self.send_header('Content-Length', out_length)
+        elif chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        for key, value in headers:
+            self.send_header(key, value)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.relaying = True
+
+        sent = written = 0
+        while True:
+            # read1: whatever has arrived (up to CHUNK_SIZE), without waiting
+            # for a full buffer
+            data = response.read1(CHUNK_SIZE)
+            if not data:
+                break
+            sent += len(data)
+            if sent > self.max_body:
+                print("[PROXY] Cut off: body passed --max-body")
+                self.close_connection = True
+                return
+            if keep is not None:
+                keep.append(data)
+                if sent > response_cache.max_entry:
+                    keep = None
+                elif sent == length:
+                    # Cache it before the browser has the last byte and can
+                    # ask again
+                    response_cache.store(url, response.headers, b"".join(keep), expires, base=response.url)
+                    keep = None
+            written += self.write_body(stage.feed(data) if stage else data, chunked)
+        if keep is not None:
+            response_cache.store(url, response.headers, b"".join(keep), expires, base=response.url)
+        if stage is not None:
+            written += self.write_body(stage.finish(), chunked)
+            if self.transforms:
+                transform_stats.record('html', sent, written)
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+        print(f"[PROXY] OK: {response.status} {sent} bytes")
+
+    def write_body(self, data, chunked):
+        # An empty chunk would end a chunked body
+        if data:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data) if chunked else data)
+        return len(data)
+
     def log_message(self, format, *args):
         print(f"[PROXY] {args[0]}")
 
+class ThreadedProxyServer(http.server.ThreadingHTTPServer):
+    # One thread per browser connection, so a slow site only holds up the
+    # requests that are waiting on it
+    daemon_threads = True
+    request_queue_size = 64
+
 def main():
+    global upstream_pool, response_cache, prefetcher
+    port = PORT
+    host = HOST
+    per_host = PER_HOST
+    max_upstream = MAX_UPSTREAM
+    idle_timeout = IDLE_TIMEOUT
+    cache_dir = CACHE_DIR
+    cache_mb = CACHE_MB
+    disk_cache_mb = DISK_CACHE_MB
+    prefetch_workers = PREFETCH_WORKERS
+    prefetch_budget = PREFETCH_BUDGET
+    prefetch_budget_mb = PREFETCH_BUDGET_MB
+    for i, arg in enumerate(sys.argv[1:], 1):
+        if arg == "--port" and i < len(sys.argv) - 1:
+            port = int(sys.argv[i + 1])
+        elif arg == "--host" and i < len(sys.argv) - 1:
+            host = sys.argv[i + 1]
+        elif arg == "--per-host" and i < len(sys.argv) - 1:
+            per_host = int(sys.argv[i + 1])
+        elif arg == "--max-upstream" and i < len(sys.argv) - 1:
+            max_upstream = int(sys.argv[i + 1])
+        elif arg == "--idle-timeout" and i < len(sys.argv) - 1:
+            idle_timeout = float(sys.argv[i + 1])
+        elif arg == "--max-body" and i < len(sys.argv) - 1:
+            ProxyHandler.max_body = int(float(sys.argv[i + 1]) * (1 << 20))
+        elif arg == "--transform":
+            stages = sys.argv[i + 1] if i < len(sys.argv) - 1 and not sys.argv[i + 1].startswith("--") else "all"
+            stages = TRANSFORM_STAGES if stages == "all" else set(stages.split(","))
+            unknown = stages - TRANSFORM_STAGES
+            if unknown:
+                sys.exit(f"--transform: unknown stage(s) {', '.join(sorted(unknown))} "
+                         f"(choose from {', '.join(sorted(TRANSFORM_STAGES))}, or all)")
+            ProxyHandler.transforms = frozenset(stages)
+        elif arg == "--max-image-width" and i < len(sys.argv) - 1:
+            ProxyHandler.image_width = int(sys.argv[i + 1])
+        elif arg == "--image-bits" and i < len(sys.argv) - 1:
+            ProxyHandler.image_bits = min(max(int(sys.argv[i + 1]), 1), 8)
+        elif arg == "--prefetch-workers" and i < len(sys.argv) - 1:
+            prefetch_workers = int(sys.argv[i + 1])
+        elif arg == "--prefetch-budget" and i < len(sys.argv) - 1:
+            prefetch_budget = int(sys.argv[i + 1])
+        elif arg == "--prefetch-budget-mb" and i < len(sys.argv) - 1:
+            prefetch_budget_mb = float(sys.argv[i + 1])
+        elif arg == "--cache-dir" and i < len(sys.argv) - 1:
+            cache_dir = sys.argv[i + 1]
+        elif arg == "--cache-mb" and i < len(sys.argv) - 1:
+            cache_mb = float(sys.argv[i + 1])
+        elif arg == "--disk-cache-mb" and i < len(sys.argv) - 1:
+            disk_cache_mb = float(sys.argv[i + 1])
+    upstream_pool = ConnectionPool(per_host, max_upstream, idle_timeout)
+    if "--no-cache" not in sys.argv:
+        response_cache = ResponseCache(cache_dir if disk_cache_mb > 0 else None,
+                                       int(cache_mb * (1 << 20)), int(disk_cache_mb * (1 << 20)))
+    if "--prefetch" in sys.argv:
+        if response_cache is None:
+            sys.exit("--prefetch fetches into the cache; it cannot be used with --no-cache")
+        prefetcher = Prefetcher(response_cache, prefetch_workers, prefetch_budget,
+                                int(prefetch_budget_mb * (1 << 20)))
+
     print(f"=" * 50)
     print(f"TrustOS Web Proxy Server")
     print(f"=" * 50)
-    print(f"Listening on port {PORT}")
+    print(f"Listening on port {port}")
+    print(f"Upstream: {per_host} connections per site, {max_upstream} in flight, keep-alive")
+    if ProxyHandler.transforms:
+        print(f"Transform: {', '.join(sorted(ProxyHandler.transforms))}")
+        if 'images' in ProxyHandler.transforms and Image is None:
+            print(f"  (images passed through: Pillow is not installed, pip install Pillow)")
+    if response_cache is None:
+        print(f"Cache: off")
+    else:
+        where = f"{cache_dir}, {disk_cache_mb:g} MB on disk" if response_cache.directory else "memory only"
+        print(f"Cache: {cache_mb:g} MB in memory, {where} "
+              f"({len(response_cache.entries)} entries kept)")
+    if prefetcher is not None:
+        print(f"Prefetch: {prefetch_workers} workers, up to {prefetch_budget} resources / "
+              f"{prefetch_budget_mb:g} MB per page")
     print(f"")
     print(f"In TrustOS browser, use:")
-    print(f"  http://10.0.2.2:{PORT}/https://google.com")
-    print(f"  http://10.0.2.2:{PORT}/https://example.com")
+    print(f"  http://10.0.2.2:{port}/https://google.com")
+    print(f"  http://10.0.2.2:{port}/https://example.com")
     print(f"")
     print(f"Press Ctrl+C to stop")
     print(f"=" * 50)
-    
-    with http.server.HTTPServer(('0.0.0.0', PORT), ProxyHandler) as httpd:
+
+    with ThreadedProxyServer((host, port), ProxyHandler) as httpd:
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
@@ -0,0 +1,93 @@
+"""Helpers shared by the TrustOS benchmarks (tools/pkg-bench.py,
+tools/http-bench.py and server/proxy-bench.py): free localhost ports,
+server scripts run as subprocesses, one-shot GETs and PASS/FAIL checks.
+"""
+
+import http.client
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def fetch(host, port, path, headers=None, timeout=30, response=False):
+    """GET `path` on a new connection; returns (status, body), or
+    (response, body) with response=True."""
+    conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request("GET", path, headers=headers or {})
+        resp = conn.getresponse()
+        body = resp.read()
+        return resp if response else resp.status, body
+    finally:
+        conn.close()
+
+class Spawned:
+    """Run a server script as a subprocess until it answers a GET of `path`
+    on `port` (path=None: until the port accepts connections). With
+    cache_dir=True a throwaway --cache-dir is passed unless `cmd` names one,
+    and removed on exit."""
+
+    def __init__(self, cmd, port, path="/", timeout=60.0, stdout=subprocess.DEVNULL, cache_dir=False):
+        self.cmd = [sys.executable] + cmd
+        self.host = "127.0.0.1"
+        self.port = port
+        self.path = path
+        self.timeout = timeout
+        self.stdout = stdout
+        self.proc = None
+        self.tmp = None
+        if cache_dir and "--cache-dir" not in cmd:
+            self.tmp = tempfile.mkdtemp(prefix="bench-cache-")
+            self.cmd += ["--cache-dir", self.tmp]
+
+    def ready(self):
+        try:
+            if self.path is None:
+                socket.create_connection((self.host, self.port), timeout=5).close()
+            else:
+                fetch(self.host, self.port, self.path, timeout=5)
+            return True
+        except OSError:
+            return False
+
+    def __enter__(self):
+        self.proc = subprocess.Popen(self.cmd, stdout=self.stdout, stderr=subprocess.DEVNULL)
+        deadline = time.time() + self.timeout
+        while time.time() < deadline and self.proc.poll() is None:
+            if self.ready():
+                return self
+            time.sleep(0.05)
+        self.__exit__()
+        raise RuntimeError(f"server did not start: {' '.join(self.cmd)}")
+
+    def __exit__(self, *exc):
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        if self.tmp:
+            shutil.rmtree(self.tmp, ignore_errors=True)
+
+class Checks:
+    """check(label, ok) prints PASS/FAIL; exit() ends with status 1 if any failed."""
+
+    def __init__(self):
+        self.failures = []
+
+    def __call__(self, label, ok):
+        print(f"  {'PASS' if ok else 'FAIL'}  {label}")
+        if not ok:
+            self.failures.append(label)
+
+    def exit(self):
+        if self.failures:
+            print(f"{len(self.failures)} check(s) failed")
+            sys.exit(1)
@@ -0,0 +1,646 @@
+#!/usr/bin/env python3
+"""
+TrustOS HTTP Server Benchmark
+=============================
+One load generator for every server TrustOS VMs talk to:
+
+    server      server/server.py (simple and --production)
+    proxy       server/web_proxy.py in front of a local origin (cache on and off)
+    pkg         tools/pkg-server.py (single-threaded and --workers 8)
+    test        scripts/test/test_browser_server.py
+
+Each target is spawned on a free localhost port with generated fixtures and
+loaded endpoint by endpoint at every --concurrency level, with keep-alive on
+(persistent HTTP/1.1 connections, reopened when the server closes them) and
+off (a new connection and `Connection: close` per request, like the kernel
+client). Every run records p50/p95/p99 latency and throughput; --json writes
+them out so two runs can be compared.
+
+Usage:
+    python http-bench.py run [--targets server,proxy,pkg,test] [--concurrency 1,8,32]
+                             [--keepalive on,off] [--requests 400] [--json OUT]
+    python http-bench.py run --url http://HOST:PORT --endpoint [NAME=][POST:]PATH ...
+    python http-bench.py compare BASE.json NEW.json [--threshold 15] [--min-ms 1]
+    python http-bench.py shape [--resets 40] [--loads 5] [--seed 0]
+    python http-bench.py files [--size-mb 1024] [--clients 1,4,16]
+
+A target can be narrowed to one variant, e.g. --targets server:production,pkg.
+`compare` exits 1 when any endpoint lost more than --threshold percent of its
+throughput or gained as much p95/p99 latency (and at least --min-ms), so it
+can gate a change. The client shares the machine with the server under test:
+only compare runs made on the same box.
+"""
+
+import argparse
+import gzip
+import http.client
+import json
+import math
+import os
+import platform
+import socket
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+
+from benchutil import Checks, Spawned, fetch, free_port
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(SCRIPT_DIR)
+FILE_SERVER = os.path.join(ROOT_DIR, "server", "server.py")
+WEB_PROXY = os.path.join(ROOT_DIR, "server", "web_proxy.py")
+PKG_SERVER = os.path.join(SCRIPT_DIR, "pkg-server.py")
+TEST_SERVER = os.path.join(ROOT_DIR, "scripts", "test", "test_browser_server.py")
+
+RESULT_VERSION = 1
+
+# ─── Fixtures ────────────────────────────────────────────────────────────────
+# One directory serves the file servers, the proxy's origin and the browser
+# test server: a page, its stylesheet and image, and a 1 MB download. The
+# files are dated a day back so the proxy's heuristic freshness (a tenth of
+# the Last-Modified age) turns repeat requests into cache hits.
+
+def make_fixtures(root):
+    links = "".join(f'<p>Paragraph {i}: <a href="/page{i}.html">link {i}</a> '
+                    f'lorem ipsum dolor sit amet.</p>\n' for i in range(80))
+    files = {
+        "index.html": ('<!DOCTYPE html>\n<html><head><title>Bench</title>'
+                       '<link rel="stylesheet" href="/style.css"></head>\n'
+                       f'<body><h1>TrustOS</h1><img src="/logo.png">\n{links}'
+                       '<form method="POST" action="/submit"><input name="q"></form>'
+                       '</body></html>\n').encode(),
+        "style.css": b"".join(b".c%d { color: #%06x; margin: %dpx; }\n" % (i, i * 4099, i % 9)
+                              for i in range(60)),
+        "logo.png": os.urandom(32 << 10),
+        "big.bin": os.urandom(1 << 20),
+    }
+    day_ago = time.time() - 86400
+    for name, data in files.items():
+        path = os.path.join(root, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        os.utime(path, (day_ago, day_ago))
+
+# ─── Targets ─────────────────────────────────────────────────────────────────
+# A target variant is a generator: it starts whatever it needs, yields
+# (host, port, endpoints) and tears down when resumed. Endpoints are
+# (name, method, path, body) tuples.
+
+PAGE_ENDPOINTS = [("page", "GET", "/index.html", None),
+                  ("style", "GET", "/style.css", None),
+                  ("image", "GET", "/logo.png", None),
+                  ("large", "GET", "/big.bin", None)]
+
+def target_server(fixtures, flags):
+    port = free_port()
+    with Spawned([FILE_SERVER, "--port", str(port), "--dir", fixtures] + flags, port) as srv:
+        yield srv.host, srv.port, PAGE_ENDPOINTS
+
+def target_proxy(fixtures, flags):
+    origin_port, port = free_port(), free_port()
+    with tempfile.TemporaryDirectory(prefix="proxy-cache-") as cache, \
+            Spawned([FILE_SERVER, "--port", str(origin_port), "--dir", fixtures, "--production"],
+                    origin_port), \
+            Spawned([WEB_PROXY, "--host", "127.0.0.1", "--port", str(port),
+                     "--cache-dir", cache] + flags, port) as srv:
+        origin = f"/http://127.0.0.1:{origin_port}"
+        yield srv.host, srv.port, [(name, method, origin + path, body)
+                                   for name, method, path, body in PAGE_ENDPOINTS]
+
+def target_pkg(fixtures, flags):
+    port = free_port()
+    with Spawned([PKG_SERVER, "--host", "127.0.0.1", "--port", str(port), "--no-alpine"] + flags,
+                 port, path="/repo/index", cache_dir=True) as srv:
+        name = fetch(srv.host, srv.port, "/repo/index")[1].decode().split(" ", 1)[0]
+        yield srv.host, srv.port, [("index", "GET", "/repo/index", None),
+                                   ("package", "GET", f"/repo/pool/{name}.pkg", None),
+                                   ("search", "GET", "/repo/search?q=lib", None),
+                                   ("resolve", "GET", f"/repo/resolve?pkgs={name}", None)]
+
+def target_test(fixtures, flags):
+    port = free_port()
+    with Spawned([TEST_SERVER, "--port", str(port), "--dir", fixtures] + flags, port) as srv:
+        yield srv.host, srv.port, PAGE_ENDPOINTS[:3] + [
+            ("submit", "POST", "/submit", b"name=trustos&message=hello+from+the+bench")]
+
+TARGETS = {
+    "server": [("simple", target_server, []), ("production", target_server, ["--production"])],
+    "proxy": [("cache", target_proxy, []), ("no-cache", target_proxy, ["--no-cache"])],
+    "pkg": [("single", target_pkg, []), ("workers", target_pkg, ["--workers", "8"])],
+    "test": [("default", target_test, [])],
+}
+
+def select_targets(spec):
+    """"server,pkg:workers" -> [(target, variant, factory, flags)]."""
+    chosen = []
+    for item in spec:
+        name, _, variant = item.partition(":")
+        if name not in TARGETS:
+            sys.exit(f"unknown target {name!r} (choose from {', '.join(TARGETS)})")
+        variants = [v for v in TARGETS[name] if not variant or v[0] == variant]
+        if not variants:
+            sys.exit(f"unknown variant {item!r} (choose from "
+                     f"{', '.join(v[0] for v in TARGETS[name])})")
+        chosen += [(name,) + v for v in variants]
+    return chosen
+
+# ─── Load Generator ──────────────────────────────────────────────────────────
+
+class CountingConnection(http.client.HTTPConnection):
+    """HTTPConnection that counts the TCP connections it opens."""
+
+    def __init__(self, *args, counter, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counter = counter
+
+    def connect(self):
+        super().connect()
+        self.counter.append(1)
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of an ascending list."""
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+def run_level(host, port, endpoint, clients, total, keepalive):
+    """Issue `total` requests to one endpoint from `clients` threads."""
+    name, method, path, body = endpoint
+    counter = iter(range(total))
+    lock = threading.Lock()
+    latencies, errors, opened, received = [], [0], [], [0]
+    headers = {} if keepalive else {"Connection": "close"}
+    if body is not None:
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+    def client():
+        conn = None
+        mine, nbytes = [], 0
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                break
+            if conn is None:
+                conn = CountingConnection(host, port, timeout=30, counter=opened)
+            t0 = time.perf_counter()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+                if resp.status >= 400:
+                    raise RuntimeError(resp.status)
+                mine.append(time.perf_counter() - t0)
+                nbytes += len(data)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                conn.close()
+                conn = None
+                continue
+            if not keepalive:
+                conn.close()
+                conn = None
+        if conn is not None:
+            conn.close()
+        with lock:
+            latencies.extend(mine)
+            received[0] += nbytes
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    latencies.sort()
+    ms = lambda s: None if s is None else round(s * 1000, 3)
+    return {
+        "endpoint": name, "method": method, "path": path,
+        "concurrency": clients, "keepalive": keepalive,
+        "requests": total, "errors": errors[0], "connections": len(opened),
+        "seconds": round(elapsed, 4),
+        "rps": round(len(latencies) / elapsed, 1),
+        "mb_per_s": round(received[0] / elapsed / (1 << 20), 2),
+        "latency_ms": {"p50": ms(percentile(latencies, 50)), "p95": ms(percentile(latencies, 95)),
+                       "p99": ms(percentile(latencies, 99)), "max": ms(latencies[-1] if latencies else None),
+                       "mean": ms(sum(latencies) / len(latencies) if latencies else None)},
+    }
+
+def fmt_ms(value):
+    return "-" if value is None else f"{value:.1f}"
+
+def print_row(label, r):
+    lat = r["latency_ms"]
+    print(f"  {label:<18} {r['endpoint']:<8} {r['concurrency']:>4} {'on' if r['keepalive'] else 'off':>4}"
+          f" {r['rps']:>9.0f} {fmt_ms(lat['p50']):>8} {fmt_ms(lat['p95']):>8} {fmt_ms(lat['p99']):>8}"
+          f" {r['connections']:>6} {r['errors']:>6}")
+
+def bench_endpoints(label, host, port, endpoints, args, results, extra):
+    for endpoint in endpoints:
+        run_level(host, port, endpoint, 1, 5, True)     # warm caches and the proxy pool
+        for clients in args.concurrency:
+            for keepalive in args.keepalive:
+                r = run_level(host, port, endpoint, clients, args.requests, keepalive)
+                r.update(extra)
+                results.append(r)
+                print_row(label, r)
+
+# ─── Commands ────────────────────────────────────────────────────────────────
+
+def parse_endpoint(spec):
+    """"[NAME=][POST:]PATH" -> endpoint tuple."""
+    name, eq, rest = spec.partition("=")
+    if not eq or name.startswith("/"):
+        name, rest = "", spec
+    method, colon, path = rest.partition(":")
+    if not colon or method.upper() not in ("GET", "HEAD", "POST"):
+        method, path = "GET", rest
+    return (name or path, method.upper(), path, b"" if method.upper() == "POST" else None)
+
+def cmd_run(args):
+    results = []
+    print(f"{args.requests} requests per endpoint and level")
+    print(f"  {'target':<18} {'endpoint':<8} {'conc':>4} {'ka':>4} {'req/s':>9}"
+          f" {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'conns':>6} {'errors':>6}")
+    if args.url:
+        u = urlparse(args.url)
+        endpoints = [parse_endpoint(e) for e in args.endpoint or ["/"]]
+        bench_endpoints(u.netloc, u.hostname, u.port or 80, endpoints, args, results,
+                        {"target": "url", "variant": u.netloc})
+    else:
+        with tempfile.TemporaryDirectory(prefix="http-bench-") as fixtures:
+            make_fixtures(fixtures)
+            for name, variant, factory, flags in select_targets(args.targets):
+                run = factory(fixtures, flags)
+                host, port, endpoints = next(run)
+                try:
+                    bench_endpoints(f"{name}/{variant}", host, port, endpoints, args, results,
+                                    {"target": name, "variant": variant})
+                finally:
+                    run.close()
+    if args.json:
+        report = {
+            "version": RESULT_VERSION,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "machine": {"host": platform.node(), "cpus": os.cpu_count(),
+                        "python": platform.python_version()},
+            "settings": {"requests": args.requests, "concurrency": args.concurrency,
+                         "keepalive": args.keepalive},
+            "results": results,
+        }
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=1)
+        print(f"Wrote {len(results)} results to {args.json}")
+    failed = sum(r["errors"] for r in results)
+    if failed:
+        print(f"{failed} requests failed")
+
+def result_key(r):
+    return (r["target"], r["variant"], r["endpoint"], r["concurrency"], r["keepalive"])
+
+def cmd_compare(args):
+    runs = []
+    for path in (args.base, args.new):
+        with open(path) as f:
+            report = json.load(f)
+        if report.get("version") != RESULT_VERSION:
+            sys.exit(f"{path}: unsupported result version {report.get('version')}")
+        runs.append({result_key(r): r for r in report["results"]})
+    base, new = runs
+    limit = args.threshold / 100
+    regressions = 0
+    print(f"  {'target':<18} {'endpoint':<8} {'conc':>4} {'ka':>4} {'req/s':>16}"
+          f" {'p95 ms':>16} {'p99 ms':>16}")
+    for key in sorted(base.keys() & new.keys(), key=str):
+        b, n = base[key], new[key]
+        problems = []
+        if n["rps"] < b["rps"] * (1 - limit):
+            problems.append("req/s")
+        for p in ("p95", "p99"):
+            old, cur = b["latency_ms"][p], n["latency_ms"][p]
+            if old is not None and cur is not None and cur > old * (1 + limit) and cur - old >= args.min_ms:
+                problems.append(p)
+        if n["errors"] > b["errors"]:
+            problems.append("errors")
+        regressions += bool(problems)
+        label = f"{key[0]}/{key[1]}"
+        print(f"  {label:<18} {key[2]:<8} {key[3]:>4} {'on' if key[4] else 'off':>4}"
+              f" {b['rps']:>7.0f} → {n['rps']:<6.0f}"
+              f" {fmt_ms(b['latency_ms']['p95']):>7} → {fmt_ms(n['latency_ms']['p95']):<6}"
+              f" {fmt_ms(b['latency_ms']['p99']):>7} → {fmt_ms(n['latency_ms']['p99']):<6}"
+              f"{'  REGRESSION: ' + ', '.join(problems) if problems else ''}")
+    for key in sorted(base.keys() - new.keys(), key=str):
+        print(f"  (only in {args.base}: {' '.join(map(str, key))})")
+    for key in sorted(new.keys() - base.keys(), key=str):
+        print(f"  (only in {args.new}: {' '.join(map(str, key))})")
+    print(f"{regressions} regressions beyond {args.threshold:g}%")
+    if regressions:
+        sys.exit(1)
+
+# ─── Link Shaping ────────────────────────────────────────────────────────────
+# Checks of the test server's --shape rules (latency, per-connection rate
+# caps, fragmentation, resets and their seeded replay), then page loads the
+# way the kernel browser does them: the page, its stylesheet and image one
+# after another, Connection: close, up to 3 retries when a connection is
+# reset, under a few link profiles.
+
+SHAPE_PROFILES = [
+    ("localhost", None),
+    ("dsl", "rate=256,latency=20"),
+    ("3g", "rate=48,latency=150,jitter=50,chunk=536"),
+    ("lossy-3g", "rate=48,latency=150,jitter=50,chunk=536,reset=0.1"),
+]
+
+def raw_get(host, port, path):
+    """HTTP/1.0 GET reading with recv(); returns (complete, body, recv calls,
+    seconds). `complete` is False when the connection was reset or the body
+    came up short of its Content-Length."""
+    t0 = time.perf_counter()
+    data, recvs = bytearray(), 0
+    with socket.create_connection((host, port), timeout=30) as sock:
+        sock.sendall(f"GET {path} HTTP/1.0\r\nHost: bench\r\nConnection: close\r\n\r\n".encode())
+        try:
+            while True:
+                piece = sock.recv(65536)
+                if not piece:
+                    break
+                data += piece
+                recvs += 1
+        except ConnectionResetError:
+            pass
+    head, end, body = bytes(data).partition(b"\r\n\r\n")
+    length = None
+    for line in head.split(b"\r\n")[1:] if end else ():   # cut inside the head
+        key, _, value = line.partition(b":")
+        if key.strip().lower() == b"content-length":
+            length = int(value)
+    complete = head.startswith(b"HTTP/") and length is not None and len(body) == length
+    return complete, body, recvs, time.perf_counter() - t0
+
+def shaped_server(fixtures, rules, seed=0):
+    port = free_port()
+    cmd = [TEST_SERVER, "--port", str(port), "--dir", fixtures, "--seed", str(seed)]
+    for rule in rules:
+        cmd += ["--shape", rule]
+    return Spawned(cmd, port, path="/__shape")
+
+def shape_stats(srv):
+    stats = json.loads(fetch(srv.host, srv.port, "/__shape", timeout=10)[1])
+    return {r["path"]: r for r in stats["rules"]}
+
+def reset_pattern(fixtures, seed, n):
+    with shaped_server(fixtures, ["/flaky.bin:reset=0.5"], seed) as srv:
+        outcomes = [raw_get(srv.host, srv.port, "/flaky.bin")[0] for _ in range(n)]
+        return outcomes, shape_stats(srv)["/flaky.bin"]
+
+def kernel_load(srv, paths, retries=3):
+    """Serial fetches with retries; returns (seconds, retries used, failed)."""
+    t0 = time.perf_counter()
+    used = failed = 0
+    for path in paths:
+        for attempt in range(retries + 1):
+            if raw_get(srv.host, srv.port, path)[0]:
+                break
+            if attempt == retries:
+                failed += 1
+            else:
+                used += 1
+    return time.perf_counter() - t0, used, failed
+
+def cmd_shape(args):
+    check = Checks()
+    with tempfile.TemporaryDirectory(prefix="http-bench-") as fixtures:
+        make_fixtures(fixtures)
+        for name in ("frag.bin", "flaky.bin", "dead.bin"):
+            with open(os.path.join(fixtures, name), "wb") as f:
+                f.write(os.urandom(16 << 10))
+        os.mkdir(os.path.join(fixtures, "short"))
+        with open(os.path.join(fixtures, "short", "a.txt"), "wb") as f:
+            f.write(b"x")
+
+        print("Shaping rules")
+        rules = ["/index.html:latency=300", "/logo.png:rate=16", "/frag.bin:rate=32,chunk=512",
+                 "/dead.bin:reset=1", "/short/:reset=1",
+                 "/__shape/*:reset=1"]
+        with shaped_server(fixtures, rules) as srv:
+            ok, _, _, t = raw_get(srv.host, srv.port, "/style.css")
+            check(f"unshaped path served at full speed ({t * 1000:.1f} ms)", ok and t < 0.1)
+            ok, _, _, t = raw_get(srv.host, srv.port, "/index.html")
+            check(f"latency=300 delays the response ({t * 1000:.0f} ms)", ok and 0.3 <= t < 0.5)
+            ok, body, _, t = raw_get(srv.host, srv.port, "/logo.png")
+            check(f"rate=16 sends 32 KB in ~2 s ({t:.2f} s)", ok and len(body) == 32 << 10 and 1.8 <= t < 2.6)
+            times = []
+            threads = [threading.Thread(target=lambda: times.append(raw_get(srv.host, srv.port, "/logo.png")[3]))
+                       for _ in range(3)]
+            for th in threads:
+                th.start()
+            for th in threads:
+                th.join()
+            check(f"the cap is per connection: 3 at once take {max(times):.2f} s, not ~6 s",
+                  len(times) == 3 and max(times) < 2.6)
+            ok, body, recvs, t = raw_get(srv.host, srv.port, "/frag.bin")
+            check(f"chunk=512 arrives in pieces ({recvs} recv() calls for 16 KB)", ok and recvs >= 16)
+            outcomes = [raw_get(srv.host, srv.port, "/dead.bin") for _ in range(5)]
+            check("reset=1 resets every response", not any(ok for ok, *_ in outcomes))
+            stats = shape_stats(srv)
+            check(f"/__shape counts requests and resets ({stats['/dead.bin']['resets']} resets)",
+                  stats["/dead.bin"]["requests"] == 5 and stats["/dead.bin"]["resets"] == 5
+                  and stats["/logo.png"]["requests"] == 4 and stats["/logo.png"]["resets"] == 0
+                  and stats["/logo.png"]["bytes"] > 4 * (32 << 10))
+            ok, body, _, _ = raw_get(srv.host, srv.port, "/__shape?fmt=json")
+            check("/__shape with a query string still answers with the counters",
+                  ok and b'"rules"' in body)
+            ok, _, _, _ = raw_get(srv.host, srv.port, "/__shape/x")
+            check("paths under /__shape/ are shaped like any other", not ok)
+            # A listing's size is guessed, so its cut point can land past the end
+            whole = [raw_get(srv.host, srv.port, "/short/")[0] for _ in range(20)]
+            resets = shape_stats(srv)["/short/"]["resets"]
+            check(f"only responses actually cut count as resets ({resets} of 20, "
+                  f"{whole.count(True)} came through whole)", resets == whole.count(False) and any(whole))
+
+        first, stats = reset_pattern(fixtures, 7, args.resets)
+        again, _ = reset_pattern(fixtures, 7, args.resets)
+        other, _ = reset_pattern(fixtures, 8, args.resets)
+        broken = first.count(False)
+        check(f"reset=0.5 breaks {broken} of {args.resets} responses",
+              0.25 * args.resets <= broken <= 0.75 * args.resets and stats["resets"] == broken)
+        check("the same --seed replays the same resets", first == again)
+        check("another --seed gives other resets", first != other)
+
+        print(f"Kernel-style page loads (page, stylesheet, image; serial; 3 retries), "
+              f"{args.loads} loads, seed {args.seed}")
+        print(f"  {'profile':<10} {'mean ms':>9} {'max ms':>9} {'retries':>8} {'failed':>7}")
+        paths = ["/index.html", "/style.css", "/logo.png"]
+        for label, rule in SHAPE_PROFILES:
+            with shaped_server(fixtures, [rule] if rule else [], args.seed) as srv:
+                runs = [kernel_load(srv, paths) for _ in range(args.loads)]
+            seconds = [r[0] for r in runs]
+            print(f"  {label:<10} {sum(seconds) / len(seconds) * 1000:>9.0f} {max(seconds) * 1000:>9.0f}"
+                  f" {sum(r[1] for r in runs):>8} {sum(r[2] for r in runs):>7}")
+    check.exit()
+
+# ─── Large File Downloads ────────────────────────────────────────────────────
+# server/server.py serving one ISO-sized file to N concurrent clients, in
+# its default mode (SimpleHTTPRequestHandler, one connection at a time) and
+# with --production (threaded, sendfile). Reports aggregate throughput, the
+# longest any client waited for its first byte, and the server's CPU time
+# per GB sent (from /proc/<pid>/stat). The file is
+# sparse, so it comes from the page cache and the disk is not measured.
+# First, checks of --production's headers against files changed behind the
+# index's back and Accept-Encoding q-values.
+
+def download(host, port, path, buf):
+    """GET `path` over a raw socket; return (body bytes, seconds to first byte)."""
+    t0 = time.perf_counter()
+    ttfb = None
+    with socket.create_connection((host, port)) as s:
+        s.sendall(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+        received = 0
+        head = b""
+        while True:
+            n = s.recv_into(buf)
+            if not n:
+                return received, ttfb
+            if ttfb is None:
+                ttfb = time.perf_counter() - t0
+            if head is not None:
+                head += bytes(buf[:n])
+                if b"\r\n\r\n" in head:
+                    received = len(head) - head.index(b"\r\n\r\n") - 4
+                    head = None
+            else:
+                received += n
+
+def cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def file_checks(check):
+    with tempfile.TemporaryDirectory(prefix="http-bench-") as tmp:
+        page = os.path.join(tmp, "page.html")
+        with open(page, "wb") as f:
+            f.write(b"<p>first</p>\n" * 100)
+        with open(page + ".gz", "wb") as f:
+            f.write(gzip.compress(b"<p>first</p>\n" * 100))
+        port = free_port()
+        with Spawned([FILE_SERVER, "--port", str(port), "--dir", tmp, "--production",
+                      "--rescan", "3600"], port) as srv:
+            def get(headers):
+                return fetch(srv.host, srv.port, "/page.html", headers, response=True)
+
+            resp, _ = get({"Accept-Encoding": "gzip"})
+            check("gzip is served the .gz sibling", resp.getheader("Content-Encoding") == "gzip")
+            for accept in ("gzip;q=0", "identity", "br, *;q=0"):
+                resp, _ = get({"Accept-Encoding": accept})
+                check(f"Accept-Encoding: {accept} gets the plain file",
+                      resp.getheader("Content-Encoding") is None)
+            resp, _ = get({"Accept-Encoding": "deflate, *;q=0.5"})
+            check("*;q=0.5 covers gzip", resp.getheader("Content-Encoding") == "gzip")
+
+            old_etag = get({})[0].getheader("ETag")
+            with open(page, "wb") as f:
+                f.write(b"<p>rewritten, and longer</p>\n" * 300)
+            new_size = os.path.getsize(page)
+            ok, body, _, _ = raw_get(srv.host, srv.port, "/page.html")
+            check("a file rewritten between rescans is sent whole with its new length",
+                  ok and len(body) == new_size)
+            resp, _ = get({"If-None-Match": old_etag})
+            check("... and the old ETag no longer matches", resp.status == 200)
+            resp, body = get({"Range": f"bytes={new_size - 10}-"})
+            check("... and Range is resolved against the new size",
+                  resp.status == 206 and len(body) == 10
+                  and resp.getheader("Content-Range") == f"bytes {new_size - 10}-{new_size - 1}/{new_size}")
+            with open(page, "wb") as f:
+                f.write(b"short\n")
+            ok, body, _, _ = raw_get(srv.host, srv.port, "/page.html")
+            check("a truncated file is not announced at its old length", ok and body == b"short\n")
+
+def cmd_files(args):
+    check = Checks()
+    print("server/server.py --production headers")
+    file_checks(check)
+    size = args.size_mb << 20
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "trustos.iso"), "wb") as f:
+            f.truncate(size)
+        print(f"Concurrent downloads of a {args.size_mb} MB file from server/server.py")
+        print(f"  {'mode':<12} {'clients':>7} {'MB/s':>8} {'max TTFB ms':>12} {'server CPU s/GB':>16}")
+        for label, flags in (("simple", []), ("production", ["--production"])):
+            port = free_port()
+            with Spawned([FILE_SERVER, "--port", str(port), "--dir", tmp] + flags, port) as srv:
+                for clients in args.clients:
+                    got = []
+                    cpu0 = cpu_seconds(srv.proc.pid)
+                    t0 = time.perf_counter()
+                    threads = [threading.Thread(target=lambda: got.append(
+                        download(srv.host, srv.port, "/trustos.iso", bytearray(1 << 20))))
+                        for _ in range(clients)]
+                    for t in threads:
+                        t.start()
+                    for t in threads:
+                        t.join()
+                    elapsed = time.perf_counter() - t0
+                    cpu = cpu_seconds(srv.proc.pid) - cpu0
+                    ok = "" if [n for n, _ in got] == [size] * clients else f"  (short: {got})"
+                    print(f"  {label:<12} {clients:>7} {size * clients / elapsed / (1 << 20):>8.0f}"
+                          f" {max(t for _, t in got) * 1000:>12.0f}"
+                          f" {cpu / (size * clients / (1 << 30)):>16.3f}{ok}")
+    check.exit()
+
+# ─── CLI ─────────────────────────────────────────────────────────────────────
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+def keepalive_list(value):
+    modes = {"on": True, "off": False}
+    try:
+        return [modes[v] for v in value.split(",") if v]
+    except KeyError:
+        raise argparse.ArgumentTypeError("expected on, off or on,off")
+
+def main():
+    parser = argparse.ArgumentParser(description="TrustOS HTTP server benchmark")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("run", help="load every endpoint of the chosen servers")
+    p.add_argument("--targets", type=lambda v: [t for t in v.split(",") if t], default=list(TARGETS),
+                   help=f"targets or target:variant, comma-separated (default: {','.join(TARGETS)})")
+    p.add_argument("--concurrency", type=int_list, default=[1, 8, 32])
+    p.add_argument("--keepalive", type=keepalive_list, default=[True, False])
+    p.add_argument("--requests", type=int, default=400, help="requests per endpoint and level")
+    p.add_argument("--json", help="write the results to this file")
+    p.add_argument("--url", help="benchmark an already running server instead")
+    p.add_argument("--endpoint", action="append",
+                   help="[NAME=][POST:]PATH to load with --url, repeatable (default: /)")
+    p.set_defaults(func=cmd_run)
+
+    p = sub.add_parser("compare", help="flag regressions between two --json runs")
+    p.add_argument("base")
+    p.add_argument("new")
+    p.add_argument("--threshold", type=float, default=15.0, help="allowed change in percent")
+    p.add_argument("--min-ms", type=float, default=1.0,
+                   help="ignore latency increases smaller than this")
+    p.set_defaults(func=cmd_compare)
+
+    p = sub.add_parser("shape", help="test server link shaping checks and shaped page loads")
+    p.add_argument("--resets", type=int, default=40, help="requests in the seeded reset checks")
+    p.add_argument("--loads", type=int, default=5, help="page loads per link profile")
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=cmd_shape)
+
+    p = sub.add_parser("files", help="server/server.py header checks and large-file download throughput")
+    p.add_argument("--size-mb", type=int, default=1024)
+    p.add_argument("--clients", type=int_list, default=[1, 4, 16])
+    p.set_defaults(func=cmd_files)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""HTTP header helpers shared by tools/pkg-server.py and server/server.py.
+
+Kept stdlib-only and free of server state so either script can import it
+from a plain checkout.
+"""
+
+def negotiate_encoding(accept, codings=("gzip", "deflate")):
+    """Pick the best of `codings` from an Accept-Encoding header, or None.
+    Honours q-values, so "gzip;q=0" refuses gzip and "*" covers codings the
+    header doesn't name; ties go to the earlier entry in `codings`."""
+    q = {}
+    for part in accept.split(","):
+        coding, _, params = part.strip().partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        q[coding.strip().lower()] = weight
+    best = None
+    for coding in codings:
+        weight = q.get(coding, q.get("*", 0.0))
+        if weight > 0 and (best is None or weight > q.get(best, q.get("*", 0.0))):
+            best = coding
+    return best
+
+def parse_range(header, length):
+    """Parse a single-range "bytes=..." header against a body of `length`.
+    Returns (start, end_exclusive), None to ignore the header (malformed or
+    multi-range; a full 200 is then correct), or "unsatisfiable"."""
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    if not dash:
+        return None
+    try:
+        if not first:                      # bytes=-N: final N bytes
+            n = int(last)
+            if n <= 0:
+                return "unsatisfiable"
+            return max(length - n, 0), length
+        start = int(first)
+        end = int(last) + 1 if last else length
+    except ValueError:
+        return None
+    if start >= length or end <= start:
+        return "unsatisfiable"
+    return start, min(end, length)
@@ -0,0 +1,1158 @@
+#!/usr/bin/env python3
+"""
+TrustOS Package Server Benchmarks
+=================================
+Load tests for tools/pkg-server.py, run against localhost.
+
+Usage:
+    python pkg-bench.py load [--clients 1,16,128] [--requests 2000]
+                             [--server "--workers 32"] [--url URL]
+    python pkg-bench.py keepalive [--packages 20] [--rounds 50] [--rtt MS]
+    python pkg-bench.py idle [--idle 8] [--workers 2] [--idle-timeout 5]
+    python pkg-bench.py search [--alpine 20000] [--apkindex APKINDEX.tar.gz]
+    python pkg-bench.py coldstart [--alpine 20000] [--mirror-ms 1500]
+    python pkg-bench.py parse [--alpine 20000] [--apkindex APKINDEX.tar.gz]
+    python pkg-bench.py compress [--rounds 200]
+    python pkg-bench.py catalog [--packages 50000]
+    python pkg-bench.py roundtrip
+    python pkg-bench.py blobs [--packages 400] [--shared 40] [--disk-cap-kb 512]
+    python pkg-bench.py logging [--clients 16] [--requests 4000] [--line-us 1000]
+    python pkg-bench.py proxy [--stampede 50] [--mirror-ms 300]
+    python pkg-bench.py stampede [--clients 100] [--build-ms 50]
+
+By default each --server configuration is spawned on a free port with
+--no-alpine, benchmarked, and stopped. With --url an already running server
+is used instead.
+"""
+
+import argparse
+import atexit
+import functools
+import gzip
+import hashlib
+import http.client
+import http.server
+import importlib.util
+import io
+import json
+import os
+import random
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+
+from benchutil import Checks, Spawned, fetch, free_port
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PKG_SERVER = os.path.join(SCRIPT_DIR, "pkg-server.py")
+
+def load_pkg_server():
+    """Import pkg-server.py as a module (its name is not a valid identifier),
+    with its caches in a temporary directory instead of tools/.pkg-cache."""
+    spec = importlib.util.spec_from_file_location("pkg_server", PKG_SERVER)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    cache = tempfile.mkdtemp(prefix="pkg-cache-")
+    atexit.register(shutil.rmtree, cache, ignore_errors=True)
+    mod.CACHE_DIR = cache
+    mod.alpine_index.cache_path = os.path.join(cache, "alpine-index.pickle")
+    mod.blob_store.directory = os.path.join(cache, "blobs")
+    return mod
+
+# ─── Server Management ───────────────────────────────────────────────────────
+
+class SpawnedServer(Spawned):
+    """Run pkg-server.py as a subprocess on a free localhost port, with its
+    caches in a throwaway --cache-dir unless `args` names one."""
+
+    def __init__(self, args, alpine=False, stdout=subprocess.DEVNULL):
+        port = free_port()
+        super().__init__([PKG_SERVER, "--host", "127.0.0.1", "--port", str(port)] + shlex.split(args)
+                         + ([] if alpine else ["--no-alpine"]),
+                         port, path="/repo", timeout=30.0, stdout=stdout, cache_dir=True)
+
+# ─── Load Generator ──────────────────────────────────────────────────────────
+
+def package_paths(host, port):
+    """Request mix: the index plus every package bundle it lists."""
+    status, body = fetch(host, port, "/repo/index")
+    if status != 200:
+        raise RuntimeError(f"/repo/index returned {status}")
+    names = [line.split(" ", 1)[0] for line in body.decode().splitlines() if line]
+    return ["/repo/index"] + [f"/repo/pool/{n}.pkg" for n in names]
+
+def run_load(host, port, paths, clients, total):
+    """Issue `total` requests from `clients` threads; return (req/s, errors)."""
+    counter = iter(range(total))
+    lock = threading.Lock()
+    errors = [0]
+
+    def client():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            try:
+                status, _ = fetch(host, port, paths[i % len(paths)])
+                if status != 200:
+                    raise RuntimeError(status)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    return total / elapsed, errors[0]
+
+def bench_load(host, port, label, args):
+    paths = package_paths(host, port)
+    for clients in args.clients:
+        rps, errors = run_load(host, port, paths, clients, args.requests)
+        print(f"  {label:<28} {clients:>5} clients  {rps:>9.0f} req/s  {errors} errors")
+
+def cmd_load(args):
+    print(f"Load test: {args.requests} requests per level")
+    if args.url:
+        u = urlparse(args.url)
+        bench_load(u.hostname, u.port or 80, u.netloc, args)
+        return
+    for server_args in args.server:
+        with SpawnedServer(server_args) as srv:
+            bench_load(srv.host, srv.port, server_args or "(single-threaded)", args)
+
+# ─── Keep-Alive ──────────────────────────────────────────────────────────────
+# A 20-package install fetched three ways: a new connection per package
+# (Connection: close, what the kernel client does today), one persistent
+# connection, and all requests pipelined on one connection. --rtt adds a
+# simulated round trip to every TCP handshake to approximate a slirp link.
+
+def read_response(f):
+    """Read one HTTP/1.1 response from a buffered socket file."""
+    status = int(f.readline().split()[1])
+    length = 0
+    while True:
+        line = f.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        if key.strip().lower() == "content-length":
+            length = int(value.strip())
+    return status, f.read(length)
+
+def request_bytes(path, close=False):
+    conn = "close" if close else "keep-alive"
+    return f"GET {path} HTTP/1.1\r\nHost: bench\r\nConnection: {conn}\r\n\r\n".encode()
+
+def connect(host, port, rtt):
+    if rtt:
+        time.sleep(rtt)
+    return socket.create_connection((host, port))
+
+def install_close(host, port, paths, rtt):
+    for path in paths:
+        with connect(host, port, rtt) as sock:
+            sock.sendall(request_bytes(path, close=True))
+            read_response(sock.makefile("rb"))
+
+def install_keepalive(host, port, paths, rtt):
+    with connect(host, port, rtt) as sock:
+        f = sock.makefile("rb")
+        for path in paths:
+            sock.sendall(request_bytes(path))
+            read_response(f)
+
+def install_pipelined(host, port, paths, rtt):
+    with connect(host, port, rtt) as sock:
+        f = sock.makefile("rb")
+        sock.sendall(b"".join(request_bytes(p) for p in paths))
+        for _ in paths:
+            read_response(f)
+
+def cmd_keepalive(args):
+    with SpawnedServer("--workers 8") as srv:
+        paths = package_paths(srv.host, srv.port)[1:args.packages + 1]
+        rtt = args.rtt / 1000.0
+        print(f"{len(paths)}-package install, {args.rounds} rounds, simulated handshake RTT {args.rtt} ms")
+        for label, fn in (("close per package", install_close),
+                          ("keep-alive", install_keepalive),
+                          ("keep-alive + pipelining", install_pipelined)):
+            t0 = time.perf_counter()
+            for _ in range(args.rounds):
+                fn(srv.host, srv.port, paths, rtt)
+            ms = (time.perf_counter() - t0) * 1000 / args.rounds
+            print(f"  {label:<26} {ms:>8.2f} ms/install")
+
+# ─── Idle Connections ────────────────────────────────────────────────────────
+# More VMs holding idle keep-alive connections than the server has workers
+# (by default as many as its --max-conns cap), then new clients: they must be
+# answered right away, not after the idle ones time out.
+
+def cmd_idle(args):
+    check = Checks()
+
+    flags = f"--workers {args.workers} --idle-timeout {args.idle_timeout}"
+    print(f"{args.idle} idle keep-alive connections against {flags}")
+    with SpawnedServer(flags) as srv:
+        idle = []
+        for _ in range(args.idle):
+            conn = http.client.HTTPConnection(srv.host, srv.port, timeout=30)
+            conn.request("GET", "/repo/index")
+            conn.getresponse().read()
+            idle.append(conn)
+        times = []
+        for path in ("/repo/index", "/repo/search?q=lib", "/metrics"):
+            t0 = time.perf_counter()
+            status, body = fetch(srv.host, srv.port, path)
+            times.append(time.perf_counter() - t0)
+        check(f"new clients are served while they idle (slowest {max(times) * 1000:.1f} ms)",
+              max(times) < args.idle_timeout / 2)
+        gauges = dict(line.split(" ", 1) for line in body.decode().splitlines()
+                      if line.startswith("pkg_") and "{" not in line)
+        check(f"idle connections hold no worker ({gauges.get('pkg_workers_busy')} busy, "
+              f"the /metrics request itself)", gauges.get("pkg_workers_busy") == "1")
+        reused = 0
+        for conn in idle:
+            try:
+                conn.request("GET", "/repo/index")
+                conn.getresponse().read()
+                reused += 1
+            except (http.client.HTTPException, OSError):
+                pass
+            conn.close()
+        closed = int(gauges.get("pkg_idle_closed_total", 0))
+        check(f"only the longest idle were closed to make room ({closed} closed, {reused} reused)",
+              reused >= args.idle - len(times) and reused + closed >= args.idle - 1)
+    check.exit()
+
+# ─── Search ──────────────────────────────────────────────────────────────────
+# SearchIndex.query against the linear scan it replaced, on the local catalog
+# merged with a synthetic (or recorded) Alpine index.
+
+_WORDS = ["net", "ssl", "xml", "http", "json", "gtk", "qt", "font", "sound", "image",
+          "crypto", "regex", "yaml", "sql", "mail", "dns", "usb", "pci", "tls", "zip"]
+
+def synthetic_alpine(n, seed=0):
+    rng = random.Random(seed)
+    pkgs = {}
+    while len(pkgs) < n:
+        a, b = rng.sample(_WORDS, 2)
+        name = rng.choice(["", "lib", "py3-", "perl-", "lua-"]) + a + b + str(rng.randrange(1000)) \
+            + rng.choice(["", "", "-dev", "-doc", "-libs"])
+        pkgs[name] = {"version": f"{rng.randrange(10)}.{rng.randrange(50)}-r0",
+                      "description": f"{a} {b} support library for {rng.choice(_WORDS)}",
+                      "depends": [], "size": rng.randrange(1 << 20)}
+    return pkgs
+
+def linear_search(srv, keyword):
+    """The /repo/search implementation before the inverted index."""
+    results = []
+    kw = keyword.lower()
+    for name, pkg in sorted(srv.PACKAGES.items()):
+        if kw in name.lower() or kw in pkg.description.lower():
+            deps = ",".join(pkg.depends) if pkg.depends else "none"
+            results.append(f"{name} {pkg.version} {pkg.size_kb} x86_64 {pkg.n_files} {deps} {pkg.description}")
+    alpine = []
+    for aname, ainfo in srv.alpine_index.packages.items():
+        if kw in aname.lower() or kw in ainfo.get('description', '').lower():
+            alpine.append((aname, ainfo))
+            if len(alpine) >= 100:
+                break
+    for aname, ainfo in alpine:
+        if not any(r.startswith(f"{aname} ") for r in results):
+            size_kb = max(ainfo['size'] // 1024, 1)
+            results.append(f"{aname} {ainfo['version']} {size_kb} x86_64 1 none {ainfo['description']}")
+    return results[:200]
+
+def time_us(fn, rounds):
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - t0) * 1e6 / rounds
+
+def cmd_search(args):
+    srv = load_pkg_server()
+    if args.apkindex:
+        with open(args.apkindex, "rb") as f:
+            srv.alpine_index.packages = srv.alpine_index._parse_tar(f)
+    else:
+        srv.alpine_index.packages = synthetic_alpine(args.alpine)
+    srv.alpine_index.loaded = True
+    srv.search_index.build()
+    total = len(srv.search_index.lines)
+    print(f"Search over {total} packages ({len(srv.PACKAGES)} local), {args.rounds} rounds per query")
+    print(f"  {'query':<12} {'linear us':>10} {'index us':>10} {'speedup':>8} {'hits':>5}")
+    for q in args.queries:
+        lin = time_us(lambda: linear_search(srv, q), max(args.rounds // 20, 1))
+        idx = time_us(lambda: srv.search_index.query(q), args.rounds)
+        hits = len(srv.search_index.query(q))
+        print(f"  {q:<12} {lin:>10.0f} {idx:>10.1f} {lin / idx:>7.0f}x {hits:>5}")
+
+# ─── Cold Start ──────────────────────────────────────────────────────────────
+# Serves a synthetic APKINDEX.tar.gz from a local directory standing in for
+# the Alpine mirror, then times how long pkg-server takes until the whole
+# catalog is searchable: first run (download + parse), second run (on-disk
+# cache, followed by a conditional refresh that must come back 304), and
+# --offline with the mirror gone. --mirror-ms delays each index response to
+# approximate fetching a few MB from the real CDN.
+
+def apkindex_text(packages):
+    """APKINDEX records with the full set of fields Alpine publishes, so the
+    fixture has a realistic size per package."""
+    out = []
+    for name, info in packages.items():
+        digest = hashlib.sha1(name.encode()).hexdigest()
+        out.append(f"C:Q1{digest[:27]}=\nP:{name}\nV:{info['version']}\nA:x86_64\n"
+                   f"S:{info['size']}\nI:{info['size'] * 3}\nT:{info['description']}\n"
+                   f"U:https://example.org/{name}\nL:MIT\no:{name}\n"
+                   f"m:Alpine Maintainer <maint@alpinelinux.org>\nt:1700000000\nc:{digest}\n"
+                   f"D:{' '.join(info['depends'])} so:libc.musl-x86_64.so.1\n"
+                   f"p:cmd:{name}={info['version']}\n\n")
+    return "".join(out).encode()
+
+def write_apkindex(path, packages):
+    """Write packages as an APKINDEX.tar.gz the way Alpine publishes it."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    body = apkindex_text(packages)
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        info = tarfile.TarInfo("APKINDEX")
+        info.size = len(body)
+        tar.addfile(info, io.BytesIO(body))
+    with open(path, "wb") as f:
+        f.write(buf.getvalue())
+
+class FixtureMirror:
+    """Local HTTP server standing in for ALPINE_MIRROR; records status codes."""
+
+    def __init__(self, root, delay=0.0):
+        self.statuses = []
+        self.paths = []
+        mirror = self
+
+        class Handler(http.server.SimpleHTTPRequestHandler):
+            def send_head(self):
+                if delay and "If-Modified-Since" not in self.headers:
+                    time.sleep(delay)
+                return super().send_head()
+
+            def log_request(self, code="-", size="-"):
+                mirror.statuses.append(int(code))
+                mirror.paths.append(self.path)
+
+        self.httpd = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), functools.partial(Handler, directory=root))
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def time_until_searchable(args, probe, timeout=120.0):
+    """Spawn pkg-server; return (seconds until /repo/search finds `probe`, server)."""
+    t0 = time.perf_counter()
+    srv = SpawnedServer(args, alpine=True).__enter__()
+    while time.perf_counter() - t0 < timeout:
+        _, body = fetch(srv.host, srv.port, f"/repo/search?q={probe}")
+        if body.startswith(probe.encode() + b" "):
+            return time.perf_counter() - t0, srv
+        time.sleep(0.01)
+    srv.__exit__()
+    raise RuntimeError("catalog never became searchable")
+
+def cmd_coldstart(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, "mirror")
+        main_pkgs = synthetic_alpine(args.alpine, seed=1)
+        community = synthetic_alpine(args.alpine // 4, seed=2)
+        write_apkindex(os.path.join(root, "main/x86_64/APKINDEX.tar.gz"), main_pkgs)
+        write_apkindex(os.path.join(root, "community/x86_64/APKINDEX.tar.gz"), community)
+        probe = sorted(community)[-1]
+        cache = os.path.join(tmp, "cache")
+        print(f"Time until searchable, {len(set(main_pkgs) | set(community))}-package fixture mirror, "
+              f"{args.mirror_ms} ms per index download")
+
+        with FixtureMirror(root, args.mirror_ms / 1000.0) as mirror:
+            server_args = f"--mirror {mirror.url} --cache-dir {cache}"
+            cold, srv = time_until_searchable(server_args, probe)
+            srv.__exit__()
+            print(f"  {'no cache (download + parse)':<30} {cold * 1000:>8.0f} ms")
+
+            del mirror.statuses[:]
+            warm, srv = time_until_searchable(server_args, probe)
+            deadline = time.time() + 30
+            while len(mirror.statuses) < 2 and time.time() < deadline:
+                time.sleep(0.05)
+            srv.__exit__()
+            print(f"  {'on-disk cache':<30} {warm * 1000:>8.0f} ms")
+            print(f"  background refresh: {mirror.statuses} (304 = not re-downloaded)")
+
+        offline, srv = time_until_searchable(f"--offline --mirror {mirror.url} --cache-dir {cache}", probe)
+        srv.__exit__()
+        print(f"  {'--offline, mirror down':<30} {offline * 1000:>8.0f} ms")
+
+# ─── APKINDEX Parsing ───────────────────────────────────────────────────────
+# Streaming parser vs the buffer-everything parser it replaced. Each variant
+# runs in a fresh child process so peak RSS is measured in isolation (needs
+# Linux /proc). Peak growth includes the resulting package table itself.
+
+def legacy_parse(data):
+    """The pre-streaming AlpineIndex._parse_tar + _parse_apkindex."""
+    packages = {}
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tar:
+        for member in tar.getmembers():
+            if member.name == 'APKINDEX':
+                content = tar.extractfile(member).read().decode('utf-8', errors='replace')
+                current = {}
+                for line in content.split('\n'):
+                    if not line:
+                        if 'P' in current:
+                            deps = [d.split('=')[0].split('>')[0].split('<')[0].split('~')[0]
+                                    for d in current.get('D', '').split()]
+                            deps = [d for d in deps if d and not d.startswith(('so:', 'cmd:', 'pc:'))]
+                            packages[current['P']] = {
+                                'version': current.get('V', '0'),
+                                'description': current.get('T', current['P']),
+                                'depends': deps[:5],
+                                'size': int(current.get('S', '0')),
+                            }
+                        current = {}
+                    elif ':' in line:
+                        key, _, value = line.partition(':')
+                        current[key] = value
+    return packages
+
+def proc_status_kb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return 0
+
+def parse_child(variant, path):
+    srv = load_pkg_server()
+    before = reset_peak_rss()
+    t0 = time.perf_counter()
+    with open(path, "rb") as f:
+        if variant == "legacy":
+            packages = legacy_parse(f.read())
+        else:
+            packages = srv.alpine_index._parse_tar(f)
+    ms = (time.perf_counter() - t0) * 1000
+    peak = proc_status_kb("VmHWM")
+    print(json.dumps({"ms": ms, "rss_kb": peak - before, "packages": len(packages)}))
+
+def reset_peak_rss():
+    """Reset the peak-RSS high-water mark (Linux only); return current RSS KB."""
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    return proc_status_kb("VmRSS")
+
+def cmd_parse(args):
+    if args.child:
+        parse_child(args.child, args.apkindex)
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.apkindex
+        if not path:
+            path = os.path.join(tmp, "APKINDEX.tar.gz")
+            write_apkindex(path, synthetic_alpine(args.alpine))
+        with tarfile.open(path) as tar:
+            raw = tar.getmember("APKINDEX").size
+        print(f"APKINDEX: {os.path.getsize(path) // 1024} KB compressed, {raw // 1024} KB raw")
+        print(f"  {'parser':<10} {'time ms':>8} {'peak RSS growth KB':>20} {'packages':>9}")
+        for variant in ("legacy", "stream"):
+            out = subprocess.run([sys.executable, __file__, "parse", "--child", variant,
+                                  "--apkindex", path], capture_output=True, text=True, check=True)
+            r = json.loads(out.stdout.strip().splitlines()[-1])
+            print(f"  {variant:<10} {r['ms']:>8.0f} {r['rss_kb']:>20} {r['packages']:>9}")
+
+# ─── Compression ─────────────────────────────────────────────────────────────
+# Wire size and per-request latency of the index and the 10 largest bundles
+# for each Accept-Encoding, over one keep-alive connection.
+
+def timed_get(conn, path, encoding, rounds):
+    headers = {"Accept-Encoding": encoding} if encoding else {}
+    size = 0
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        conn.request("GET", path, headers=headers)
+        resp = conn.getresponse()
+        size = len(resp.read())
+        if resp.status != 200:
+            raise RuntimeError(f"{path}: {resp.status}")
+    return size, (time.perf_counter() - t0) * 1e6 / rounds
+
+def cmd_compress(args):
+    with SpawnedServer("--workers 4") as srv:
+        conn = http.client.HTTPConnection(srv.host, srv.port)
+        pools = package_paths(srv.host, srv.port)[1:]
+        sizes = {p: timed_get(conn, p, None, 1)[0] for p in pools}
+        paths = ["/repo/index"] + sorted(pools, key=sizes.get, reverse=True)[:10]
+        print(f"Wire bytes and mean latency over keep-alive, {args.rounds} requests each")
+        print(f"  {'path':<34} {'identity':>14} {'gzip':>20} {'deflate':>20}")
+        for path in paths:
+            cols = []
+            raw = None
+            for enc in (None, "gzip", "deflate"):
+                size, us = timed_get(conn, path, enc, args.rounds)
+                raw = raw or size
+                pct = "" if enc is None else f" {size * 100 // raw:>3}%"
+                cols.append(f"{size:>7}B{pct} {us:>5.0f}us")
+            print(f"  {path:<34} {cols[0]:>14} {cols[1]:>20} {cols[2]:>20}")
+        conn.close()
+
+# ─── Lazy Catalog ────────────────────────────────────────────────────────────
+# Startup cost of a synthetic _EXTRA-style table: the eager layout (a dict per
+# package holding its file bodies, every bundle encoded up front) against the
+# slotted Package records with bundles built on demand.
+
+def synthetic_extra(n, seed=0):
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        a, b = rng.sample(_WORDS, 2)
+        name = f"{a}{b}{i}"
+        rows.append((name, f"{rng.randrange(10)}.{rng.randrange(50)}-r0", rng.randrange(1, 1 << 16),
+                     f"{a} {b} utility", [], None, f"echo 'Usage: {name} [options] [file]'"))
+    return rows
+
+def eager_startup(rows):
+    """What pkg-server did before: file bodies at import, all bundles at start."""
+    packages = {}
+    for name, ver, size, desc, deps, bn, extra in rows:
+        script = f"#!/bin/sh\necho '{name} {ver}'\necho '{desc}'\n" + (extra + "\n" if extra else "")
+        packages[name] = {"version": ver, "size_kb": size, "arch": "x86_64", "description": desc,
+                          "depends": deps or [], "files": {f"/usr/bin/{bn or name}": script}}
+    lines = []
+    for name, pkg in sorted(packages.items()):
+        deps = ",".join(pkg["depends"]) if pkg["depends"] else "none"
+        lines.append(f"{name} {pkg['version']} {pkg['size_kb']} {pkg['arch']} {len(pkg['files'])} {deps} {pkg['description']}")
+    index = ('\n'.join(lines) + '\n').encode()
+    bundles = {}
+    for name, pkg in packages.items():
+        out = [f"PKG {name} {pkg['version']}"]
+        for path, content in pkg["files"].items():
+            out += [f"FILE {path}", content.rstrip('\n')]
+        data = ('\n'.join(out + ["EOF"]) + '\n').encode()
+        bundles[name] = (data, hashlib.sha256(data).hexdigest())
+    return packages, index, bundles
+
+def catalog_child(variant, n):
+    srv = load_pkg_server()
+    rows = synthetic_extra(n)
+    before = reset_peak_rss()
+    t0 = time.perf_counter()
+    if variant == "eager":
+        keep = eager_startup(rows)
+    else:
+        for name, ver, size, desc, deps, bn, extra in rows:
+            srv.PACKAGES[name] = srv.Package(name, ver, size, desc, deps or [], source=(bn or name, extra))
+        srv.repo_cache.rebuild()
+        keep = srv.PACKAGES
+    ms = (time.perf_counter() - t0) * 1000
+    rss = proc_status_kb("VmRSS") - before
+    print(json.dumps({"ms": ms, "rss_kb": rss, "peak_kb": proc_status_kb("VmHWM") - before,
+                      "packages": len(keep)}))
+
+def cmd_catalog(args):
+    if args.child:
+        catalog_child(args.child, args.packages)
+        return
+    print(f"Catalog startup with {args.packages} synthetic packages (index + bundles)")
+    print(f"  {'layout':<8} {'time ms':>8} {'RSS growth KB':>14} {'peak KB':>9}")
+    for variant in ("eager", "lazy"):
+        out = subprocess.run([sys.executable, __file__, "catalog", "--child", variant,
+                              "--packages", str(args.packages)], capture_output=True, text=True, check=True)
+        r = json.loads(out.stdout.strip().splitlines()[-1])
+        print(f"  {variant:<8} {r['ms']:>8.0f} {r['rss_kb']:>14} {r['peak_kb']:>9}")
+
+# ─── Bundle Round Trip ───────────────────────────────────────────────────────
+# Encodes every local package, plus content the text format cannot carry, in
+# the binary bundle format and checks the reference decoder gives it back
+# byte for byte. Also checks concatenated bundles, corruption detection, that
+# the server negotiates the same bytes over HTTP, and /repo/index.sha256.
+
+TRICKY_FILES = {
+    "/etc/lines": "FILE /etc/passwd\nEOF\nPKG evil 1.0\n",
+    "/etc/empty": "",
+    "/etc/trailing": "keep\n\n\n",
+    "/usr/share/unicode-\u00e9t\u00e9.txt": "\u2603 snow \u00e9\n",
+    "/usr/lib/blob.bin": bytes(range(256)) * 4,
+}
+
+def parse_text_bundle(text):
+    """What the kernel's PKG/FILE/EOF parser recovers from a text bundle."""
+    files, path, body = {}, None, []
+    for line in text.splitlines():
+        if line.startswith("FILE ") or line == "EOF":
+            if path is not None:
+                files[path] = "\n".join(body)
+            path, body = (line[5:], []) if line != "EOF" else (None, [])
+            if line == "EOF":
+                break
+        elif path is not None:
+            body.append(line)
+    return files
+
+def check_roundtrip(srv, name, version, files):
+    data = srv.encode_binary_bundle(name, version, files)
+    got_name, got_version, got, end = srv.decode_binary_bundle(data)
+    want = [(p, c.encode() if isinstance(c, str) else c) for p, c in files.items()]
+    return (got_name, got_version, end) == (name, version, len(data)) and \
+        [(p, b) for p, _, b in got] == want
+
+def cmd_roundtrip(args):
+    srv = load_pkg_server()
+    check = Checks()
+
+    print("Binary bundle round trip")
+    bad = [n for n, pkg in srv.PACKAGES.items()
+           if not check_roundtrip(srv, n, pkg.version, srv.package_files(pkg))]
+    check(f"{len(srv.PACKAGES)} local packages ({', '.join(bad) or 'all identical'})", not bad)
+    check("FILE/EOF lines, empty, trailing newlines, unicode, raw bytes",
+          check_roundtrip(srv, "tricky", "1.0-r0", TRICKY_FILES))
+    text_files = {p: c for p, c in TRICKY_FILES.items() if isinstance(c, str)}
+    check("text format is lossy for the same content (expected)",
+          parse_text_bundle(srv.encode_text_bundle("tricky", "1.0-r0", text_files)) != text_files)
+
+    names = sorted(srv.PACKAGES)[:10]
+    stream = b"".join(srv.encode_binary_bundle(n, srv.PACKAGES[n].version,
+                                               srv.package_files(srv.PACKAGES[n])) for n in names)
+    walked, pos = [], 0
+    while pos < len(stream):
+        name, _, _, pos = srv.decode_binary_bundle(stream, pos)
+        walked.append(name)
+    check(f"{len(names)} concatenated bundles walk in order", walked == names)
+
+    many = {f"/usr/share/many/{i}": str(i) for i in range(70000)}
+    check("70000 files (more than a u16 count)", check_roundtrip(srv, "many", "1.0-r0", many))
+    v2 = srv.encode_binary_bundle("tricky", "1.0-r0", TRICKY_FILES)
+    _, _, count, header_size, payload_size = srv._BIN_HEAD.unpack_from(v2)
+    v1 = srv._BIN_HEADS[1].pack(srv.BIN_BUNDLE_MAGIC, 1, count, header_size - 2, payload_size) + \
+        v2[srv._BIN_HEAD.size:]
+    check("version 1 bundles (u16 count) still decode",
+          srv.decode_binary_bundle(v1)[2] == srv.decode_binary_bundle(v2)[2])
+
+    good = bytearray(srv.encode_binary_bundle("tricky", "1.0-r0", TRICKY_FILES))
+    for label, mutate in (("flipped payload byte", lambda b: b.__setitem__(len(b) - 1, b[-1] ^ 1)),
+                          ("bad magic", lambda b: b.__setitem__(0, 0)),
+                          ("truncated payload", lambda b: b.__delitem__(slice(len(b) - 10, None))),
+                          ("truncated header", lambda b: b.__delitem__(slice(20, None)))):
+        data = bytearray(good)
+        mutate(data)
+        try:
+            srv.decode_binary_bundle(bytes(data))
+            check(f"{label} rejected", False)
+        except ValueError:
+            check(f"{label} rejected", True)
+
+    with SpawnedServer("--workers 4") as server:
+        conn = http.client.HTTPConnection(server.host, server.port)
+        ok = True
+        for name in sorted(srv.PACKAGES):
+            for path, headers in ((f"/repo/pool/{name}.tpk", {}),
+                                  (f"/repo/pool/{name}.pkg", {"Accept": srv.BIN_BUNDLE_TYPE})):
+                conn.request("GET", path, headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+                pkg = srv.PACKAGES[name]
+                ok &= resp.status == 200 and resp.getheader("Content-Type") == srv.BIN_BUNDLE_TYPE and \
+                    body == srv.encode_binary_bundle(name, pkg.version, srv.package_files(pkg))
+            conn.request("GET", f"/repo/pool/{name}.pkg")
+            resp = conn.getresponse()
+            ok &= resp.read().decode() == srv.build_package_bundle(name, srv.PACKAGES[name])
+        check("server serves binary on .tpk / Accept, text otherwise", ok)
+
+        conn.request("GET", "/repo/index.sha256")
+        lines = conn.getresponse().read().decode().splitlines()
+        ok = [l.split(" ", 1)[0] for l in lines] == sorted(srv.PACKAGES)
+        for line in lines:
+            name, text_sha, text_len, bin_sha, bin_len = line.split(" ")
+            for ext, sha, length in ((".pkg", text_sha, text_len), (".tpk", bin_sha, bin_len)):
+                conn.request("GET", f"/repo/pool/{name}{ext}")
+                body = conn.getresponse().read()
+                ok &= hashlib.sha256(body).hexdigest() == sha and len(body) == int(length)
+        conn.close()
+        check("/repo/index.sha256 matches every served bundle", ok)
+
+    check.exit()
+
+# ─── Blob Deduplication ──────────────────────────────────────────────────────
+# Store size with file bodies keyed by content, for the local catalog and for
+# a synthetic "-libs" style catalog where packages share library payloads,
+# plus the bytes a client downloads installing every package when it fetches
+# whole bundles versus manifests and only the blobs it does not hold yet.
+
+def synthetic_libs(n, shared, seed=0):
+    rng = random.Random(seed)
+    pool = [rng.randbytes(rng.randrange(8, 64) << 10) for _ in range(shared)]
+    wrapper = "#!/bin/sh\nexec /usr/lib/ld-musl-x86_64.so.1 \"$0.real\" \"$@\"\n"
+    rows = []
+    for i in range(n):
+        name = f"{rng.choice(_WORDS)}{i}-libs"
+        files = {f"/usr/lib/lib{name}-{j}.so": pool[j] for j in rng.sample(range(shared), 3)}
+        files[f"/usr/bin/{name}"] = wrapper
+        files[f"/usr/share/doc/{name}/README"] = "See https://pkgs.alpinelinux.org for details.\n"
+        rows.append((name, files))
+    return rows
+
+def dedup_report(srv, label, names):
+    srv.blob_store.stored_bytes = srv.blob_store.dedup_bytes = 0
+    logical = 0
+    held, bundle_bytes, blob_bytes = set(), 0, 0
+    for name in names:
+        pkg = srv.PACKAGES[name]
+        files = srv.package_files(pkg)
+        logical += sum(len(c.encode() if isinstance(c, str) else c) for c in files.values())
+        bundle_bytes += len(srv.encode_binary_bundle(name, pkg.version, files))
+        manifest = srv.repo_cache.get_bundle(name, "manifest").data
+        blob_bytes += len(manifest)
+        for line in manifest.decode().splitlines():
+            if line.startswith("BLOB "):
+                _, digest, length, _ = line.split(" ", 3)
+                if digest not in held:
+                    held.add(digest)
+                    blob_bytes += int(length)
+    unique = srv.blob_store.stored_bytes
+    print(f"  {label:<26} {len(names):>6} {logical:>12} {unique:>12} {unique * 100 // max(logical, 1):>5}%"
+          f" {bundle_bytes:>12} {blob_bytes:>12}")
+
+def cmd_blobs(args):
+    srv = load_pkg_server()
+    with tempfile.TemporaryDirectory() as tmp:
+        srv.blob_store.directory = os.path.join(tmp, "blobs")
+        print("Content-addressed storage and install transfer (bytes)")
+        print(f"  {'catalog':<26} {'pkgs':>6} {'file bodies':>12} {'blob store':>12} {'':>6}"
+              f" {'via bundles':>12} {'via blobs':>12}")
+        dedup_report(srv, "local", sorted(srv.PACKAGES))
+        rows = synthetic_libs(args.packages, args.shared)
+        for name, files in rows:
+            srv.PACKAGES[name] = srv.Package(name, "1.0-r0", 1, "synthetic", [],
+                                             n_files=len(files), source=files)
+        dedup_report(srv, f"synthetic -libs ({args.shared} libs)", [n for n, _ in rows])
+        on_disk = sum(os.path.getsize(os.path.join(d, f))
+                      for d, _, fs in os.walk(srv.blob_store.directory) for f in fs)
+        stats = srv.blob_store.stats()
+        print(f"  blob directory: {stats['stored']} files, {on_disk} bytes;"
+              f" in memory: {stats['memory_bytes']} bytes")
+
+        # The disk tier under a cap smaller than the synthetic blobs: it must
+        # stay under it, and a blob evicted from both tiers must come back
+        # when a client holding an old manifest asks for it.
+        check = Checks()
+
+        cap = args.disk_cap_kb << 10
+        capped = os.path.join(tmp, "capped")
+        srv.blob_store = srv.BlobStore(capped, max_bytes=64 << 10, disk_max_bytes=cap)
+        manifests = [srv.encode_manifest(name, "1.0-r0", files) for name, files in rows]
+        on_disk = sum(os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(capped) for f in fs)
+        stats = srv.blob_store.stats()
+        print(f"Disk tier capped at {args.disk_cap_kb} KB")
+        check(f"blob directory stays under the cap ({on_disk} bytes, {stats['evictions']} evicted)",
+              on_disk <= cap and on_disk == stats["disk_bytes"] and stats["evictions"] > 0)
+        first = manifests[0].splitlines()[1].split(" ")[1]
+        gone = srv.blob_store.get(first) is None
+        body = srv.repo_cache.restore_blob(first)
+        check(f"an evicted blob is rebuilt from its package (evicted: {gone})",
+              body is not None and srv.hashlib.sha256(body.data).hexdigest() == first)
+        reopened = srv.BlobStore(capped, disk_max_bytes=cap)
+        check("a restart picks up the blobs on disk and their size",
+              reopened.stats()["disk_bytes"] == 0 and reopened.get(first) is not None
+              and reopened.stats()["disk_bytes"] == srv.blob_store.stats()["disk_bytes"])
+
+        # Writes start failing (every shard not yet created is a plain file)
+        # while 8 threads store new blobs at once
+        broken = os.path.join(tmp, "broken")
+        store = srv.BlobStore(broken, max_bytes=1)
+        kept = store.put(b"written before the failure")
+        store.put(b"pushes it out of memory")
+        for i in range(256):
+            if not os.path.exists(os.path.join(broken, f"{i:02x}")):
+                open(os.path.join(broken, f"{i:02x}"), "w").close()
+        blobs = [os.urandom(64) for _ in range(64)]
+        errors = []
+
+        def writer(part):
+            try:
+                for data in part:
+                    store.put(data)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=writer, args=(blobs[i::8],)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        check(f"failed writes fall back to memory ({len(errors)} errors in 8 threads)",
+              not errors and not store.stats()["disk_writable"]
+              and all(store.get(srv.hashlib.sha256(b).hexdigest()) is not None for b in blobs))
+        check("blobs written before the failure are still served from disk",
+              kept not in store.memory and store.get(kept) is not None)
+    check.exit()
+
+# ─── Access Logging ──────────────────────────────────────────────────────────
+# Throughput with the access log going to a slow consumer (a terminal or an
+# ssh session draining stdout at --line-us per line), printed on the request
+# path versus queued to the --async-log writer. The /metrics latency
+# histogram of the pool route is reported alongside.
+
+def slow_reader(pipe, line_us):
+    for _ in iter(pipe.readline, b""):
+        time.sleep(line_us / 1e6)
+
+def metrics_quantile(text, route, q):
+    """Upper bucket bound holding quantile q of a route's latency histogram."""
+    buckets = []
+    for line in text.splitlines():
+        if line.startswith(f'pkg_request_duration_seconds_bucket{{route="{route}",'):
+            le = line.split('le="', 1)[1].split('"', 1)[0]
+            buckets.append((float(le), int(line.rsplit(" ", 1)[1])))
+    total = buckets[-1][1]
+    return next(le for le, n in buckets if n >= q * total)
+
+def cmd_logging(args):
+    print(f"Access log to a consumer taking {args.line_us:.0f}us/line,"
+          f" {args.clients} clients, {args.requests} requests")
+    print(f"  {'mode':<10} {'req/s':>8} {'pool p50':>9} {'pool p99':>9}")
+    for label, flags in (("print", "--workers 32"), ("async", "--workers 32 --async-log")):
+        with SpawnedServer(flags, stdout=subprocess.PIPE) as srv:
+            threading.Thread(target=slow_reader, args=(srv.proc.stdout, args.line_us), daemon=True).start()
+            paths = package_paths(srv.host, srv.port)
+            rps, errors = run_load(srv.host, srv.port, paths, args.clients, args.requests)
+            _, body = fetch(srv.host, srv.port, "/metrics")
+            text = body.decode()
+            p50, p99 = (metrics_quantile(text, "pool", q) * 1000 for q in (0.5, 0.99))
+            print(f"  {label:<10} {rps:>8.0f} {p50:>7.1f}ms {p99:>7.1f}ms" + (f"  ({errors} errors)" if errors else ""))
+
+# ─── Alpine Package Proxy ────────────────────────────────────────────────────
+# Offline checks of --apk-proxy against a fixture mirror directory holding
+# an APKINDEX and .apk files built the way abuild does: signature, control
+# and data tar segments, each gzipped separately and concatenated, with the
+# end-of-archive blocks cut from the first two.
+
+def apk_segment(members, cut=True):
+    """members: (name, bytes | None for a dir, mode, linktype, linkname)."""
+    buf = io.BytesIO()
+    tar = tarfile.open(fileobj=buf, mode="w", format=tarfile.PAX_FORMAT)
+    for name, data, mode, kind, link in members:
+        info = tarfile.TarInfo(name)
+        info.mode, info.type, info.linkname = mode, kind, link
+        if kind == tarfile.REGTYPE:
+            info.size = len(data)
+        tar.addfile(info, io.BytesIO(data) if kind == tarfile.REGTYPE else None)
+    if cut:
+        return buf.getvalue()[:tar.offset]
+    tar.close()
+    return buf.getvalue()
+
+def write_apk(path, name, version, members):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    sign = apk_segment([(".SIGN.RSA.alpine-devel@alpinelinux.org.rsa.pub", b"\x00sig", 0o644, tarfile.REGTYPE, "")])
+    control = apk_segment([(".PKGINFO", f"pkgname = {name}\npkgver = {version}\n".encode(), 0o644, tarfile.REGTYPE, ""),
+                           (".post-install", b"#!/bin/sh\ntrue\n", 0o755, tarfile.REGTYPE, "")])
+    with open(path, "wb") as f:
+        for segment in (sign, control, apk_segment(members, cut=False)):
+            f.write(gzip.compress(segment))
+
+def apk_fixture(root):
+    """Write the fixture mirror; return {name: expected {path: (mode, bytes)}}."""
+    rng = random.Random(7)
+    elf = b"\x7fELF" + rng.randbytes(20000)
+    members = {
+        "proxytool": [("usr", None, 0o755, tarfile.DIRTYPE, ""),
+                      ("usr/bin/proxytool", elf, 0o755, tarfile.REGTYPE, ""),
+                      ("usr/bin/proxytool-alias", None, 0o755, tarfile.LNKTYPE, "usr/bin/proxytool"),
+                      ("usr/bin/pt", None, 0o777, tarfile.SYMTYPE, "proxytool"),
+                      ("etc/proxytool.conf", b"# FILE /etc/x\nEOF\nkey=1\n", 0o640, tarfile.REGTYPE, "")],
+    }
+    for i in range(6):
+        members[f"bigpkg{i}"] = [(f"usr/lib/libbig{i}.so", rng.randbytes(300 << 10), 0o755, tarfile.REGTYPE, "")]
+    index = {}
+    expected = {}
+    for name, m in members.items():
+        index[name] = {"version": "1.0-r0", "description": f"{name} fixture", "depends": [], "size": 1}
+        write_apk(os.path.join(root, f"main/x86_64/{name}-1.0-r0.apk"), name, "1.0-r0", m)
+        files = {"/" + n: (mode, data) for n, data, mode, kind, _ in m if kind == tarfile.REGTYPE}
+        files.update({"/" + n: files["/" + link] for n, _, _, kind, link in m if kind == tarfile.LNKTYPE})
+        expected[name] = files
+    write_apkindex(os.path.join(root, "main/x86_64/APKINDEX.tar.gz"), index)
+    write_apkindex(os.path.join(root, "community/x86_64/APKINDEX.tar.gz"), {})
+    return expected
+
+def wait_searchable(srv, name, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if fetch(srv.host, srv.port, f"/repo/search?q={name}")[1].startswith(name.encode()):
+            return
+        time.sleep(0.05)
+    raise RuntimeError(f"{name} never became searchable")
+
+def decoded_files(srv_mod, body):
+    _, _, entries, _ = srv_mod.decode_binary_bundle(body)
+    return {p: (m, b) for p, m, b in entries}
+
+def cmd_proxy(args):
+    pkgsrv = load_pkg_server()
+    check = Checks()
+
+    print("Alpine package proxy (--apk-proxy) against a fixture mirror")
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, "mirror")
+        expected = apk_fixture(root)
+        cache = os.path.join(tmp, "cache")
+        with FixtureMirror(root, args.mirror_ms / 1000.0) as mirror:
+            flags = f"--workers 64 --mirror {mirror.url} --cache-dir {cache} --apk-proxy --apk-cache-mb 1"
+            with SpawnedServer(flags, alpine=True) as srv:
+                wait_searchable(srv, "proxytool")
+                t0 = time.perf_counter()
+                status, body = fetch(srv.host, srv.port, "/repo/pool/proxytool.tpk")
+                cold = time.perf_counter() - t0
+                t0 = time.perf_counter()
+                fetch(srv.host, srv.port, "/repo/pool/proxytool.pkg")
+                warm = time.perf_counter() - t0
+                check(f"real payload extracted: files, bytes and modes match the .apk data segment "
+                      f"(cold {cold * 1000:.0f} ms, cached {warm * 1000:.1f} ms)",
+                      status == 200 and decoded_files(pkgsrv, body) == expected["proxytool"])
+                _, text = fetch(srv.host, srv.port, "/repo/pool/proxytool.pkg")
+                check("text bundle of the same package has the same files",
+                      text.count(b"\nFILE ") + text.startswith(b"FILE ") == len(expected["proxytool"]))
+
+                del mirror.paths[:]
+                results = []
+                barrier = threading.Barrier(args.stampede)
+
+                def client():
+                    barrier.wait()
+                    results.append(fetch(srv.host, srv.port, "/repo/pool/bigpkg0.tpk"))
+
+                threads = [threading.Thread(target=client) for _ in range(args.stampede)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                apk_gets = [p for p in mirror.paths if p.endswith("bigpkg0-1.0-r0.apk")]
+                check(f"{args.stampede} concurrent cold requests -> {len(apk_gets)} upstream fetch",
+                      len(apk_gets) == 1 and len({r for r in results}) == 1 and results[0][0] == 200)
+
+                for i in range(1, 6):
+                    fetch(srv.host, srv.port, f"/repo/pool/bigpkg{i}.tpk")
+                on_disk = sum(os.path.getsize(os.path.join(cache, "apk", f))
+                              for f in os.listdir(os.path.join(cache, "apk")))
+                info = json.loads(fetch(srv.host, srv.port, "/repo")[1])["apk_proxy"]
+                check(f"disk LRU stays under the 1 MB cap ({on_disk} bytes, {info['evictions']} evicted)",
+                      on_disk <= 1 << 20 and info["evictions"] > 0)
+                blob_dir = os.path.join(cache, "blobs")
+                in_blobs = sum(os.path.getsize(os.path.join(d, f))
+                               for d, _, fs in os.walk(blob_dir) for f in fs)
+                _, body = fetch(srv.host, srv.port, "/repo/pool/proxytool.tpk")
+                served = []
+                for _, content in decoded_files(pkgsrv, body).values():
+                    status, blob = fetch(srv.host, srv.port,
+                                         f"/repo/blob/{hashlib.sha256(content).hexdigest()}")
+                    served.append(status == 200 and blob == content)
+                check(f"proxied payloads stay out of the blob directory ({in_blobs} bytes there), "
+                      f"their {len(served)} blobs are served from the proxy cache",
+                      in_blobs == 0 and served and all(served))
+
+        # The mirror is gone now; --mirror only selects the cached index
+        with SpawnedServer(f"--offline --mirror {mirror.url} --cache-dir {cache} --apk-proxy",
+                           alpine=True) as srv:
+            wait_searchable(srv, "bigpkg5")
+            status, body = fetch(srv.host, srv.port, "/repo/pool/bigpkg5.tpk")
+            check("--offline serves cached payloads from disk",
+                  status == 200 and decoded_files(pkgsrv, body) == expected["bigpkg5"])
+            status, _ = fetch(srv.host, srv.port, "/repo/pool/bigpkg0.tpk")
+            check(f"--offline uncached package -> {status}", status == 502)
+
+        cache2 = os.path.join(tmp, "cache2")
+        with SpawnedServer(f"--mirror file://{root} --cache-dir {cache2} --apk-proxy", alpine=True) as srv:
+            wait_searchable(srv, "proxytool")
+            status, body = fetch(srv.host, srv.port, "/repo/pool/proxytool.tpk")
+            check("file:// mirror directory works as the upstream",
+                  status == 200 and decoded_files(pkgsrv, body) == expected["proxytool"])
+
+    check.exit()
+
+# ─── Stampede ────────────────────────────────────────────────────────────────
+# 100 threads released at once onto the same cold keys. In process, the
+# bundle encoder is wrapped to count calls and take --build-ms, so every
+# thread is certain to arrive while the first build runs. Over HTTP, a fresh
+# threaded server gets 100 simultaneous requests for one cold bundle.
+
+def stampede(n, fn):
+    barrier = threading.Barrier(n)
+    results, errors = [], []
+
+    def worker():
+        barrier.wait()
+        try:
+            results.append(fn())
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, errors
+
+def cmd_stampede(args):
+    srv = load_pkg_server()
+    check = Checks()
+
+    print(f"{args.clients}-way stampede, one build per key")
+    builds = {}
+    encode = srv.encode_text_bundle
+
+    def slow_encode(name, *rest):
+        builds[name] = builds.get(name, 0) + 1
+        time.sleep(args.build_ms / 1000.0)
+        return encode(name, *rest)
+
+    srv.encode_text_bundle = slow_encode
+    for name in ("python3", "vim", "git"):
+        t0 = time.perf_counter()
+        results, errors = stampede(args.clients, lambda: srv.repo_cache.get_bundle(name))
+        ms = (time.perf_counter() - t0) * 1000
+        check(f"{name}: {builds.get(name, 0)} build, {len(results)} callers got the same bundle "
+              f"in {ms:.0f} ms", builds.get(name) == 1 and not errors
+              and len({id(r) for r in results}) == 1)
+    builds.clear()
+    srv.repo_cache.rebuild()
+    stampede(args.clients, lambda: srv.repo_cache._build("python3", "text"))
+    print(f"  (without single-flight the same stampede builds python3 {builds['python3']} times)")
+    srv.encode_text_bundle = encode
+
+    calls = [0]
+
+    def failing():
+        calls[0] += 1
+        time.sleep(args.build_ms / 1000.0)
+        raise OSError("upstream down")
+
+    flights = srv.SingleFlight()
+    results, errors = stampede(args.clients, lambda: flights.do("k", failing))
+    check(f"a failing build runs once ({calls[0]}) and all {len(errors)} callers see the error",
+          calls[0] == 1 and len(errors) == args.clients)
+    check("the next call after a failure retries",
+          flights.do("k", lambda: "ok") == "ok" and not flights.calls)
+
+    with SpawnedServer(f"--workers {args.clients + 8} --max-conns {args.clients + 8}") as server:
+        results, errors = stampede(args.clients,
+                                   lambda: fetch(server.host, server.port, "/repo/pool/python3.pkg"))
+        cache = json.loads(fetch(server.host, server.port, "/repo")[1])["cache"]
+        check(f"HTTP: {len(results)} x 200 for a cold bundle, {cache['encodes']} encode, "
+              f"{cache['coalesced']} coalesced, {cache['hits']} cache hits",
+              cache["encodes"] == 1 and not errors and {r for r in results} == {results[0]}
+              and results[0][0] == 200)
+
+    check.exit()
+
+# ─── CLI ─────────────────────────────────────────────────────────────────────
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+def main():
+    parser = argparse.ArgumentParser(description="TrustOS package server benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("load", help="requests/sec at several client concurrency levels")
+    p.add_argument("--clients", type=int_list, default=[1, 16, 128])
+    p.add_argument("--requests", type=int, default=2000)
+    p.add_argument("--server", action="append",
+                   help='pkg-server arguments to spawn, repeatable (default: "" and "--workers 32")')
+    p.add_argument("--url", help="benchmark an already running server instead")
+    p.set_defaults(func=cmd_load)
+
+    p = sub.add_parser("keepalive", help="connection-per-package vs keep-alive install time")
+    p.add_argument("--packages", type=int, default=20)
+    p.add_argument("--rounds", type=int, default=50)
+    p.add_argument("--rtt", type=float, default=0.0, help="simulated handshake round trip in ms")
+    p.set_defaults(func=cmd_keepalive)
+
+    p = sub.add_parser("idle", help="idle keep-alive connections must not starve new clients")
+    p.add_argument("--idle", type=int, default=8, help="idle connections, more than --workers")
+    p.add_argument("--workers", type=int, default=2)
+    p.add_argument("--idle-timeout", type=float, default=5)
+    p.set_defaults(func=cmd_idle)
+
+    p = sub.add_parser("search", help="inverted search index vs linear scan")
+    p.add_argument("--alpine", type=int, default=20000, help="synthetic Alpine catalog size")
+    p.add_argument("--apkindex", help="use a recorded APKINDEX.tar.gz instead")
+    p.add_argument("--rounds", type=int, default=200)
+    p.add_argument("--queries", type=lambda v: v.split(","),
+                   default=["vim", "python3", "py3-", "lib", "compress", "qwertyzzz", "ssl"])
+    p.set_defaults(func=cmd_search)
+
+    p = sub.add_parser("coldstart", help="time to full catalog with and without the index cache")
+    p.add_argument("--alpine", type=int, default=20000, help="fixture main repo size")
+    p.add_argument("--mirror-ms", type=int, default=1500, help="simulated CDN download time")
+    p.set_defaults(func=cmd_coldstart)
+
+    p = sub.add_parser("parse", help="streaming vs buffered APKINDEX parse time and peak RSS")
+    p.add_argument("--alpine", type=int, default=20000, help="synthetic fixture size")
+    p.add_argument("--apkindex", help="use a recorded APKINDEX.tar.gz instead")
+    p.add_argument("--child", choices=["legacy", "stream"], help=argparse.SUPPRESS)
+    p.set_defaults(func=cmd_parse)
+
+    p = sub.add_parser("compress", help="identity vs gzip vs deflate size and latency")
+    p.add_argument("--rounds", type=int, default=200)
+    p.set_defaults(func=cmd_compress)
+
+    p = sub.add_parser("catalog", help="eager vs lazy catalog startup time and RSS")
+    p.add_argument("--packages", type=int, default=50000)
+    p.add_argument("--child", choices=["eager", "lazy"], help=argparse.SUPPRESS)
+    p.set_defaults(func=cmd_catalog)
+
+    p = sub.add_parser("roundtrip", help="binary bundle encode/decode and negotiation checks")
+    p.set_defaults(func=cmd_roundtrip)
+
+    p = sub.add_parser("blobs", help="content-addressed store size and install transfer")
+    p.add_argument("--packages", type=int, default=400, help="synthetic -libs packages")
+    p.add_argument("--shared", type=int, default=40, help="distinct shared libraries among them")
+    p.add_argument("--disk-cap-kb", type=int, default=512, help="blob directory cap for the eviction checks")
+    p.set_defaults(func=cmd_blobs)
+
+    p = sub.add_parser("logging", help="access log on the request path vs --async-log")
+    p.add_argument("--clients", type=int, default=16)
+    p.add_argument("--requests", type=int, default=4000)
+    p.add_argument("--line-us", type=float, default=1000, help="consumer time per log line")
+    p.set_defaults(func=cmd_logging)
+
+    p = sub.add_parser("proxy", help="--apk-proxy extraction, coalescing and disk LRU checks")
+    p.add_argument("--stampede", type=int, default=50, help="concurrent requests for one cold package")
+    p.add_argument("--mirror-ms", type=int, default=300, help="simulated mirror response delay")
+    p.set_defaults(func=cmd_proxy)
+
+    p = sub.add_parser("stampede", help="single-flight: one bundle build per key under a stampede")
+    p.add_argument("--clients", type=int, default=100)
+    p.add_argument("--build-ms", type=float, default=50, help="simulated build time in process")
+    p.set_defaults(func=cmd_stampede)
+
+    args = parser.parse_args()
+    if args.command == "load" and not args.server:
+        args.server = ["", "--workers 32"]
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
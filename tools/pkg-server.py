@@ -5,7 +5,35 @@ TrustOS Package Server
 Serves a real APT-like repository over HTTP for TrustOS to download.
 
 Usage:
-    python pkg-server.py [--port 8080] [--host 0.0.0.0]
+    python pkg-server.py [--port 8080] [--host 0.0.0.0] [--no-alpine]
+                         [--workers N] [--max-conns N] [--idle-timeout S]
+                         [--mirror URL] [--cache-dir DIR] [--offline]
+                         [--async-log] [--apk-proxy] [--apk-cache-mb N]
+                         [--blob-cache-mb N]
+
+    --workers N     Serve each connection on its own thread and handle up to
+                    N requests at once (default: one connection at a time).
+                    Idle keep-alive connections do not take up a worker.
+    --max-conns N   Cap on open connections in threaded mode (default: 4 x
+                    workers). At the cap the longest idle keep-alive
+                    connection is closed to let a new client in.
+    --idle-timeout S
+                    Drop keep-alive connections idle for S seconds (default 15).
+                    Keep-alive is only offered in threaded mode.
+    --mirror URL    Alpine mirror to index (default: dl-cdn v3.19)
+    --cache-dir DIR Where the parsed Alpine index and file blobs are persisted
+                    (default: tools/.pkg-cache)
+    --blob-cache-mb N
+                    Size cap of the file blobs kept on disk (default 1024);
+                    the least recently used are removed first
+    --offline       Serve the cached Alpine index only, never contact the mirror
+    --apk-proxy     Serve the real contents of Alpine packages: download each
+                    .apk from the mirror on first request and cache it on disk
+                    (default: generated stub bundles)
+    --apk-cache-mb N
+                    Size cap of the proxied package cache (default 512)
+    --async-log     Write the access log from a background thread in batches
+                    instead of printing on the request path
 
 For QEMU user-mode networking, TrustOS reaches the host at 10.0.2.2.
 For VirtualBox host-only, it's typically 192.168.56.1.
@@ -17,21 +45,38 @@ import sys
 import os
 import time
 import hashlib
-import io
+import struct
+import gzip
+import zlib
+import codecs
+import contextlib
+import bisect
+import pickle
+import queue
+import socket
 import tarfile
 import threading
+import urllib.error
 import urllib.request
+from collections import OrderedDict
 from urllib.parse import urlparse, unquote, parse_qs
 
+from httputil import negotiate_encoding, parse_range
+
 PORT = 8080
 HOST = "0.0.0.0"
 ALPINE_MIRROR = "https://dl-cdn.alpinelinux.org/alpine/v3.19"
+ALPINE_REPOS = ["main", "community"]
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".pkg-cache")
+CACHE_FORMAT = 1   # bump when the pickled index layout changes
+IDLE_TIMEOUT = 15  # seconds before an idle keep-alive connection is dropped
 
 # ─── Package Repository ──────────────────────────────────────────────────────
 # Each package has: version, size_kb, description, depends, files
 # files = dict of { install_path: file_content }
+# These definitions are turned into compact Package records (PACKAGES) below.
 
-PACKAGES = {
+_HANDWRITTEN = {
     "vim": {
         "version": "9.0.2127-r0",
         "size_kb": 5824,
@@ -554,17 +599,13 @@ PACKAGES = {
 
 # ─── Extra Packages (compact definitions to reach 100+) ──────────────────────
 
-def _pkg_quick(name, version, size_kb, desc, depends=None, bin_name=None, extra_output=""):
-    """Helper to create a simple package with auto-generated shell script."""
+def _pkg_quick(name, version, desc, bin_name=None, extra_output=""):
+    """Files of a simple package with an auto-generated shell script."""
     bn = bin_name or name
     script = f"#!/bin/sh\necho '{name} {version}'\necho '{desc}'\n"
     if extra_output:
         script += extra_output + "\n"
-    return {
-        "version": version, "size_kb": size_kb, "arch": "x86_64",
-        "description": desc, "depends": depends or [],
-        "files": {f"/usr/bin/{bn}": script}
-    }
+    return {f"/usr/bin/{bn}": script}
 
 _EXTRA = [
     # Shells
@@ -701,95 +742,228 @@ _EXTRA = [
     ("smartmontools", "7.4-r0", 640, "S.M.A.R.T. monitoring", [], "smartctl", "echo 'Usage: smartctl [options] device'"),
 ]
 
+# ─── Package Catalog ──────────────────────────────────────────────────────────
+# PACKAGES maps name -> Package, a slotted metadata record. Generated packages
+# keep only the arguments needed to produce their files; bodies are built by
+# package_files() when a bundle is first requested, and the encoded bundle is
+# then held in RepoCache's LRU. Startup cost and memory therefore scale with
+# the number of packages, not with the size of their contents.
+
+class Package:
+    """Metadata for one local package; file bodies are produced on demand."""
+
+    __slots__ = ("name", "version", "size_kb", "arch", "description", "depends",
+                 "n_files", "source")
+
+    def __init__(self, name, version, size_kb, description, depends,
+                 arch="x86_64", n_files=1, source=None):
+        self.name = name
+        self.version = version
+        self.size_kb = size_kb
+        self.arch = arch
+        self.description = description
+        self.depends = depends
+        self.n_files = n_files
+        self.source = source   # {path: content}, or (bin_name, extra_output)
+
+def package_files(pkg):
+    """Return {install_path: content} for a Package."""
+    if isinstance(pkg.source, dict):
+        return pkg.source
+    bin_name, extra_output = pkg.source
+    return _pkg_quick(pkg.name, pkg.version, pkg.description, bin_name, extra_output)
+
+PACKAGES = {}
+for _name, _def in _HANDWRITTEN.items():
+    PACKAGES[_name] = Package(_name, _def["version"], _def["size_kb"], _def["description"],
+                              _def["depends"], _def["arch"], len(_def["files"]), _def["files"])
 for _name, _ver, _size, _desc, _deps, _bn, _extra in _EXTRA:
     if _name not in PACKAGES:
-        PACKAGES[_name] = _pkg_quick(_name, _ver, _size, _desc, _deps, _bn or _name, _extra)
+        PACKAGES[_name] = Package(_name, _ver, _size, _desc, _deps or [],
+                                  source=(_bn or _name, _extra))
 
 # ─── Alpine CDN Proxy ────────────────────────────────────────────────────────
 
+def iter_lines(f, chunk_size=1 << 16):
+    """Decode a binary stream chunk by chunk and yield its lines (without the
+    newline). Only one chunk plus a partial line is buffered at a time."""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    tail = ''
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        lines = (tail + decoder.decode(chunk)).split('\n')
+        tail = lines.pop()
+        yield from lines
+    tail += decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+def iter_apkindex(lines):
+    """Yield each APKINDEX record as a dict of its single-letter fields.
+    Records are separated by blank lines; `lines` may be any line iterator."""
+    current = {}
+    for line in lines:
+        if not line:
+            if current:
+                yield current
+            current = {}
+        elif ':' in line:
+            key, _, value = line.partition(':')
+            current[key] = value
+    if current:
+        yield current
+
 class AlpineIndex:
-    """Downloads and parses Alpine Linux APKINDEX for 15,000+ package discovery."""
+    """Downloads and parses Alpine Linux APKINDEX for 15,000+ package discovery.
+
+    The parsed index is persisted to CACHE_DIR so a restart serves the full
+    catalog immediately; the mirror is then re-checked in the background with
+    If-None-Match / If-Modified-Since and only re-parsed when it changed."""
 
     def __init__(self):
         self.packages = {}   # name -> {version, description, depends, size}
+        self.repos = {}      # repo -> {etag, last_modified, packages}
         self.loaded = False
         self.loading = False
+        self.cache_path = os.path.join(CACHE_DIR, "alpine-index.pickle")
+        self.load_seconds = {}   # "cache" / "mirror" -> duration of the last load
+
+    def load_cache(self):
+        """Load the index persisted by a previous run. Returns True if usable."""
+        t0 = time.time()
+        try:
+            with open(self.cache_path, "rb") as f:
+                state = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f"[Alpine] Warning: ignoring unreadable cache {self.cache_path}: {e}")
+            return False
+        if state.get("format") != CACHE_FORMAT or state.get("mirror") != ALPINE_MIRROR:
+            print(f"[Alpine] Cache is for another mirror or format, ignoring it")
+            return False
+        self.repos = state["repos"]
+        self._merge()
+        self.loaded = True
+        self.load_seconds["cache"] = time.time() - t0
+        print(f"[Alpine] Cache: {len(self.packages)} packages loaded in {(time.time() - t0) * 1000:.0f} ms")
+        return True
+
+    def save_cache(self):
+        state = {"format": CACHE_FORMAT, "mirror": ALPINE_MIRROR, "repos": self.repos}
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp = self.cache_path + ".tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.cache_path)
+        except OSError as e:
+            print(f"[Alpine] Warning: could not write cache: {e}")
+
+    def _merge(self):
+        merged = {}
+        for repo in ALPINE_REPOS:
+            merged.update(self.repos.get(repo, {}).get("packages", {}))
+        self.packages = merged
 
     def load_async(self):
-        """Start loading Alpine indices in a background thread."""
-        if self.loading or self.loaded:
+        """Start loading (or refreshing) Alpine indices in a background thread."""
+        if self.loading:
             return
         self.loading = True
         t = threading.Thread(target=self._load, daemon=True)
         t.start()
 
     def _load(self):
-        for repo in ["main", "community"]:
+        t0 = time.time()
+        changed = False
+        for repo in ALPINE_REPOS:
             try:
-                url = f"{ALPINE_MIRROR}/{repo}/x86_64/APKINDEX.tar.gz"
-                print(f"[Alpine] Fetching {repo} index...")
-                req = urllib.request.Request(url, headers={"User-Agent": "TrustOS-PkgServer/2.0"})
-                data = urllib.request.urlopen(req, timeout=15).read()
-                self._parse_tar(data)
-                print(f"[Alpine] {repo}: {len(self.packages)} packages total")
+                changed |= self._fetch(repo)
             except Exception as e:
                 print(f"[Alpine] Warning: could not load {repo}: {e}")
+        if changed:
+            self._merge()
+            self.save_cache()
         self.loaded = True
         self.loading = False
+        self.load_seconds["mirror"] = time.time() - t0
         print(f"[Alpine] Index ready: {len(self.packages)} additional packages from Alpine CDN")
+        if changed:
+            refresh_catalog()
 
-    def _parse_tar(self, data):
+    def _fetch(self, repo):
+        """Conditionally download one repo index. Returns True if it changed."""
+        url = f"{ALPINE_MIRROR}/{repo}/x86_64/APKINDEX.tar.gz"
+        prev = self.repos.get(repo, {})
+        headers = {"User-Agent": "TrustOS-PkgServer/2.0"}
+        if prev.get("etag"):
+            headers["If-None-Match"] = prev["etag"]
+        if prev.get("last_modified"):
+            headers["If-Modified-Since"] = prev["last_modified"]
+        print(f"[Alpine] Fetching {repo} index...")
         try:
-            with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tar:
-                for member in tar.getmembers():
+            resp = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=15)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                print(f"[Alpine] {repo}: not modified")
+                return False
+            raise
+        with resp:
+            packages = self._parse_tar(resp)
+            if packages is None:
+                return False
+            self.repos[repo] = {
+                "etag": resp.headers.get("ETag"),
+                "last_modified": resp.headers.get("Last-Modified"),
+                "packages": packages,
+            }
+        print(f"[Alpine] {repo}: {len(packages)} packages")
+        return True
+
+    def _parse_tar(self, fileobj):
+        """Parse an APKINDEX.tar.gz as it streams in; returns name -> info,
+        or None on error. Nothing larger than one line is held in memory
+        besides the resulting table."""
+        try:
+            with tarfile.open(fileobj=fileobj, mode='r|gz') as tar:
+                for member in tar:
                     if member.name == 'APKINDEX':
                         f = tar.extractfile(member)
                         if f:
-                            self._parse_apkindex(f.read().decode('utf-8', errors='replace'))
+                            return self._parse_apkindex(iter_apkindex(iter_lines(f)))
+            return {}
         except Exception as e:
             print(f"[Alpine] Parse error: {e}")
+            return None
 
-    def _parse_apkindex(self, content):
-        current = {}
-        for line in content.split('\n'):
-            if not line:
-                if 'P' in current:
-                    name = current['P']
-                    if name not in PACKAGES:  # Don't override local packages
-                        deps_raw = current.get('D', '')
-                        deps = []
-                        if deps_raw:
-                            for d in deps_raw.split():
-                                clean = d.split('=')[0].split('>')[0].split('<')[0].split('~')[0]
-                                if clean and not clean.startswith('so:') and not clean.startswith('cmd:') and not clean.startswith('pc:'):
-                                    deps.append(clean)
-                        self.packages[name] = {
-                            'version': current.get('V', '0'),
-                            'description': current.get('T', name),
-                            'depends': deps[:5],
-                            'size': int(current.get('S', '0')),
-                        }
-                current = {}
-            elif ':' in line:
-                key, _, value = line.partition(':')
-                current[key] = value
-
-    def search(self, keyword, limit=100):
-        """Search Alpine packages by keyword."""
-        kw = keyword.lower()
-        results = []
-        for name, info in self.packages.items():
-            if kw in name.lower() or kw in info.get('description', '').lower():
-                results.append((name, info))
-                if len(results) >= limit:
-                    break
-        return results
-
-    def get(self, name):
-        return self.packages.get(name)
-
-    def generate_bundle(self, name):
-        """Auto-generate a package bundle for any Alpine package."""
+    def _parse_apkindex(self, records):
+        packages = {}
+        for current in records:
+            if 'P' not in current:
+                continue
+            name = current['P']
+            if name in PACKAGES:  # Don't override local packages
+                continue
+            deps_raw = current.get('D', '')
+            deps = []
+            if deps_raw:
+                for d in deps_raw.split():
+                    clean = d.split('=')[0].split('>')[0].split('<')[0].split('~')[0]
+                    if clean and not clean.startswith('so:') and not clean.startswith('cmd:') and not clean.startswith('pc:'):
+                        deps.append(clean)
+            packages[name] = {
+                'version': current.get('V', '0'),
+                'description': current.get('T', name),
+                'depends': deps[:5],
+                'size': int(current.get('S', '0')),
+            }
+        return packages
+
+    def generate_files(self, name):
+        """Auto-generate (version, {path: content}) for any Alpine package."""
         info = self.packages.get(name)
         if not info:
             return None
@@ -799,19 +973,13 @@ class AlpineIndex:
         is_lib = bn.startswith('lib') or bn.endswith('-libs')
         is_data = bn.endswith('-dev') or bn.endswith('-doc') or bn.endswith('-dbg') or bn.endswith('-static') or bn.endswith('-data') or bn.endswith('-common')
 
-        lines_out = [f"PKG {name} {version}"]
         if is_lib:
-            lines_out.append(f"FILE /usr/lib/{name}.info")
-            lines_out.append(f"{name} {version} - {desc}")
+            files = {f"/usr/lib/{name}.info": f"{name} {version} - {desc}"}
         elif is_data:
-            lines_out.append(f"FILE /usr/share/doc/{name}/README")
-            lines_out.append(f"{name} {version}\n{desc}")
+            files = {f"/usr/share/doc/{name}/README": f"{name} {version}\n{desc}"}
         else:
-            script = f"#!/bin/sh\necho '{name} {version}'\necho '{desc}'"
-            lines_out.append(f"FILE /usr/bin/{bn}")
-            lines_out.append(script)
-        lines_out.append("EOF")
-        return '\n'.join(lines_out) + '\n'
+            files = {f"/usr/bin/{bn}": f"#!/bin/sh\necho '{name} {version}'\necho '{desc}'"}
+        return version, files
 
 alpine_index = AlpineIndex()
 
@@ -824,163 +992,1759 @@ alpine_index = AlpineIndex()
 #   <content lines...>
 #   EOF
 
-def build_package_bundle(name, pkg):
-    """Build a text bundle for a package."""
-    lines = [f"PKG {name} {pkg['version']}"]
-    for path, content in pkg["files"].items():
+def encode_text_bundle(name, version, files, modes=None):
+    """Encode {path: content} in the text bundle format. The format has no
+    file modes, and bytes content is decoded as UTF-8 (lossy for binaries:
+    use the binary format for those)."""
+    lines = [f"PKG {name} {version}"]
+    for path, content in files.items():
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'replace')
         lines.append(f"FILE {path}")
         lines.append(content.rstrip('\n'))
     lines.append("EOF")
     return '\n'.join(lines) + '\n'
 
+def build_package_bundle(name, pkg):
+    """Build a text bundle for a package."""
+    return encode_text_bundle(name, pkg.version, package_files(pkg))
+
+# ─── Binary Bundle Format ─────────────────────────────────────────────────────
+# Sent instead of the text format when the client asks for it (Accept:
+# application/x-trustos-bundle, or a .tpk pool URL). A header table lets the
+# client seek straight to each file and copy it, and file bodies are stored
+# byte for byte, so content containing "FILE " or "EOF" lines is no longer
+# ambiguous. All integers are little-endian.
+#
+#   magic "TPKB" | u16 format version | u32 file count N
+#   u32 header size (payload starts here) | u32 payload size
+#   u16 len + package name | u16 len + package version      (UTF-8)
+#   N x { u16 len + path | u32 offset | u32 length | u32 mode | 32B SHA-256 }
+#   payload: file bodies; offsets are relative to the payload start
+#
+# header size + payload size is the whole bundle, so bundles can be
+# concatenated and walked one after another. Version 1 had a u16 file count
+# (at most 65535 files); it is still decoded, for bundles cached on disk.
+
+BIN_BUNDLE_MAGIC = b"TPKB"
+BIN_BUNDLE_VERSION = 2
+BIN_BUNDLE_TYPE = "application/x-trustos-bundle"
+_BIN_HEAD = struct.Struct("<4sHIII")
+_BIN_HEADS = {1: struct.Struct("<4sHHII"), 2: _BIN_HEAD}   # decodable versions
+_BIN_MAGIC = struct.Struct("<4sH")
+_BIN_ENTRY = struct.Struct("<III32s")
+_U16 = struct.Struct("<H")
+
+def _file_mode(content):
+    return 0o755 if content.startswith(b"#!") else 0o644
+
+def encode_binary_bundle(name, version, files, modes=None):
+    """Encode {path: content} in the binary bundle format. `modes` maps
+    paths to permission bits; other files get _file_mode()."""
+    table, bodies, offset = [], [], 0
+    for path, content in files.items():
+        body = content.encode('utf-8') if isinstance(content, str) else content
+        mode = modes[path] if modes and path in modes else _file_mode(body)
+        p = path.encode('utf-8')
+        table.append(_U16.pack(len(p)) + p +
+                     _BIN_ENTRY.pack(offset, len(body), mode, hashlib.sha256(body).digest()))
+        bodies.append(body)
+        offset += len(body)
+    n, v = name.encode('utf-8'), version.encode('utf-8')
+    meta = _U16.pack(len(n)) + n + _U16.pack(len(v)) + v + b"".join(table)
+    head = _BIN_HEAD.pack(BIN_BUNDLE_MAGIC, BIN_BUNDLE_VERSION, len(files),
+                          _BIN_HEAD.size + len(meta), offset)
+    return head + meta + b"".join(bodies)
+
+def decode_binary_bundle(data, start=0):
+    """Reference decoder. Returns (name, version, [(path, mode, body)], end)
+    where `end` is the offset just past this bundle. Raises ValueError on a
+    bad magic, unknown version, out-of-bounds entry or checksum mismatch."""
+    mv = memoryview(data)
+    if len(data) - start < _BIN_MAGIC.size:
+        raise ValueError("truncated bundle header")
+    magic, version = _BIN_MAGIC.unpack_from(data, start)
+    if magic != BIN_BUNDLE_MAGIC:
+        raise ValueError("not a binary bundle")
+    head = _BIN_HEADS.get(version)
+    if head is None:
+        raise ValueError(f"unsupported bundle version {version}")
+    if len(data) - start < head.size:
+        raise ValueError("truncated bundle header")
+    _, _, count, header_size, payload_size = head.unpack_from(data, start)
+    payload = start + header_size
+    end = payload + payload_size
+    if end > len(data):
+        raise ValueError("truncated bundle payload")
+    pos = start + head.size
+
+    def string():
+        nonlocal pos
+        (n,) = _U16.unpack_from(data, pos)
+        pos += _U16.size
+        value = bytes(mv[pos:pos + n]).decode('utf-8')
+        pos += n
+        return value
+
+    try:
+        name, pkg_version = string(), string()
+        entries = []
+        for _ in range(count):
+            path = string()
+            entries.append((path,) + _BIN_ENTRY.unpack_from(data, pos))
+            pos += _BIN_ENTRY.size
+    except struct.error:
+        raise ValueError("truncated header table") from None
+    files = []
+    for path, offset, length, mode, digest in entries:
+        if offset + length > payload_size:
+            raise ValueError(f"{path}: entry outside payload")
+        body = bytes(mv[payload + offset:payload + offset + length])
+        if hashlib.sha256(body).digest() != digest:
+            raise ValueError(f"{path}: checksum mismatch")
+        files.append((path, mode, body))
+    if pos != payload:
+        raise ValueError("header size does not match header table")
+    return name, pkg_version, files, end
+
 def build_index():
     """Build package index in simple text format."""
     lines = []
     for name, pkg in sorted(PACKAGES.items()):
-        deps = ",".join(pkg["depends"]) if pkg["depends"] else "none"
-        n_files = len(pkg["files"])
-        lines.append(f"{name} {pkg['version']} {pkg['size_kb']} {pkg['arch']} {n_files} {deps} {pkg['description']}")
+        deps = ",".join(pkg.depends) if pkg.depends else "none"
+        lines.append(f"{name} {pkg.version} {pkg.size_kb} {pkg.arch} {pkg.n_files} {deps} {pkg.description}")
+    return '\n'.join(lines) + '\n'
+
+# ─── Response Cache ───────────────────────────────────────────────────────────
+# The index is encoded once and served from memory. Bundles (local and Alpine)
+# are encoded on first request and kept in an LRU until the package set
+# changes (e.g. the Alpine index finishes loading), which triggers a rebuild.
+# Compressed variants are built the first time a client asks for them and kept
+# next to the raw bytes, so compression is paid once per content version.
+
+COMPRESS_MIN = 256   # bodies smaller than this are always sent uncompressed
+BUNDLE_CACHE_SIZE = 4096   # encoded bundles kept in memory
+BUNDLE_CACHE_BYTES = 256 << 20   # ... up to this many bytes (proxied bundles can be large)
+
+def make_etag(data):
+    """Strong ETag for a response body."""
+    return '"' + hashlib.sha256(data).hexdigest()[:32] + '"'
+
+def compress(data, encoding):
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    if encoding == "deflate":
+        return zlib.compress(data, 9)
+    return data
+
+class CachedBody:
+    """A response body, its strong ETag and its compressed variants."""
+
+    __slots__ = ("data", "etag", "variants")
+
+    def __init__(self, data, etag=None):
+        self.data = data
+        self.etag = etag or make_etag(data)
+        self.variants = {}   # encoding -> (bytes, etag)
+
+    def variant(self, encoding):
+        """Return (bytes, etag) for `encoding` (None = identity)."""
+        if not encoding or len(self.data) < COMPRESS_MIN:
+            return self.data, self.etag
+        v = self.variants.get(encoding)
+        if v is None:
+            # Each representation needs its own strong ETag.
+            v = (compress(self.data, encoding), self.etag[:-1] + "-" + encoding + '"')
+            self.variants[encoding] = v
+        return v
+
+# ─── Blob Store ───────────────────────────────────────────────────────────────
+# File bodies are stored once per distinct content, keyed by SHA-256, however
+# many packages ship them. A manifest lists a package's files by digest, so a
+# client that already holds a blob (a shared lib, a README) skips it and
+# fetches only the rest from /repo/blob/<sha256>. Blobs never change, so they
+# are served with immutable cache headers. The binary bundle header carries
+# the same digests.
+#
+# Manifest format (text, like bundles; the path comes last as it may contain
+# spaces):
+#   PKG <name> <version>
+#   BLOB <sha256> <length> <mode, octal> <path>
+#   EOF
+
+MANIFEST_TYPE = "application/x-trustos-manifest"
+BUNDLE_TYPES = {"text": "application/octet-stream", "binary": BIN_BUNDLE_TYPE,
+                "manifest": MANIFEST_TYPE}
+BLOB_MEMORY_BYTES = 32 << 20   # hot blob bodies kept in memory
+BLOB_DISK_MB = 1024            # blob bodies kept on disk
+
+class BlobStore:
+    """Content-addressed file bodies in two LRU tiers bounded by total size:
+    memory, backed by <directory>/<aa>/<sha256> on disk so blobs outlive
+    restarts. Without a directory every blob stays in memory; if writing to
+    it fails, new blobs stay in memory and those already on disk are still
+    served from there.
+
+    A blob evicted from both tiers can still be listed by a manifest a client
+    holds, so put() records which package shipped each digest; the server
+    rebuilds that package's blobs when one of them is requested again."""
+
+    def __init__(self, directory=None, max_bytes=BLOB_MEMORY_BYTES, disk_max_bytes=BLOB_DISK_MB << 20):
+        self.lock = threading.Lock()
+        self.directory = directory
+        self.writable = True          # cleared (under the lock) when a write fails
+        self.memory = OrderedDict()   # digest -> CachedBody, least recent first
+        self.memory_bytes = 0
+        self.max_bytes = max_bytes
+        self.disk = None              # digest -> size on disk, least recent first
+        self.disk_bytes = 0
+        self.disk_max_bytes = disk_max_bytes
+        self.owners = {}      # digest -> name of a package that ships it
+        self.stored = 0       # distinct blobs written by this process
+        self.stored_bytes = 0
+        self.dedup_hits = 0   # put() calls whose content was already stored
+        self.dedup_bytes = 0
+        self.evictions = 0    # blobs removed from disk to stay under the cap
+
+    def _path(self, digest, directory=None):
+        return os.path.join(directory or self.directory, digest[:2], digest)
+
+    def _disk(self):
+        """The on-disk LRU (caller holds the lock). Built on first use from
+        the blob files' mtimes, since --cache-dir is applied after the store
+        is created; get() and put() touch a file whenever they use it."""
+        if self.disk is None:
+            found = []
+            try:
+                with os.scandir(self.directory) as shards:
+                    for shard in shards:
+                        if not shard.is_dir():
+                            continue
+                        with os.scandir(shard.path) as it:
+                            for e in it:
+                                if e.name.endswith(".tmp"):
+                                    os.remove(e.path)   # a write cut short by a crash
+                                elif len(e.name) == 64:
+                                    st = e.stat()
+                                    found.append((st.st_mtime, e.name, st.st_size))
+            except OSError:
+                pass
+            found.sort()
+            self.disk = OrderedDict((digest, size) for _, digest, size in found)
+            self.disk_bytes = sum(self.disk.values())
+        return self.disk
+
+    def _evict_disk(self):
+        """Trim the disk tier to its cap (caller holds the lock); returns the
+        paths to delete once the lock is released."""
+        paths = []
+        while self.disk_bytes > self.disk_max_bytes and len(self.disk) > 1:
+            digest, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            self.evictions += 1
+            paths.append(self._path(digest))
+        return paths
+
+    def _touch(self, digest):
+        """Mark a blob on disk as just used (caller holds the lock). True if
+        it is on disk."""
+        disk = self._disk()
+        if digest not in disk:
+            return False
+        disk.move_to_end(digest)
+        try:
+            os.utime(self._path(digest))
+        except OSError:
+            pass
+        return True
+
+    def _remember(self, digest, body):
+        """Insert into the memory LRU (caller holds the lock)."""
+        self.memory[digest] = body
+        self.memory_bytes += len(body.data)
+        while (self.directory and self.writable and self.memory_bytes > self.max_bytes
+               and len(self.memory) > 1):
+            _, old = self.memory.popitem(last=False)
+            self.memory_bytes -= len(old.data)
+
+    def _write(self, digest, data, directory):
+        path = self._path(digest, directory)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            with self.lock:
+                warn, self.writable = self.writable, False
+            if warn:
+                print(f"[Blobs] Warning: {directory} not writable ({e}), keeping new blobs in memory")
+            return
+        with self.lock:
+            disk = self._disk()
+            self.disk_bytes += len(data) - disk.pop(digest, 0)
+            disk[digest] = len(data)
+            evict = self._evict_disk()
+        for old in evict:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+    def put(self, data, owner=None):
+        """Store `data` (bytes) if it is new; return its hex digest. `owner`
+        names the package it came from."""
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if owner:
+                self.owners[digest] = owner
+            if digest in self.memory:
+                self.memory.move_to_end(digest)
+                self.dedup_hits += 1
+                self.dedup_bytes += len(data)
+                return digest
+            if self.directory and self._touch(digest):
+                self.dedup_hits += 1
+                self.dedup_bytes += len(data)
+                self._remember(digest, CachedBody(data, f'"{digest}"'))
+                return digest
+            directory = self.directory if self.writable else None
+        if directory:
+            self._write(digest, data, directory)
+        with self.lock:
+            if digest not in self.memory:
+                self.stored += 1
+                self.stored_bytes += len(data)
+                self._remember(digest, CachedBody(data, f'"{digest}"'))
+        return digest
+
+    def claim(self, digest, owner):
+        """Record that `owner` ships `digest` without storing the body; it
+        is fetched from the package when requested."""
+        with self.lock:
+            self.owners[digest] = owner
+
+    def owner(self, digest):
+        with self.lock:
+            return self.owners.get(digest)
+
+    def get(self, digest):
+        """Return the CachedBody for a hex digest, or None if unknown."""
+        if len(digest) != 64 or any(c not in "0123456789abcdef" for c in digest):
+            return None
+        with self.lock:
+            body = self.memory.get(digest)
+            if body:
+                self.memory.move_to_end(digest)
+                if self.directory and self.disk and digest in self.disk:
+                    self.disk.move_to_end(digest)
+                return body
+            if not self.directory or not self._touch(digest):
+                return None
+        try:
+            with open(self._path(digest), "rb") as f:
+                data = f.read()
+        except OSError:
+            with self.lock:
+                self.disk_bytes -= self.disk.pop(digest, 0)
+            return None
+        if hashlib.sha256(data).hexdigest() != digest:
+            print(f"[Blobs] Warning: corrupt blob {digest} on disk, ignoring")
+            return None
+        body = CachedBody(data, f'"{digest}"')
+        with self.lock:
+            self._remember(digest, body)
+        return body
+
+    def stats(self):
+        with self.lock:
+            return {
+                "stored": self.stored,
+                "stored_bytes": self.stored_bytes,
+                "dedup_hits": self.dedup_hits,
+                "dedup_bytes": self.dedup_bytes,
+                "in_memory": len(self.memory),
+                "memory_bytes": self.memory_bytes,
+                "on_disk": bool(self.directory),
+                "disk_writable": bool(self.directory) and self.writable,
+                "disk_blobs": len(self.disk or ()),
+                "disk_bytes": self.disk_bytes,
+                "disk_max_bytes": self.disk_max_bytes,
+                "evictions": self.evictions,
+            }
+
+blob_store = BlobStore(os.path.join(CACHE_DIR, "blobs"))
+
+def encode_manifest(name, version, files, modes=None, store=True):
+    """Put every file body of a package in the blob store and return its
+    manifest (text) listing them by digest. With store=False the bodies are
+    only claimed, for packages whose files are cached elsewhere."""
+    lines = [f"PKG {name} {version}"]
+    for path, content in files.items():
+        body = content.encode('utf-8') if isinstance(content, str) else content
+        if store:
+            digest = blob_store.put(body, name)
+        else:
+            digest = hashlib.sha256(body).hexdigest()
+            blob_store.claim(digest, name)
+        mode = modes[path] if modes and path in modes else _file_mode(body)
+        lines.append(f"BLOB {digest} {len(body)} {mode:o} {path}")
+    lines.append("EOF")
     return '\n'.join(lines) + '\n'
 
+# ─── Single Flight ────────────────────────────────────────────────────────────
+# When many VMs boot from one image they ask for the same cold bundle at the
+# same moment. Work that is expensive and keyed (encoding a bundle,
+# downloading an .apk) goes through SingleFlight: the first caller for a key
+# does it, callers arriving while it runs wait and share the result.
+
+class _Call:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into one."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}    # key -> _Call in flight
+        self.leaders = 0   # calls that ran fn
+        self.waiters = 0   # calls that shared a result
+
+    def do(self, key, fn):
+        """Return fn(), or the result of the fn() already running for `key`.
+        An exception from fn is raised in every caller that waited on it;
+        the next call for the key starts afresh."""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.waiters += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+
+# ─── Alpine Package Proxy ─────────────────────────────────────────────────────
+# With --apk-proxy, bundles for Alpine packages carry the real package
+# contents instead of a generated stub. The .apk is fetched from
+# ALPINE_MIRROR the first time it is asked for and its data files are
+# extracted while it downloads. An .apk is three concatenated gzip members
+# (signature, control, data) that together form one tar stream; dot-files
+# (.SIGN.*, .PKGINFO, install scripts) are control data and skipped, as are
+# symlinks and directories, which bundles cannot express. The result is kept
+# on disk as a binary bundle, <cache-dir>/apk/<name>-<version>.tpk, in an LRU
+# capped at --apk-cache-mb; concurrent requests for one package share a
+# single download. The mirror may be a file:// URL for offline testing.
+
+APK_CACHE_MB = 512
+
+class UpstreamError(Exception):
+    """The mirror could not supply a package."""
+
+class ApkProxy:
+    """Fetches, extracts and caches real Alpine package payloads."""
+
+    def __init__(self, directory, max_bytes=APK_CACHE_MB << 20, offline=False):
+        self.lock = threading.Lock()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.entries = OrderedDict()   # file name -> size, least recent first
+        self.total = 0
+        self.flights = SingleFlight()  # file name -> download in progress
+        self.fetches = 0
+        self.fetch_bytes = 0
+        self.hits = 0
+        self.errors = 0
+        self.evictions = 0
+        self._scan()
+
+    def _scan(self):
+        """Adopt bundles left by a previous run, oldest access first."""
+        try:
+            names = [n for n in os.listdir(self.directory) if n.endswith(".tpk")]
+        except FileNotFoundError:
+            return
+        found = []
+        for n in names:
+            st = os.stat(os.path.join(self.directory, n))
+            found.append((st.st_mtime, n, st.st_size))
+        for _, n, size in sorted(found):
+            self.entries[n] = size
+            self.total += size
+
+    def _repo_of(self, name):
+        # Later repos win in AlpineIndex._merge, so look them up in reverse
+        for repo in reversed(ALPINE_REPOS):
+            if name in alpine_index.repos.get(repo, {}).get("packages", {}):
+                return repo
+        return ALPINE_REPOS[0]
+
+    def _read(self, fname):
+        with self.lock:
+            if fname not in self.entries:
+                return None
+            self.entries.move_to_end(fname)
+        path = os.path.join(self.directory, fname)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)   # keeps the LRU order across restarts
+        except OSError:
+            with self.lock:
+                self.total -= self.entries.pop(fname, 0)
+            return None
+        return data
+
+    def _store(self, fname, data):
+        path = os.path.join(self.directory, fname)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[Proxy] Warning: could not cache {fname}: {e}")
+            return
+        evict = []
+        with self.lock:
+            self.total += len(data) - self.entries.pop(fname, 0)
+            self.entries[fname] = len(data)
+            while self.total > self.max_bytes and len(self.entries) > 1:
+                old, size = self.entries.popitem(last=False)
+                self.total -= size
+                self.evictions += 1
+                evict.append(old)
+        for old in evict:
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except OSError:
+                pass
+
+    def _download(self, name, version):
+        """Fetch an .apk and return its data files as a binary bundle."""
+        url = f"{ALPINE_MIRROR}/{self._repo_of(name)}/x86_64/{name}-{version}.apk"
+        files, modes, skipped = {}, {}, 0
+        t0 = time.time()
+        req = urllib.request.Request(url, headers={"User-Agent": "TrustOS-PkgServer/2.0"})
+        try:
+            with urllib.request.urlopen(req, timeout=30) as resp, \
+                    gzip.GzipFile(fileobj=resp) as stream, \
+                    tarfile.open(fileobj=stream, mode="r|") as tar:
+                for member in tar:
+                    rel = member.name[2:] if member.name.startswith("./") else member.name
+                    if rel.startswith("."):
+                        continue
+                    path = "/" + rel
+                    target = "/" + (member.linkname[2:] if member.linkname.startswith("./")
+                                    else member.linkname)
+                    if member.isfile():
+                        files[path] = tar.extractfile(member).read()
+                        modes[path] = member.mode & 0o7777
+                    elif member.islnk() and target in files:
+                        files[path], modes[path] = files[target], modes[target]
+                    elif not member.isdir():
+                        skipped += 1
+        except (OSError, EOFError, tarfile.TarError, zlib.error) as e:
+            raise UpstreamError(f"{url}: {e}") from None
+        try:
+            data = encode_binary_bundle(name, version, files, modes)
+        except struct.error as e:
+            # A path over 64 KB or a payload over 4 GB does not fit the format
+            raise UpstreamError(f"{url}: cannot bundle: {e}") from None
+        print(f"[Proxy] {name}-{version}: {len(files)} files ({len(data)} bytes), "
+              f"{skipped} links skipped, {(time.time() - t0) * 1000:.0f} ms")
+        return data
+
+    def package_files(self, name):
+        """(version, {path: bytes}, {path: mode}) for an Alpine package, or
+        None if the index does not list it. Raises UpstreamError."""
+        info = alpine_index.packages.get(name)
+        if not info:
+            return None
+        fname = f"{name}-{info['version']}.tpk"
+        data = self._read(fname)
+        if data is not None:
+            with self.lock:
+                self.hits += 1
+        else:
+            data = self.flights.do(fname, lambda: self._fetch(name, info['version'], fname))
+        _, version, entries, _ = decode_binary_bundle(data)
+        return version, {p: b for p, _, b in entries}, {p: m for p, m, _ in entries}
+
+    def _fetch(self, name, version, fname):
+        """Download and cache `fname` (once per flight)."""
+        data = self._read(fname)   # stored by a flight that just finished
+        if data is not None:
+            return data
+        try:
+            if self.offline:
+                raise UpstreamError(f"{fname} is not cached (offline)")
+            data = self._download(name, version)
+        except UpstreamError:
+            with self.lock:
+                self.errors += 1
+            raise
+        with self.lock:
+            self.fetches += 1
+            self.fetch_bytes += len(data)
+        self._store(fname, data)
+        return data
+
+    def stats(self):
+        with self.lock:
+            return {
+                "fetches": self.fetches,
+                "fetch_bytes": self.fetch_bytes,
+                "hits": self.hits,
+                "coalesced": self.flights.waiters,
+                "errors": self.errors,
+                "evictions": self.evictions,
+                "cached": len(self.entries),
+                "cached_bytes": self.total,
+                "max_bytes": self.max_bytes,
+            }
+
+apk_proxy = None   # ApkProxy when started with --apk-proxy
+
+class RepoCache:
+    """Pre-encoded index plus an LRU of encoded bundles, with strong ETags."""
+
+    def __init__(self, max_bundles=BUNDLE_CACHE_SIZE, max_bytes=BUNDLE_CACHE_BYTES):
+        self.lock = threading.Lock()
+        self.index = CachedBody(b"")
+        self.bundles = OrderedDict()   # (name, kind) -> CachedBody, least recent first
+        self.bundle_bytes = 0
+        self.max_bundles = max_bundles
+        self.max_bytes = max_bytes
+        # (name, version, kind) -> (sha256 hex, length) of local bundles. Kept
+        # across LRU evictions and rebuilds; a new version gets a new key.
+        self.digests = {}
+        self.digest_index = None       # CachedBody of /repo/index.sha256
+        self.flights = SingleFlight()  # (name, kind) -> bundle being encoded
+        self.hits = 0
+        self.misses = 0
+        self.encodes = 0
+        self.builds = 0
+
+    def rebuild(self):
+        """Re-encode the index and drop bundles built from the old package set."""
+        t0 = time.time()
+        index = CachedBody(build_index().encode('utf-8'))
+        with self.lock:
+            self.index = index
+            self.bundles = OrderedDict()
+            self.bundle_bytes = 0
+            self.digest_index = None
+            self.builds += 1
+        print(f"[Cache] Built index of {len(PACKAGES)} packages in {(time.time() - t0) * 1000:.1f} ms")
+
+    def get_index(self):
+        with self.lock:
+            self.hits += 1
+            return self.index
+
+    def get_bundle(self, name, kind="text"):
+        """Return the CachedBody for a package bundle (kind "text", "binary"
+        or "manifest"), or None if unknown. Bundles are encoded on first
+        request and kept in the LRU; concurrent first requests share one
+        encoding."""
+        key = (name, kind)
+        with self.lock:
+            entry = self.bundles.get(key)
+            if entry:
+                self.bundles.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        return self.flights.do(key, lambda: self._build(name, kind))
+
+    def _build(self, name, kind):
+        key = (name, kind)
+        with self.lock:
+            entry = self.bundles.get(key)   # inserted by a flight that just finished
+            if entry:
+                return entry
+        pkg = PACKAGES.get(name)
+        source = self._source(name)
+        if not source:
+            return None
+        # Proxied payloads already sit in the --apk-cache-mb cache: their
+        # blobs are only claimed and served from there (restore_blob)
+        proxied = not pkg and apk_proxy is not None
+        if kind == "binary":
+            data = encode_binary_bundle(name, *source)
+            # Its header lists the same digests; make them fetchable too
+            for content in source[1].values():
+                body = content.encode('utf-8') if isinstance(content, str) else content
+                if proxied:
+                    blob_store.claim(hashlib.sha256(body).hexdigest(), name)
+                else:
+                    blob_store.put(body, name)
+        elif kind == "manifest":
+            data = encode_manifest(name, *source, store=not proxied).encode('utf-8')
+        else:
+            data = encode_text_bundle(name, *source).encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        entry = CachedBody(data, '"' + digest[:32] + '"')
+        with self.lock:
+            self.encodes += 1
+            if pkg:
+                self.digests[(name, pkg.version, kind)] = (digest, len(data))
+            old = self.bundles.pop(key, None)
+            self.bundle_bytes += len(data) - (len(old.data) if old else 0)
+            self.bundles[key] = entry
+            while len(self.bundles) > 1 and (len(self.bundles) > self.max_bundles
+                                             or self.bundle_bytes > self.max_bytes):
+                _, evicted = self.bundles.popitem(last=False)
+                self.bundle_bytes -= len(evicted.data)
+        return entry
+
+    def _source(self, name):
+        """(version, {path: content}[, {path: mode}]) of a package, or None.
+        Raises UpstreamError for proxied packages that cannot be fetched."""
+        pkg = PACKAGES.get(name)
+        if pkg:
+            return pkg.version, package_files(pkg)
+        if apk_proxy:
+            return apk_proxy.package_files(name)
+        if alpine_index.loaded:
+            return alpine_index.generate_files(name)
+        return None
+
+    def restore_blob(self, digest):
+        """CachedBody of a blob the store does not hold: read from the
+        proxied package that ships it, or re-stored with the rest of its
+        package's bodies after an eviction. None if no package ships it."""
+        name = blob_store.owner(digest)
+        source = name and self._source(name)
+        if not source:
+            return None
+        if name not in PACKAGES and apk_proxy:
+            for content in source[1].values():
+                if hashlib.sha256(content).hexdigest() == digest:
+                    return CachedBody(content, f'"{digest}"')
+            return None
+        for content in source[1].values():
+            blob_store.put(content.encode('utf-8') if isinstance(content, str) else content, name)
+        return blob_store.get(digest)
+
+    def bundle_digest(self, name, kind):
+        """(sha256 hex, length) of a local package's bundle, hashed once."""
+        key = (name, PACKAGES[name].version, kind)
+        with self.lock:
+            digest = self.digests.get(key)
+        if digest is None:
+            self.get_bundle(name, kind)
+            with self.lock:
+                digest = self.digests[key]
+        return digest
+
+    def get_digest_index(self):
+        """CachedBody of /repo/index.sha256: one line per index entry,
+        `name text-sha256 text-length binary-sha256 binary-length`. Built on
+        first request after a catalog change, from digests recorded when the
+        bundles were cached."""
+        with self.lock:
+            if self.digest_index:
+                self.hits += 1
+                return self.digest_index
+        lines = []
+        for name in sorted(PACKAGES):
+            text, binary = self.bundle_digest(name, "text"), self.bundle_digest(name, "binary")
+            lines.append(f"{name} {text[0]} {text[1]} {binary[0]} {binary[1]}")
+        body = CachedBody(('\n'.join(lines) + '\n').encode('utf-8'))
+        with self.lock:
+            self.digest_index = body
+        return body
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+                "encodes": self.encodes,
+                "coalesced": self.flights.waiters,
+                "bundles_cached": len(self.bundles),
+                "bundle_bytes": self.bundle_bytes,
+                "builds": self.builds,
+            }
+
+repo_cache = RepoCache()
+
+# ─── Merged Catalog ───────────────────────────────────────────────────────────
+
+def catalog_entries():
+    """Yield (name, description, depends, index_line) for every package that
+    can be served: local PACKAGES plus the Alpine index once loaded. Local
+    packages shadow Alpine ones of the same name."""
+    if alpine_index.loaded:
+        for name, info in alpine_index.packages.items():
+            if name in PACKAGES:
+                continue
+            size_kb = max(info['size'] // 1024, 1)
+            yield (name, info['description'], info['depends'],
+                   f"{name} {info['version']} {size_kb} x86_64 1 none {info['description']}")
+    for name, pkg in PACKAGES.items():
+        deps = ",".join(pkg.depends) if pkg.depends else "none"
+        yield (name, pkg.description, pkg.depends,
+               f"{name} {pkg.version} {pkg.size_kb} x86_64 {pkg.n_files} {deps} {pkg.description}")
+
+# ─── Search Index ─────────────────────────────────────────────────────────────
+# Trigram inverted index over the merged local + Alpine catalog. Results are
+# ranked in tiers (exact name, name prefix, name substring, description
+# substring), each tier in name order, and collection stops at the limit.
+
+def _grams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class SearchIndex:
+    """Ranked substring search over package names and descriptions."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.names = []       # lowercased names, sorted; position = entry id
+        self.descs = []       # lowercased descriptions, same order
+        self.lines = []       # pre-formatted result line per entry
+        self.exact = {}       # lowercased name -> [ids]
+        self.name_grams = {}  # trigram -> set of ids
+        self.desc_grams = {}
+
+    def build(self):
+        t0 = time.time()
+        ordered = sorted(catalog_entries(), key=lambda e: e[0].lower())
+        names, descs, lines = [], [], []
+        exact, name_grams, desc_grams = {}, {}, {}
+        for i, (name, desc, _deps, line) in enumerate(ordered):
+            lname, ldesc = name.lower(), desc.lower()
+            names.append(lname)
+            descs.append(ldesc)
+            lines.append(line)
+            exact.setdefault(lname, []).append(i)
+            for g in _grams(lname):
+                name_grams.setdefault(g, set()).add(i)
+            for g in _grams(ldesc):
+                desc_grams.setdefault(g, set()).add(i)
+        with self.lock:
+            (self.names, self.descs, self.lines, self.exact,
+             self.name_grams, self.desc_grams) = names, descs, lines, exact, name_grams, desc_grams
+        print(f"[Search] Indexed {len(lines)} packages in {(time.time() - t0) * 1000:.0f} ms")
+
+    @staticmethod
+    def _candidates(kw, grams, texts):
+        """Ids whose text contains kw, in id (= name) order."""
+        if len(kw) < 3:
+            return [i for i, t in enumerate(texts) if kw in t]
+        postings = []
+        for g in _grams(kw):
+            ids = grams.get(g)
+            if not ids:
+                return []
+            postings.append(ids)
+        postings.sort(key=len)
+        ids = postings[0].intersection(*postings[1:])
+        return sorted(i for i in ids if kw in texts[i])
+
+    def query(self, keyword, limit=200):
+        """Return up to `limit` result lines, best matches first."""
+        kw = keyword.lower()
+        with self.lock:
+            names, descs, lines, exact = self.names, self.descs, self.lines, self.exact
+            name_grams, desc_grams = self.name_grams, self.desc_grams
+        out, seen = [], set()
+
+        def take(ids):
+            for i in ids:
+                if i not in seen:
+                    seen.add(i)
+                    out.append(i)
+                    if len(out) >= limit:
+                        return True
+            return False
+
+        def prefixed():
+            i = bisect.bisect_left(names, kw)
+            while i < len(names) and names[i].startswith(kw):
+                yield i
+                i += 1
+
+        tiers = (
+            lambda: exact.get(kw, ()),
+            prefixed,
+            lambda: self._candidates(kw, name_grams, names),
+            lambda: self._candidates(kw, desc_grams, descs),
+        )
+        for tier in tiers:
+            if take(tier()):
+                break
+        return [lines[i] for i in out]
+
+search_index = SearchIndex()
+
+# ─── Dependency Resolution ────────────────────────────────────────────────────
+# The dependency graph is condensed into strongly connected components with
+# Tarjan's algorithm, which emits components dependencies-first: that order is
+# the install order. Packages in a cycle share a component and are installed
+# together. Each component's transitive closure is computed on first use and
+# memoized. Dependencies on names the catalog doesn't know (virtual provides
+# such as "musl" when only local packages are loaded) are skipped.
+
+class DepGraph:
+    """Precomputed dependency graph with memoized install closures."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.comp_of = {}     # name -> component id (ids are in install order)
+        self.members = []     # component id -> sorted member names
+        self.succ = []        # component id -> component ids it depends on
+        self.lines = {}       # name -> index line
+        self.closures = {}    # component id -> frozenset of component ids
+        self.cycles = 0
+
+    def build(self):
+        t0 = time.time()
+        edges, lines = {}, {}
+        for name, _desc, deps, line in catalog_entries():
+            edges[name] = deps
+            lines[name] = line
+        for name in edges:
+            edges[name] = [d for d in edges[name] if d in edges and d != name]
+
+        # Iterative Tarjan SCC
+        index, low, on_stack, stack = {}, {}, set(), []
+        comp_of, members = {}, []
+        counter = 0
+        for root in edges:
+            if root in index:
+                continue
+            work = [(root, iter(edges[root]))]
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                node, it = work[-1]
+                advanced = False
+                for dep in it:
+                    if dep not in index:
+                        index[dep] = low[dep] = counter
+                        counter += 1
+                        stack.append(dep)
+                        on_stack.add(dep)
+                        work.append((dep, iter(edges[dep])))
+                        advanced = True
+                        break
+                    if dep in on_stack:
+                        low[node] = min(low[node], index[dep])
+                if advanced:
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    comp = []
+                    while True:
+                        n = stack.pop()
+                        on_stack.discard(n)
+                        comp_of[n] = len(members)
+                        comp.append(n)
+                        if n == node:
+                            break
+                    members.append(sorted(comp))
+
+        succ = [set() for _ in members]
+        for name, deps in edges.items():
+            c = comp_of[name]
+            for d in deps:
+                if comp_of[d] != c:
+                    succ[c].add(comp_of[d])
+        cycles = sum(1 for m in members if len(m) > 1)
+        with self.lock:
+            self.comp_of, self.members, self.lines = comp_of, members, lines
+            self.succ = [tuple(s) for s in succ]
+            self.closures = {}
+            self.cycles = cycles
+        print(f"[Deps] Graph of {len(edges)} packages, {len(members)} components, "
+              f"{cycles} cycles in {(time.time() - t0) * 1000:.0f} ms")
+
+    def _closure(self, comp, succ, memo):
+        if comp in memo:
+            return memo[comp]
+        stack = [comp]
+        while stack:
+            top = stack[-1]
+            if top in memo:
+                stack.pop()
+                continue
+            pending = [s for s in succ[top] if s not in memo]
+            if pending:
+                stack.extend(pending)
+                continue
+            acc = {top}
+            for s in succ[top]:
+                acc |= memo[s]
+            memo[top] = frozenset(acc)
+            stack.pop()
+        return memo[comp]
+
+    def resolve(self, names):
+        """Return (install_order, unknown) for the requested package names.
+        install_order lists every package needed, dependencies first."""
+        with self.lock:
+            comp_of, members, succ, memo = self.comp_of, self.members, self.succ, self.closures
+        unknown = [n for n in names if n not in comp_of]
+        comps = set()
+        for n in names:
+            if n in comp_of:
+                comps |= self._closure(comp_of[n], succ, memo)
+        order = []
+        for c in sorted(comps):
+            order.extend(members[c])
+        return order, unknown
+
+    def line(self, name):
+        return self.lines.get(name, name)
+
+dep_graph = DepGraph()
+
+# ─── Catalog Generations ──────────────────────────────────────────────────────
+# Every refresh that changes the merged catalog starts a new generation and
+# records what changed (additions, removals, version or metadata bumps).
+# /repo/index?since=N replays the log from N as "+ <index line>" and
+# "- <name>" lines; since=0 is therefore the whole catalog. When N has
+# already been dropped from the bounded log the client gets every current
+# entry with X-Delta: reset and must discard anything not listed.
+
+DELTA_HISTORY = 32   # generations kept in the change log
+GENERATION_EPOCH_BITS = 20   # random low bits of the starting generation
+
+class ChangeLog:
+    """Monotonic catalog generation number plus a bounded change log."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Start from the clock so numbers keep increasing across restarts, with
+        # random low bits so that two runs started within the same second
+        # still number their generations apart. A client holding the previous
+        # run's generation then gets a reset, never a delta against a history
+        # it did not see.
+        self.generation = (int(time.time()) << GENERATION_EPOCH_BITS) | \
+            int.from_bytes(os.urandom(4), "big") >> (32 - GENERATION_EPOCH_BITS)
+        self.snapshot = {}    # name -> index line at the current generation
+        self.log = []         # [(generation, {name: line or None})]
+
+    def update(self):
+        """Diff the catalog against the previous generation; bump if changed."""
+        current = {name: line for name, _desc, _deps, line in catalog_entries()}
+        with self.lock:
+            old = self.snapshot
+            changes = {n: line for n, line in current.items() if old.get(n) != line}
+            changes.update((n, None) for n in old if n not in current)
+            if not changes:
+                return
+            self.generation += 1
+            self.snapshot = current
+            self.log.append((self.generation, changes))
+            del self.log[:-DELTA_HISTORY]
+            added = sum(1 for n, v in changes.items() if v is not None and n not in old)
+            removed = sum(1 for v in changes.values() if v is None)
+            print(f"[Catalog] Generation {self.generation}: +{added} -{removed} "
+                  f"~{len(changes) - added - removed}")
+
+    def delta(self, since):
+        """Return (generation, lines, reset) for a client at `since`, or None
+        if it is already current."""
+        with self.lock:
+            gen = self.generation
+            if since == gen:
+                return None
+            covered = bool(self.log) and self.log[0][0] <= since + 1
+            if since == 0 or since > gen or not covered:
+                lines = [f"+ {line}" for _, line in sorted(self.snapshot.items())]
+                return gen, lines, since != 0
+            merged = {}
+            for g, changes in self.log:
+                if g > since:
+                    merged.update(changes)
+        lines = [f"- {n}" if line is None else f"+ {line}" for n, line in sorted(merged.items())]
+        return gen, lines, False
+
+change_log = ChangeLog()
+
+def refresh_catalog():
+    """Rebuild everything derived from the package set. Called at startup
+    and whenever the set changes (e.g. the Alpine index finishes loading)."""
+    repo_cache.rebuild()
+    search_index.build()
+    dep_graph.build()
+    change_log.update()
+
+# ─── Metrics ──────────────────────────────────────────────────────────────────
+# Counters and per-route latency histograms, rendered in the Prometheus text
+# exposition format on /metrics. Each request takes one short lock to record
+# its route, status, duration and body bytes.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram:
+    """Fixed-bucket latency histogram (seconds)."""
+
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.total += seconds
+        self.count += 1
+
+class Metrics:
+    """Request counters by route and status, latency and bytes by route."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = {}   # (route, status) -> count
+        self.latency = {}    # route -> Histogram
+        self.bytes_sent = {} # route -> body bytes
+
+    def observe(self, route, status, seconds, nbytes):
+        with self.lock:
+            key = (route, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            hist = self.latency.get(route)
+            if hist is None:
+                hist = self.latency[route] = Histogram()
+            hist.observe(seconds)
+            self.bytes_sent[route] = self.bytes_sent.get(route, 0) + nbytes
+
+    def render(self, server=None):
+        """Return the /metrics page."""
+        out = []
+
+        def metric(name, kind, help_text, samples):
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label = "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+                out.append(f"{name}{label} {value}")
+
+        with self.lock:
+            requests = sorted(self.requests.items())
+            latency = sorted((r, list(h.counts), h.total, h.count) for r, h in self.latency.items())
+            sent = sorted(self.bytes_sent.items())
+        metric("pkg_requests_total", "counter", "HTTP requests by route and status",
+               [((("route", r), ("status", st)), n) for (r, st), n in requests])
+        out.append("# HELP pkg_request_duration_seconds Request latency by route")
+        out.append("# TYPE pkg_request_duration_seconds histogram")
+        for route, counts, total, count in latency:
+            cumulative = 0
+            for le, n in zip(LATENCY_BUCKETS, counts):
+                cumulative += n
+                out.append(f'pkg_request_duration_seconds_bucket{{route="{route}",le="{le}"}} {cumulative}')
+            out.append(f'pkg_request_duration_seconds_bucket{{route="{route}",le="+Inf"}} {count}')
+            out.append(f'pkg_request_duration_seconds_sum{{route="{route}"}} {total:.6f}')
+            out.append(f'pkg_request_duration_seconds_count{{route="{route}"}} {count}')
+        metric("pkg_response_bytes_total", "counter", "Response body bytes sent by route",
+               [((("route", r),), n) for r, n in sent])
+
+        cache = repo_cache.stats()
+        metric("pkg_cache_hits_total", "counter", "Index and bundle cache hits", [((), cache["hits"])])
+        metric("pkg_cache_misses_total", "counter", "Bundle cache misses (bundle encoded)",
+               [((), cache["misses"])])
+        metric("pkg_cache_hit_ratio", "gauge", "Cache hits / lookups", [((), cache["hit_ratio"])])
+        metric("pkg_bundle_encodes_total", "counter", "Bundles encoded", [((), cache["encodes"])])
+        metric("pkg_bundle_coalesced_total", "counter", "Requests that waited on an encoding in flight",
+               [((), cache["coalesced"])])
+        metric("pkg_cache_bundles", "gauge", "Encoded bundles held in memory",
+               [((), cache["bundles_cached"])])
+        blobs = blob_store.stats()
+        metric("pkg_blob_dedup_hits_total", "counter", "Blob stores that found the content already held",
+               [((), blobs["dedup_hits"])])
+        metric("pkg_blob_memory_bytes", "gauge", "Blob bodies held in memory", [((), blobs["memory_bytes"])])
+        metric("pkg_blob_disk_bytes", "gauge", "Blob bodies on disk", [((), blobs["disk_bytes"])])
+        metric("pkg_blob_evictions_total", "counter", "Blobs removed from disk to stay under the cap",
+               [((), blobs["evictions"])])
+
+        metric("pkg_packages", "gauge", "Packages in the catalog by source",
+               [((("source", "local"),), len(PACKAGES)),
+                ((("source", "alpine"),), len(alpine_index.packages) if alpine_index.loaded else 0)])
+        metric("pkg_catalog_generation", "gauge", "Current catalog generation", [((), change_log.generation)])
+        metric("pkg_alpine_load_seconds", "gauge", "Duration of the last Alpine index load by source",
+               [((("source", src),), f"{secs:.3f}") for src, secs in sorted(alpine_index.load_seconds.items())])
+        if apk_proxy:
+            proxy = apk_proxy.stats()
+            metric("pkg_apk_fetches_total", "counter", "Packages downloaded from the mirror",
+                   [((), proxy["fetches"])])
+            metric("pkg_apk_fetch_bytes_total", "counter", "Bundle bytes extracted from downloads",
+                   [((), proxy["fetch_bytes"])])
+            metric("pkg_apk_cache_hits_total", "counter", "Proxied packages served from disk",
+                   [((), proxy["hits"])])
+            metric("pkg_apk_coalesced_total", "counter", "Requests that waited on a download in flight",
+                   [((), proxy["coalesced"])])
+            metric("pkg_apk_errors_total", "counter", "Failed package downloads", [((), proxy["errors"])])
+            metric("pkg_apk_cache_bytes", "gauge", "Proxied bundles on disk", [((), proxy["cached_bytes"])])
+        if access_log:
+            metric("pkg_access_log_dropped_total", "counter", "Access log lines dropped (queue full)",
+                   [((), access_log.dropped)])
+        if isinstance(server, PooledHTTPServer):
+            st = server.stats()
+            metric("pkg_connections_active", "gauge", "Connections being served", [((), st["active_conns"])])
+            metric("pkg_workers_busy", "gauge", "Requests being handled", [((), st["busy_workers"])])
+            metric("pkg_requests_queued", "gauge", "Requests waiting for a worker", [((), st["queued_requests"])])
+            metric("pkg_idle_closed_total", "counter", "Idle keep-alive connections closed to make room",
+                   [((), st["idle_closed"])])
+            metric("pkg_connections_peak", "gauge", "Most connections served at once", [((), st["peak_conns"])])
+        metric("pkg_uptime_seconds", "gauge", "Seconds since start", [((), f"{time.time() - self.started:.0f}")])
+        return '\n'.join(out) + '\n'
+
+metrics = Metrics()
+
+class AsyncLog:
+    """Access log written by a background thread in batches, so request
+    threads only append to a queue. Lines are dropped (and counted) rather
+    than blocking a request if the writer falls behind."""
+
+    def __init__(self, stream=None, max_pending=10000):
+        self.stream = stream or sys.stdout
+        self.queue = queue.Queue(max_pending)
+        self.dropped = 0
+        threading.Thread(target=self._run, daemon=True, name="access-log").start()
+
+    def write(self, line):
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            lines = [self.queue.get()]
+            try:
+                while len(lines) < 1000:
+                    lines.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            self.stream.write('\n'.join(lines) + '\n')
+            self.stream.flush()
+
+access_log = None   # AsyncLog when started with --async-log
+
 # ─── HTTP Handler ─────────────────────────────────────────────────────────────
 
 class PkgHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections open between requests so a client can fetch a
+    # whole dependency closure over one TCP connection. Requests that arrive
+    # back to back on the socket (pipelining) are served in order.
+    protocol_version = "HTTP/1.1"
+    timeout = IDLE_TIMEOUT  # seconds an idle keep-alive connection is held
+    # Headers and body go out as separate writes; without TCP_NODELAY the
+    # second one waits on the client's delayed ACK (~40 ms per response).
+    disable_nagle_algorithm = True
+
     def log_message(self, format, *args):
         ts = time.strftime("%H:%M:%S")
-        print(f"[{ts}] {self.address_string()} - {format % args}")
+        line = f"[{ts}] {self.address_string()} - {format % args}"
+        if access_log:
+            access_log.write(line)
+        else:
+            print(line)
+
+    def handle_one_request(self):
+        # Between requests a pooled keep-alive connection is parked, so the
+        # server can close it when it needs the slot for a new client
+        pooled = isinstance(self.server, PooledHTTPServer)
+        if pooled and getattr(self, "kept_alive", False):
+            self.server.park(self.connection)
+        try:
+            super().handle_one_request()
+        finally:
+            if pooled:
+                self.server.unpark(self.connection)
+                self.kept_alive = True
+
+    def parse_request(self):
+        if isinstance(self.server, PooledHTTPServer):
+            self.server.unpark(self.connection)
+        return super().parse_request()
+
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
+
+    def end_response_headers(self):
+        if not isinstance(self.server, PooledHTTPServer):
+            # One connection at a time: an idle keep-alive client would
+            # block everyone else, so close after each response.
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+
+    def send_body(self, status, data, content_type="text/plain", headers=(), encodable=False):
+        """Send a complete response; every path goes through here so that
+        Content-Length is always set and the connection can be reused.
+        encodable bodies are compressed on the fly if the client accepts it."""
+        headers = list(headers)
+        if encodable:
+            encoding = negotiate_encoding(self.headers.get("Accept-Encoding", ""))
+            headers.append(("Vary", "Accept-Encoding"))
+            if encoding and len(data) >= COMPRESS_MIN:
+                data = compress(data, encoding)
+                headers.append(("Content-Encoding", encoding))
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", len(data))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_response_headers()
+        self.wfile.write(data)
+        self.bytes_out += len(data)
+
+    def send_cached(self, body, content_type, ranges=False, headers=()):
+        """Send a CachedBody in the best encoding the client accepts,
+        answering 304 if the client's ETag matches. With ranges=True a
+        single-range Range request gets a 206 slice of the cached buffer."""
+        encoding = negotiate_encoding(self.headers.get("Accept-Encoding", ""))
+        data, etag = body.variant(encoding)
+        vary = ", ".join(["Accept-Encoding"] + [v for k, v in headers if k == "Vary"])
+        headers = [(k, v) for k, v in headers if k != "Vary"] + [("ETag", etag), ("Vary", vary)]
+        if data is not body.data:
+            headers.append(("Content-Encoding", encoding))
+        if ranges:
+            headers.append(("Accept-Ranges", "bytes"))
+        if etag in self.headers.get("If-None-Match", ""):
+            self.send_response(304)
+            for key, value in headers:
+                self.send_header(key, value)
+            self.end_response_headers()
+            return
+        range_header = self.headers.get("Range")
+        if ranges and range_header:
+            # If-Range: only resume if the client's copy is this exact version
+            if_range = self.headers.get("If-Range")
+            if not if_range or if_range.strip() == etag:
+                span = parse_range(range_header, len(data))
+                if span == "unsatisfiable":
+                    self.send_body(416, b"", content_type,
+                                   headers + [("Content-Range", f"bytes */{len(data)}")])
+                    return
+                if span:
+                    start, end = span
+                    headers.append(("Content-Range", f"bytes {start}-{end - 1}/{len(data)}"))
+                    # Zero-copy slice of the cached buffer
+                    self.send_body(206, memoryview(data)[start:end], content_type, headers)
+                    return
+        self.send_body(200, data, content_type, headers)
+
+    def bundle_kind(self, ext=""):
+        """Bundle format the client negotiated: "binary" (.tpk or Accept:
+        application/x-trustos-bundle), "manifest" (.manifest or Accept:
+        application/x-trustos-manifest) or the default "text"."""
+        accept = self.headers.get("Accept", "")
+        if ext == ".tpk" or BIN_BUNDLE_TYPE in accept:
+            return "binary"
+        if ext == ".manifest" or MANIFEST_TYPE in accept:
+            return "manifest"
+        return "text"
+
+    def send_bundles(self, names):
+        """Stream the cached bundles for `names` back to back in one response.
+        Each is self-delimiting: a complete PKG ... EOF block in the text
+        and manifest formats, or a header whose sizes give its length in the
+        binary one."""
+        kind = self.bundle_kind()
+        entries = []
+        for name in names:
+            try:
+                entry = repo_cache.get_bundle(name, kind)
+            except UpstreamError as e:
+                self.send_body(502, f"Upstream fetch failed: {e}\n".encode('utf-8'))
+                return
+            if not entry:
+                self.send_body(404, f"Unknown package: {name}\n".encode('utf-8'))
+                return
+            entries.append(entry.data)
+        self.send_response(200)
+        self.send_header("Content-Type", BUNDLE_TYPES[kind])
+        self.send_header("Vary", "Accept")
+        self.send_header("Content-Length", sum(len(b) for b in entries))
+        self.send_header("X-Packages", ",".join(names))
+        self.end_response_headers()
+        for data in entries:
+            self.wfile.write(data)
+            self.bytes_out += len(data)
 
     def do_GET(self):
+        # Every request is recorded under the route that served it
+        self.route, self.status, self.bytes_out = "404", 0, 0
+        t0 = time.perf_counter()
+        slot = self.server.worker() if isinstance(self.server, PooledHTTPServer) else contextlib.nullcontext()
+        try:
+            with slot:
+                self.route_get()
+        finally:
+            metrics.observe(self.route, self.status, time.perf_counter() - t0, self.bytes_out)
+
+    def route_get(self):
         path = unquote(self.path)
 
         # Package index
         if path in ("/repo/index", "/repo/Packages"):
-            data = build_index().encode('utf-8')
-            self.send_response(200)
-            self.send_header("Content-Type", "text/plain")
-            self.send_header("Content-Length", len(data))
-            self.send_header("Connection", "close")
-            self.end_headers()
-            self.wfile.write(data)
+            self.route = "index"
+            self.send_cached(repo_cache.get_index(), "text/plain",
+                             headers=[("X-Generation", change_log.generation)])
+            return
+
+        # Bundle digests for every index line. Kept out of the index itself:
+        # the kernel splits index lines into 7 fields and the last one, the
+        # description, contains spaces.
+        if path == "/repo/index.sha256":
+            self.route = "index"
+            self.send_cached(repo_cache.get_digest_index(), "text/plain",
+                             headers=[("X-Generation", change_log.generation)])
+            return
+
+        # Delta index: changes since the client's generation
+        if path.startswith("/repo/index?"):
+            self.route = "index-delta"
+            params = parse_qs(urlparse(self.path).query)
+            try:
+                since = int(params.get('since', [''])[0])
+            except ValueError:
+                self.send_body(400, b"Expected ?since=<generation>\n")
+                return
+            delta = change_log.delta(since)
+            if delta is None:
+                self.send_response(304)
+                self.send_header("X-Generation", since)
+                self.end_response_headers()
+                return
+            gen, lines, reset = delta
+            data = ('\n'.join(lines) + '\n').encode('utf-8') if lines else b""
+            self.send_body(200, data, encodable=True, headers=[
+                ("X-Generation", gen), ("X-Delta", "reset" if reset else "incremental")])
             return
 
         # Package search
         if path.startswith("/repo/search"):
+            self.route = "search"
             params = parse_qs(urlparse(self.path).query)
             keyword = params.get('q', [''])[0]
             if not keyword:
-                self.send_response(400)
-                self.send_header("Connection", "close")
-                self.end_headers()
-                self.wfile.write(b"Missing ?q= parameter\n")
+                self.send_body(400, b"Missing ?q= parameter\n")
                 return
-            results = []
-            kw = keyword.lower()
-            # Search local packages
-            for name, pkg in sorted(PACKAGES.items()):
-                if kw in name.lower() or kw in pkg['description'].lower():
-                    deps = ",".join(pkg["depends"]) if pkg["depends"] else "none"
-                    results.append(f"{name} {pkg['version']} {pkg['size_kb']} x86_64 {len(pkg['files'])} {deps} {pkg['description']}")
-            # Search Alpine CDN index
-            if alpine_index.loaded:
-                for aname, ainfo in alpine_index.search(keyword, 100):
-                    if not any(r.startswith(f"{aname} ") for r in results):
-                        size_kb = max(ainfo['size'] // 1024, 1)
-                        results.append(f"{aname} {ainfo['version']} {size_kb} x86_64 1 none {ainfo['description']}")
-            data = ('\n'.join(results[:200]) + '\n').encode('utf-8') if results else b"No results\n"
-            self.send_response(200)
-            self.send_header("Content-Type", "text/plain")
-            self.send_header("Content-Length", len(data))
-            self.send_header("Connection", "close")
-            self.end_headers()
-            self.wfile.write(data)
+            results = search_index.query(keyword, 200)
+            data = ('\n'.join(results) + '\n').encode('utf-8') if results else b"No results\n"
+            self.send_body(200, data, encodable=True)
+            return
+
+        # Dependency resolution: full install set, dependencies first
+        if path.startswith("/repo/resolve") or path.startswith("/repo/bundle"):
+            self.route = "resolve" if path.startswith("/repo/resolve") else "bundle"
+            params = parse_qs(urlparse(self.path).query)
+            names = [n for n in params.get('pkgs', [''])[0].split(',') if n]
+            if not names:
+                self.send_body(400, b"Missing ?pkgs= parameter\n")
+                return
+            if params.get('deps', ['1'])[0] == '0':
+                order = list(dict.fromkeys(names))
+                unknown = [n for n in order if n not in dep_graph.comp_of]
+            else:
+                order, unknown = dep_graph.resolve(names)
+            if unknown:
+                self.send_body(404, ("Unknown package: " + " ".join(unknown) + "\n").encode('utf-8'))
+                return
+            if path.startswith("/repo/resolve"):
+                data = ('\n'.join(dep_graph.line(n) for n in order) + '\n').encode('utf-8')
+                self.send_body(200, data, encodable=True)
+                return
+            self.send_bundles(order)
             return
 
         # Individual package download
         if path.startswith("/repo/pool/"):
-            pkg_name = path.split("/")[-1]
-            # Strip .pkg or .deb extension
-            for ext in (".pkg", ".deb", ".tar"):
-                if pkg_name.endswith(ext):
-                    pkg_name = pkg_name[:-len(ext)]
+            pkg_name = path.split("?")[0].split("/")[-1]
+            # Strip .pkg or .deb extension (.tpk and .manifest select a format)
+            ext = ""
+            for e in (".pkg", ".deb", ".tar", ".tpk", ".manifest"):
+                if pkg_name.endswith(e):
+                    pkg_name = pkg_name[:-len(e)]
+                    ext = e
             # Also strip version suffix like "vim_9.0.2127-r0"
             base_name = pkg_name.split("_")[0] if "_" in pkg_name else pkg_name
 
-            # Check local packages first
-            if base_name in PACKAGES:
-                data = build_package_bundle(base_name, PACKAGES[base_name]).encode('utf-8')
-                self.send_response(200)
-                self.send_header("Content-Type", "application/octet-stream")
-                self.send_header("Content-Length", len(data))
-                self.send_header("Connection", "close")
-                self.end_headers()
-                self.wfile.write(data)
+            kind = self.bundle_kind(ext)
+            try:
+                entry = repo_cache.get_bundle(base_name, kind)
+            except UpstreamError as e:
+                self.route = "alpine-proxy"
+                self.send_body(502, f"Upstream fetch failed: {e}\n".encode('utf-8'))
                 return
-
-            # Alpine CDN fallback: auto-generate for any known Alpine package
-            if alpine_index.loaded:
-                bundle = alpine_index.generate_bundle(base_name)
-                if bundle:
-                    data = bundle.encode('utf-8')
+            if entry:
+                self.route = "pool"
+                if base_name not in PACKAGES and apk_proxy:
+                    self.route = "alpine-proxy"
+                elif base_name not in PACKAGES:
+                    self.route = "alpine-autogen"
                     self.log_message("Alpine auto-gen: %s", base_name)
-                    self.send_response(200)
-                    self.send_header("Content-Type", "application/octet-stream")
-                    self.send_header("Content-Length", len(data))
-                    self.send_header("Connection", "close")
-                    self.end_headers()
-                    self.wfile.write(data)
-                    return
+                self.send_cached(entry, BUNDLE_TYPES[kind], ranges=True, headers=[("Vary", "Accept")])
+                return
+
+        # File body by content digest (listed in manifests)
+        if path.startswith("/repo/blob/"):
+            digest = path.split("?")[0][len("/repo/blob/"):].lower()
+            try:
+                blob = blob_store.get(digest) or repo_cache.restore_blob(digest)
+            except UpstreamError as e:
+                self.route = "blob"
+                self.send_body(502, f"Upstream fetch failed: {e}\n".encode('utf-8'))
+                return
+            if blob:
+                self.route = "blob"
+                self.send_cached(blob, "application/octet-stream", ranges=True, headers=[
+                    ("Cache-Control", "public, max-age=31536000, immutable")])
+                return
+
+        if path == "/metrics":
+            self.route = "metrics"
+            self.send_body(200, metrics.render(self.server).encode('utf-8'),
+                           "text/plain; version=0.0.4", encodable=True)
+            return
 
         # Repo info
         if path in ("/", "/repo", "/repo/"):
+            self.route = "info"
             alpine_n = len(alpine_index.packages) if alpine_index.loaded else 0
             info = {
                 "name": "TrustOS Package Repository",
                 "local_packages": len(PACKAGES),
                 "alpine_packages": alpine_n,
                 "total_available": len(PACKAGES) + alpine_n,
-                "total_files": sum(len(p["files"]) for p in PACKAGES.values()),
+                "total_files": sum(p.n_files for p in PACKAGES.values()),
+                "generation": change_log.generation,
+                "cache": repo_cache.stats(),
+                "blobs": blob_store.stats(),
             }
+            if apk_proxy:
+                info["apk_proxy"] = apk_proxy.stats()
+            if isinstance(self.server, PooledHTTPServer):
+                info["server"] = self.server.stats()
             data = json.dumps(info, indent=2).encode('utf-8')
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.send_header("Content-Length", len(data))
-            self.send_header("Connection", "close")
-            self.end_headers()
-            self.wfile.write(data)
+            self.send_body(200, data, "application/json")
             return
 
         # 404
-        self.send_response(404)
-        self.send_header("Content-Type", "text/plain")
-        self.send_header("Connection", "close")
-        self.end_headers()
-        self.wfile.write(b"404 Not Found\n")
+        self.route = "404"
+        self.send_body(404, b"404 Not Found\n")
+
+# ─── Concurrent Server ────────────────────────────────────────────────────────
+# HTTPServer handles one connection at a time, so a single slow VM on a slirp
+# link stalls everyone. PooledHTTPServer gives each accepted connection its
+# own thread, up to max_conns, and lets at most `workers` of them handle a
+# request at once. A keep-alive connection waiting for its next request holds
+# only its thread, never a worker, and when all max_conns slots are taken the
+# connection idle the longest is closed to make room, so idle VMs cannot
+# starve busy ones.
+
+class PooledHTTPServer(http.server.HTTPServer):
+    """HTTPServer with a concurrent-connection cap and a request worker cap."""
+
+    request_queue_size = 128
+
+    def __init__(self, addr, handler, workers=16, max_conns=64):
+        super().__init__(addr, handler)
+        self.workers = workers
+        self.max_conns = max(max_conns, workers)
+        self.slots = threading.BoundedSemaphore(self.max_conns)
+        self.busy = threading.BoundedSemaphore(workers)
+        self.conn_lock = threading.Lock()
+        self.active_conns = 0
+        self.peak_conns = 0
+        self.busy_workers = 0
+        self.queued_requests = 0
+        self.parked = OrderedDict()   # idle keep-alive sockets, longest idle first
+        self.idle_closed = 0
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            self.close_idle()
+            self.slots.acquire()
+        with self.conn_lock:
+            self.active_conns += 1
+            self.peak_conns = max(self.peak_conns, self.active_conns)
+        threading.Thread(target=self._work, args=(request, client_address),
+                         name="pkg-conn", daemon=True).start()
+
+    def _work(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.conn_lock:
+                self.active_conns -= 1
+            self.slots.release()
+
+    def park(self, sock):
+        """Mark a keep-alive connection as waiting for its next request."""
+        with self.conn_lock:
+            self.parked[sock] = None
+
+    def unpark(self, sock):
+        with self.conn_lock:
+            self.parked.pop(sock, None)
+
+    def close_idle(self):
+        """Shut down the longest idle keep-alive connection, if any; its
+        thread then sees EOF and gives its slot back."""
+        with self.conn_lock:
+            if not self.parked:
+                return
+            sock, _ = self.parked.popitem(last=False)
+            self.idle_closed += 1
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    @contextlib.contextmanager
+    def worker(self):
+        """Hold one of the `workers` request slots while a request is served."""
+        with self.conn_lock:
+            self.queued_requests += 1
+        self.busy.acquire()
+        with self.conn_lock:
+            self.queued_requests -= 1
+            self.busy_workers += 1
+        try:
+            yield
+        finally:
+            with self.conn_lock:
+                self.busy_workers -= 1
+            self.busy.release()
+
+    def stats(self):
+        with self.conn_lock:
+            return {
+                "workers": self.workers,
+                "max_conns": self.max_conns,
+                "active_conns": self.active_conns,
+                "peak_conns": self.peak_conns,
+                "busy_workers": self.busy_workers,
+                "queued_requests": self.queued_requests,
+                "idle_closed": self.idle_closed,
+            }
 
 def main():
+    global ALPINE_MIRROR, access_log, apk_proxy
     port = PORT
     host = HOST
+    workers = 0
+    max_conns = 0
+    cache_dir = CACHE_DIR
+    apk_cache_mb = APK_CACHE_MB
     for i, arg in enumerate(sys.argv[1:], 1):
         if arg == "--port" and i < len(sys.argv) - 1:
             port = int(sys.argv[i + 1])
         elif arg == "--host" and i < len(sys.argv) - 1:
             host = sys.argv[i + 1]
+        elif arg == "--workers" and i < len(sys.argv) - 1:
+            workers = int(sys.argv[i + 1])
+        elif arg == "--max-conns" and i < len(sys.argv) - 1:
+            max_conns = int(sys.argv[i + 1])
+        elif arg == "--idle-timeout" and i < len(sys.argv) - 1:
+            PkgHandler.timeout = float(sys.argv[i + 1])
+        elif arg == "--mirror" and i < len(sys.argv) - 1:
+            ALPINE_MIRROR = sys.argv[i + 1].rstrip("/")
+        elif arg == "--cache-dir" and i < len(sys.argv) - 1:
+            cache_dir = sys.argv[i + 1]
+            alpine_index.cache_path = os.path.join(cache_dir, "alpine-index.pickle")
+            blob_store.directory = os.path.join(cache_dir, "blobs")
+        elif arg == "--blob-cache-mb" and i < len(sys.argv) - 1:
+            blob_store.disk_max_bytes = int(float(sys.argv[i + 1]) * (1 << 20))
+        elif arg == "--apk-cache-mb" and i < len(sys.argv) - 1:
+            apk_cache_mb = float(sys.argv[i + 1])
 
-    # Start Alpine CDN index loading in background
+    if "--async-log" in sys.argv:
+        access_log = AsyncLog()
+
+    # Serve the cached Alpine index right away, refresh it in the background
     no_alpine = "--no-alpine" in sys.argv
-    if not no_alpine:
+    offline = "--offline" in sys.argv
+    if "--apk-proxy" in sys.argv and not no_alpine:
+        apk_proxy = ApkProxy(os.path.join(cache_dir, "apk"), int(apk_cache_mb * (1 << 20)), offline)
+    cached = not no_alpine and alpine_index.load_cache()
+    refresh_catalog()
+    if not no_alpine and not offline:
         alpine_index.load_async()
 
-    server = http.server.HTTPServer((host, port), PkgHandler)
+    if no_alpine:
+        alpine_mode = "disabled (--no-alpine)"
+    elif offline:
+        alpine_mode = f"offline, {len(alpine_index.packages)} cached packages" if cached \
+            else "offline, no cache available"
+    elif cached:
+        alpine_mode = f"{len(alpine_index.packages)} cached packages (refreshing in background)"
+    else:
+        alpine_mode = "enabled (loading in background)"
+
+    if workers > 0:
+        server = PooledHTTPServer((host, port), PkgHandler, workers, max_conns or workers * 4)
+        mode = f"threaded ({server.workers} workers, max {server.max_conns} connections)"
+    else:
+        server = http.server.HTTPServer((host, port), PkgHandler)
+        mode = "single-threaded (use --workers N for concurrent serving)"
     print()
     print(f"  TrustOS Package Server v2.0")
     print(f"  " + "─" * 40)
     print(f"  Local packages:  {len(PACKAGES)}")
-    print(f"  Alpine CDN:      {'enabled (loading in background)' if not no_alpine else 'disabled (--no-alpine)'}")
+    print(f"  Alpine CDN:      {alpine_mode}")
+    if apk_proxy:
+        print(f"  Alpine payloads: proxied from {ALPINE_MIRROR} ({apk_proxy.stats()['cached']} cached, "
+              f"cap {apk_cache_mb:g} MB)")
     print(f"  Listening on:    {host}:{port}")
+    print(f"  Serving mode:    {mode}")
     print(f"  Endpoints:")
-    print(f"    GET /repo/index          Package list")
-    print(f"    GET /repo/pool/<n>.pkg   Download package")
-    print(f"    GET /repo/search?q=<kw>  Search packages")
+    print(f"    GET /repo/index             Package list")
+    print(f"    GET /repo/index?since=<gen> Catalog changes since a generation")
+    print(f"    GET /repo/index.sha256      Bundle SHA-256 and length per package")
+    print(f"    GET /repo/pool/<n>.pkg      Download package (.tpk: binary format)")
+    print(f"    GET /repo/pool/<n>.manifest File list by content digest")
+    print(f"    GET /repo/blob/<sha256>     File body (immutable)")
+    print(f"    GET /repo/search?q=<kw>     Search packages")
+    print(f"    GET /repo/resolve?pkgs=a,b  Install order incl. dependencies")
+    print(f"    GET /repo/bundle?pkgs=a,b   All bundles of the install set")
+    print(f"    GET /metrics                Prometheus metrics")
     print()
 
     try: